@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Compares parsing IPN dates with dateutil, as IPN.process_date did, to the
+fixed format parsers with and without the LRU cache.
+
+    $ python benchmarks/ipn_dates.py
+
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings
+
+settings.configure(PAYPAL_APPLICATION_ID='fake', PAYPAL_USERID='fake',
+                   PAYPAL_PASSWORD='fake', PAYPAL_SIGNATURE='fake',
+                   PAYPAL_EMAIL='fake@example.com')
+
+from dateutil.parser import parse
+from pytz import utc
+
+from paypaladaptive.api.ipn import dates
+from paypaladaptive.api.ipn.constants import IPN_TIMEZONES
+
+DATES = ('Thu Jun 09 07:23:38 PDT 2011',
+         '2013-07-06T11:34:05.000-07:00')
+
+
+def with_dateutil(date_str):
+    return parse(date_str, tzinfos=IPN_TIMEZONES).astimezone(utc)
+
+
+def uncached(date_str):
+    dates._cache.clear()
+    return dates.parse_date(date_str)
+
+
+def main():
+    number = 10000
+
+    for date_str in DATES:
+        for name, parse_date in (('dateutil', with_dateutil),
+                                 ('fixed format', uncached),
+                                 ('cached', dates.parse_date)):
+            seconds = min(timeit.repeat(lambda: parse_date(date_str),
+                                        number=number, repeat=3))
+            print '%-31s %-12s: %6.2f us per date' % (
+                date_str, name, seconds / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Compares parsing the transactions of an IPN with one pass over the POST
+items to the previous six slicedict scans.
+
+    $ python benchmarks/ipn_transactions.py [receivers ...]
+
+"""
+
+import os
+import sys
+import timeit
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings
+
+settings.configure(PAYPAL_APPLICATION_ID='fake', PAYPAL_USERID='fake',
+                   PAYPAL_PASSWORD='fake', PAYPAL_SIGNATURE='fake',
+                   PAYPAL_EMAIL='fake@example.com')
+
+from django.http import QueryDict
+
+from paypaladaptive.api.ipn import IPN
+
+
+class Request(object):
+    def __init__(self, receivers):
+        data = {'transaction_type': 'Adaptive Payment PAY',
+                'status': 'COMPLETED',
+                'pay_key': 'AP-1234567890',
+                'sender_email': 'buyer@example.com',
+                'action_type': 'PAY',
+                'fees_payer': 'EACHRECEIVER',
+                'memo': 'A payment',
+                'notify_version': 'UNVERSIONED',
+                'verify_sign': 'AFcWxV21C7fd0v3bYYYRCpSSRl31AzHvdpOG25tWUY9',
+                'charset': 'windows-1252',
+                'test_ipn': '1'}
+
+        for n in range(receivers):
+            prefix = 'transaction[%s].' % n
+            data.update({prefix + 'id': '%sXYZ' % n,
+                         prefix + 'status': 'Completed',
+                         prefix + 'id_for_sender_txn': '%sABC' % n,
+                         prefix + 'status_for_sender_txn': 'Completed',
+                         prefix + 'receiver': 'r%s@example.com' % n,
+                         prefix + 'amount': 'USD 10.00',
+                         prefix + 'is_primary_receiver': 'false',
+                         prefix + 'pending_reason': 'NONE'})
+
+        self.POST = QueryDict(urllib.urlencode(data))
+
+
+def sliced(ipn, request):
+    """The parser as it was, limited to six transactions"""
+
+    ipn.transactions = []
+    for transaction_num in range(6):
+        transdict = IPN.Transaction.slicedict(
+            request.POST, 'transaction[%s].' % transaction_num)
+        if len(transdict) > 0:
+            ipn.transactions.append(IPN.Transaction(**transdict))
+
+
+def main(receivers=(1, 6, 20)):
+    ipn = IPN.__new__(IPN)
+
+    for count in receivers:
+        request = Request(count)
+        number = 10000
+
+        for name, parse in (('slicedict', sliced),
+                            ('single pass', IPN.process_transactions)):
+            seconds = min(timeit.repeat(lambda: parse(ipn, request),
+                                        number=number, repeat=3))
+            print '%2i receivers, %-11s: %6.1f us per IPN, %i parsed' % (
+                count, name, seconds / number * 1e6, len(ipn.transactions))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or (1, 6, 20))
@@ -19,3 +19,15 @@ class PaymentAdmin(admin.ModelAdmin):
 
 class RefundAdmin(admin.ModelAdmin):
     pass
+
+
+class AuditRecordAdmin(admin.ModelAdmin):
+    list_display = ('created_date', 'endpoint', 'failed', 'object_type',
+                    'object_id')
+    list_filter = ('endpoint', 'failed')
+
+
+class IPNMessageAdmin(admin.ModelAdmin):
+    list_display = ('created_date', 'object_id', 'status', 'verified',
+                    'attempts')
+    list_filter = ('status', 'verified')
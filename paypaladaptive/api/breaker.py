@@ -0,0 +1,168 @@
+"""Circuit breaker for calls to Paypal"""
+
+import logging
+import time
+
+from django.core.cache import get_cache
+
+from paypaladaptive import metrics, settings
+
+from errors import CircuitOpenError, TransportError
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling Paypal for a while when it keeps failing.
+
+    The breaker opens when `failure_threshold` failed or slow calls are
+    recorded within `window` seconds. While open, calls fail fast with
+    CircuitOpenError. After `reset_timeout` seconds it lets through up to
+    `half_open_probes` probe calls and closes again once that many of them
+    have succeeded; a failing probe opens it again.
+
+    The state is kept in the Django cache so that all processes sharing a
+    cache back off together.
+
+    """
+
+    def __init__(self, name, failure_threshold=None, window=None,
+                 reset_timeout=None, slow_call_threshold=None,
+                 half_open_probes=None, cache_alias=None):
+        self.name = name
+        self.failure_threshold = (
+            settings.BREAKER_FAILURE_THRESHOLD
+            if failure_threshold is None else failure_threshold)
+        self.window = settings.BREAKER_WINDOW if window is None else window
+        self.reset_timeout = (settings.BREAKER_RESET_TIMEOUT
+                              if reset_timeout is None else reset_timeout)
+        self.slow_call_threshold = (
+            settings.BREAKER_SLOW_CALL_THRESHOLD
+            if slow_call_threshold is None else slow_call_threshold)
+        self.half_open_probes = (
+            settings.BREAKER_HALF_OPEN_PROBES
+            if half_open_probes is None else half_open_probes)
+        self.cache_alias = cache_alias or settings.BREAKER_CACHE
+        self._cache = None
+
+    @property
+    def cache(self):
+        # resolved on first use, as the breakers are created at import time
+        if self._cache is None:
+            self._cache = get_cache(self.cache_alias)
+        return self._cache
+
+    def _key(self, suffix):
+        return 'paypaladaptive:breaker:%s:%s' % (self.name, suffix)
+
+    def _failures_key(self, now):
+        return self._key('failures:%d' % (now // self.window))
+
+    def _incr(self, key, timeout):
+        self.cache.add(key, 0, timeout)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # expired between add and incr
+            self.cache.set(key, 1, timeout)
+            return 1
+
+    @property
+    def state(self):
+        opened_at = self.cache.get(self._key('opened_at'))
+
+        if opened_at is None:
+            return 'closed'
+        elif time.time() - opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError unless a call may be made now. Returns True
+        if the call is a half-open probe.
+
+        """
+
+        opened_at = self.cache.get(self._key('opened_at'))
+
+        if opened_at is None:
+            return False
+
+        if time.time() - opened_at < self.reset_timeout:
+            metrics.incr('api.breaker.rejected')
+            raise CircuitOpenError('Circuit to Paypal is open since %s'
+                                   % time.ctime(opened_at))
+
+        probes = self._incr(self._key('probes'), self.reset_timeout)
+        if probes > self.half_open_probes:
+            metrics.incr('api.breaker.rejected')
+            raise CircuitOpenError('Circuit to Paypal is half-open and '
+                                   'waiting for probe calls')
+        return True
+
+    def record_success(self, duration, probe=False):
+        if (self.slow_call_threshold is not None
+                and duration > self.slow_call_threshold):
+            self.record_failure(probe=probe)
+            return
+
+        if probe:
+            successes = self._incr(self._key('successes'),
+                                   self.reset_timeout)
+            if successes >= self.half_open_probes:
+                self.close()
+
+    def record_failure(self, probe=False):
+        if probe:
+            self.open()
+            return
+
+        now = time.time()
+        failures = self._incr(self._failures_key(now), self.window * 2)
+        if failures >= self.failure_threshold:
+            self.open()
+
+    def open(self):
+        logger.warning('Opening circuit breaker %s' % self.name)
+        metrics.incr('api.breaker.opened')
+        self.cache.set(self._key('opened_at'), time.time(),
+                       self.reset_timeout * 10)
+        self.cache.delete_many([self._key('probes'),
+                                self._key('successes')])
+
+    def close(self):
+        logger.info('Closing circuit breaker %s' % self.name)
+        now = time.time()
+        self.cache.delete_many([self._key('opened_at'),
+                                self._key('probes'),
+                                self._key('successes'),
+                                self._failures_key(now)])
+
+    def call(self, function, is_failure=None):
+        """
+        Call function through the breaker. Exceptions of the type
+        TransportError and results for which is_failure returns True count
+        as failures.
+
+        """
+
+        probe = self.before_call()
+        started = time.time()
+
+        try:
+            result = function()
+        except TransportError:
+            self.record_failure(probe=probe)
+            raise
+
+        if is_failure is not None and is_failure(result):
+            self.record_failure(probe=probe)
+        else:
+            self.record_success(time.time() - started, probe=probe)
+
+        return result
+
+
+adaptive_breaker = CircuitBreaker('adaptive')
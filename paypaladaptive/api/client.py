@@ -0,0 +1,80 @@
+"""
+Non-blocking client for the Adaptive Payments API.
+
+Calls are made on a bounded pool of worker threads and return futures, so
+that a single caller can have many calls to Paypal in flight at once::
+
+    with AsyncClient(max_workers=50) as client:
+        futures = [client.payment_details(payKey=key) for key in keys]
+        for future in as_completed(futures):
+            endpoint = future.result()
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+from paypaladaptive import settings
+
+from endpoints import (Pay, PaymentDetails, Preapprove, PreapprovalDetails,
+                       Refund, CancelPreapproval)
+from ipn import IPN
+
+__all__ = ('AsyncClient', 'as_completed', 'wait')
+
+
+class AsyncClient(object):
+    """
+    Makes endpoint calls on a thread pool. Every method returns a Future
+    that resolves to the called endpoint, or raises the same error as the
+    blocking call would have.
+
+    The endpoint is built in the calling thread, so invalid arguments raise
+    right away instead of through the future.
+
+    """
+
+    def __init__(self, max_workers=None, executor=None):
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers or settings.ASYNC_MAX_WORKERS)
+        self.executor = executor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def call(self, endpoint_class, *args, **kwargs):
+        endpoint = endpoint_class(*args, **kwargs)
+        return self.executor.submit(self._call, endpoint)
+
+    def _call(self, endpoint):
+        endpoint.call()
+        return endpoint
+
+    def pay(self, *args, **kwargs):
+        return self.call(Pay, *args, **kwargs)
+
+    def payment_details(self, *args, **kwargs):
+        return self.call(PaymentDetails, *args, **kwargs)
+
+    def preapprove(self, *args, **kwargs):
+        return self.call(Preapprove, *args, **kwargs)
+
+    def preapproval_details(self, *args, **kwargs):
+        return self.call(PreapprovalDetails, *args, **kwargs)
+
+    def refund(self, *args, **kwargs):
+        return self.call(Refund, *args, **kwargs)
+
+    def cancel_preapproval(self, *args, **kwargs):
+        return self.call(CancelPreapproval, *args, **kwargs)
+
+    def verify_ipn(self, request, deadline=None):
+        """Verify and parse an incoming IPN, resolves to an IPN instance"""
+
+        return self.executor.submit(IPN, request, deadline=deadline)
@@ -1,3 +1,5 @@
+from decimal import Decimal
+
 from errors import ReceiverError
 
 
@@ -51,4 +53,19 @@ class ReceiverList():
 
     @property
     def total_amount(self):
-        return sum([r.amount for r in self.receivers])
\ No newline at end of file
+        # amounts may be numbers or strings, e.g. read back from JSON
+        return sum([Decimal(str(r.amount)) for r in self.receivers],
+                   Decimal('0'))
+
+
+class FrozenDict(dict):
+    """A dict that can't be changed once it has been created"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("%s can't be changed" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
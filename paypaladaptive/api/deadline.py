@@ -0,0 +1,52 @@
+import time
+from datetime import timedelta
+
+from errors import DeadlineExceeded
+
+
+class Deadline(object):
+    """
+    A point in time by which a call to Paypal has to be finished. A single
+    deadline can be passed down through several calls, each of which gets
+    the time that is left of it.
+
+    """
+
+    def __init__(self, seconds):
+        if isinstance(seconds, timedelta):
+            seconds = seconds.days * 86400 + seconds.seconds + (
+                seconds.microseconds / 1000000.0)
+        self.expires_at = time.time() + seconds
+
+    @classmethod
+    def coerce(cls, value):
+        """Turn seconds or a timedelta into a Deadline, pass None through"""
+
+        if value is None or isinstance(value, Deadline):
+            return value
+        return cls(value)
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, timeout=None):
+        """
+        Cap a timeout to what is left of the deadline. Raises
+        DeadlineExceeded if there is no time left.
+
+        """
+
+        remaining = self.remaining()
+
+        if remaining <= 0:
+            raise DeadlineExceeded('Deadline exceeded by %.3f seconds'
+                                   % -remaining)
+
+        if timeout is None:
+            return remaining
+
+        return min(timeout, remaining)
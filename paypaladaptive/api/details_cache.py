@@ -0,0 +1,49 @@
+"""Read-through cache of PaymentDetails and PreapprovalDetails responses"""
+
+from django.core.cache import get_cache
+
+from paypaladaptive import metrics, settings
+
+
+class DetailsCache(object):
+    """
+    Keeps raw details responses in the Django cache, keyed by payKey or
+    preapprovalKey. How long a response is kept depends on the status it
+    reports: objects that are still in progress change soon, while
+    completed and canceled ones rarely change at all.
+
+    """
+
+    def __init__(self, name, ttls=None, default_ttl=None, cache_alias=None):
+        self.name = name
+        self.ttls = settings.DETAILS_CACHE_TTLS if ttls is None else ttls
+        self.default_ttl = (settings.DETAILS_CACHE_DEFAULT_TTL
+                            if default_ttl is None else default_ttl)
+        self.cache_alias = cache_alias or settings.DETAILS_CACHE
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.cache_alias)
+        return self._cache
+
+    def _key(self, key):
+        return 'paypaladaptive:details:%s:%s' % (self.name, key)
+
+    def get_ttl(self, status):
+        return self.ttls.get(status, self.default_ttl)
+
+    def get(self, key):
+        raw_response = self.cache.get(self._key(key))
+        metrics.incr('api.details_cache.%s'
+                     % ('misses' if raw_response is None else 'hits'))
+        return raw_response
+
+    def set(self, key, raw_response, status=None):
+        ttl = self.get_ttl(status)
+        if ttl:
+            self.cache.set(self._key(key), raw_response, ttl)
+
+    def delete(self, key):
+        self.cache.delete(self._key(key))
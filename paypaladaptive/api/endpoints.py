@@ -3,33 +3,66 @@
 from datetime import datetime, timedelta
 import logging
 
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import simplejson as json
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from money.Money import Money
 
 from paypaladaptive import settings
 
 from errors import *
-from datatypes import ReceiverList
+from datatypes import FrozenDict, ReceiverList
+from breaker import adaptive_breaker
+from deadline import Deadline
+from details_cache import DetailsCache
 from httpwrapper import UrlRequest
+from retry import NO_RETRY, RetryPolicy
+from singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
 
+def is_transient(request):
+    """Whether a failed request is worth retrying"""
+
+    return request.code is None or request.code >= 500
+
+
 class PaypalAdaptiveEndpoint(object):
-    """Base class for all Paypal endpoints"""
+    """
+    Base class for all Paypal endpoints
+
+    Each instance builds its own request data and headers when it is
+    created and they can't be changed afterwards, so endpoints can be
+    built and called from several threads at once.
 
-    headers = {}
-    data = {'requestEnvelope': {'errorLanguage': 'en_US'}, }
+    """
+
+    request_envelope = {'errorLanguage': 'en_US'}
+    headers = None
+    data = None
     raw_response = None
     response = None
     error_class = Exception
     url = None
+    key_name = None
+    details_cache = None
+    single_flight = None
+    deadline = None
+    retry_policy = NO_RETRY
+    circuit_breaker = (adaptive_breaker if settings.USE_CIRCUIT_BREAKER
+                       else None)
 
     def __init__(self, *args, **kwargs):
         remote_address = kwargs.pop('remote_address', None)
-        self._build_headers(remote_address=remote_address)
-        self.data.update(self.prepare_data(*args, **kwargs))
+        self.deadline = Deadline.coerce(kwargs.pop('deadline', None))
+        self.attempts = []
+        self.headers = self._build_headers(remote_address=remote_address)
+
+        data = {'requestEnvelope': FrozenDict(self.request_envelope)}
+        data.update(self.prepare_data(*args, **kwargs))
+        self.data = FrozenDict(data)
 
     def _build_headers(self, remote_address=None):
         headers = {'X-PAYPAL-SECURITY-USERID': settings.PAYPAL_USERID,
@@ -42,13 +75,27 @@ class PaypalAdaptiveEndpoint(object):
         if remote_address:
             headers['X-PAYPAL-DEVICE-IPADDRESS'] = remote_address
 
-        self.headers.update(headers)
+        return FrozenDict(headers)
 
     def call(self):
-        request = UrlRequest().call(self.url, data=json.dumps(self.data),
-                                    headers=self.headers)
-        self.raw_response = request.response
-        self.response = json.loads(request.response)
+        key = self.get_key()
+        cache_key = key if self.details_cache is not None else None
+        self.cached = False
+        raw_response = None
+
+        if cache_key is not None:
+            raw_response = self.details_cache.get(cache_key)
+            self.cached = raw_response is not None
+
+        if raw_response is None:
+            if key is not None and self.single_flight is not None:
+                raw_response = self.single_flight.do(
+                    key, self._send, deadline=self.deadline)
+            else:
+                raw_response = self._send()
+
+        self.raw_response = raw_response
+        self.response = json.loads(raw_response)
 
         logger.debug('headers are: %s' % str(self.headers))
         logger.debug('request is: %s' % str(self.data))
@@ -66,6 +113,105 @@ class PaypalAdaptiveEndpoint(object):
 
             raise self.error_class(error_message)
 
+        if cache_key is not None and not self.cached:
+            self.details_cache.set(cache_key, raw_response,
+                                   self.response.get('status'))
+
+    @property
+    def error_ids(self):
+        """The errorIds of a failed call"""
+
+        errors = getattr(self, 'response', None) or {}
+        return [error.get('errorId') for error in errors.get('error', [])]
+
+    def _send(self):
+        # amounts may be Decimals, which are sent as strings
+        data = json.dumps(self.data, cls=DjangoJSONEncoder)
+
+        def send():
+            return UrlRequest().call(self.url, data=data,
+                                     headers=self.headers,
+                                     deadline=self.deadline)
+
+        def attempt():
+            if self.circuit_breaker is None:
+                return send()
+            return self.circuit_breaker.call(send, is_failure=is_transient)
+
+        request = self.get_retry_policy().run(
+            attempt, deadline=self.deadline, retry_result=is_transient,
+            attempts=self.attempts)
+
+        if is_transient(request):
+            raise TransportError('Paypal call to %s failed with code %s: %s'
+                                 % (self.url, request.code, request.response))
+
+        return request.response
+
+    def get_key(self):
+        """Value of the key_name field of the request, if any"""
+
+        if self.key_name is None:
+            return None
+        return self.data.get(self.key_name)
+
+    @classmethod
+    def invalidate_cache(cls, key):
+        """Forget the cached response for key"""
+
+        if cls.details_cache is not None:
+            cls.details_cache.delete(key)
+
+    @classmethod
+    def bulk(cls, keys, max_workers=None, deadline=None):
+        """
+        Call the endpoint once for every key in keys, passed as the
+        endpoint's key_name argument, on at most max_workers threads.
+        Returns a dict mapping each key to its called endpoint, or to the
+        exception that its call raised.
+
+        """
+
+        if cls.key_name is None:
+            raise NotImplementedError("%s does not support bulk calls"
+                                      % cls.__name__)
+
+        deadline = Deadline.coerce(deadline)
+        results = {}
+        keys = set(keys)
+
+        if not keys:
+            return results
+
+        def fetch(key):
+            endpoint = cls(deadline=deadline, **{cls.key_name: key})
+            endpoint.call()
+            return endpoint
+
+        executor = ThreadPoolExecutor(
+            min(max_workers or settings.ASYNC_MAX_WORKERS, len(keys)))
+
+        try:
+            futures = dict((executor.submit(fetch, key), key) for key in keys)
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception, e:
+                    results[futures[future]] = e
+        finally:
+            executor.shutdown()
+
+        return results
+
+    def get_retry_policy(self):
+        """
+        Override this to only retry calls that are safe to send more than
+        once.
+
+        """
+
+        return self.retry_policy
+
     def prepare_data(self, *args, **kwargs):
         """
         Override this to set the correct data for the Endpoint. Has to return
@@ -80,7 +226,7 @@ class PaypalAdaptiveEndpoint(object):
         print json.dumps(json.loads(self.raw_response), indent=4)
 
     def pretty_request(self):
-        print json.dumps(self.data, indent=4)
+        print json.dumps(self.data, cls=DjangoJSONEncoder, indent=4)
 
 
 class Pay(PaypalAdaptiveEndpoint):
@@ -88,6 +234,10 @@ class Pay(PaypalAdaptiveEndpoint):
 
     url = '%s%s' % (settings.PAYPAL_ENDPOINT, 'Pay')
     error_class = PayError
+    # a resent call could charge twice, or fail on a trackingId that the
+    # first one used; payments that may have reached Paypal are looked up
+    # by their trackingId instead
+    retry_policy = NO_RETRY
 
     def prepare_data(self, money, return_url, cancel_url, receivers,
                      ipn_url=None, **kwargs):
@@ -134,6 +284,15 @@ class PaymentDetails(PaypalAdaptiveEndpoint):
 
     url = '%s%s' % (settings.PAYPAL_ENDPOINT, 'PaymentDetails')
     error_class = PaypalAdaptiveApiError
+    key_name = 'payKey'
+    details_cache = (DetailsCache('payment') if settings.USE_DETAILS_CACHE
+                     else None)
+    single_flight = (SingleFlight('payment') if settings.USE_SINGLE_FLIGHT
+                     else None)
+    retry_policy = RetryPolicy()
+
+    # Paypal's answer to a key or id it has no payment for
+    not_found_error_id = '580022'
 
     def prepare_data(self, payKey=None, transactionId=None, trackingId=None):
         """Prepare data for PaymentDetails API call"""
@@ -156,23 +315,81 @@ class PaymentDetails(PaypalAdaptiveEndpoint):
 
         return data
 
+    @property
+    def payment_info(self):
+        """List of paymentInfo of the response, one per receiver"""
+
+        return self.response.get('paymentInfoList', {}).get('paymentInfo', [])
+
+    @property
+    def not_found(self):
+        """Whether the call failed because Paypal has no such payment"""
+
+        return self.not_found_error_id in self.error_ids
+
 
 class Refund(PaypalAdaptiveEndpoint):
     """
     Models the Refund API operation
-    
-    Currently only a full refund is supported.
+
+    Refunds the whole payment, or only the amounts of the given receivers
+    when receivers (a ReceiverList) and the currency_code of the payment
+    are passed.
 
     """
 
     url = '%s%s' % (settings.PAYPAL_ENDPOINT, 'Refund')
     error_class = RefundError
+    # a resent call could refund twice, Refund.look_up() looks up failed
+    # calls instead
+    retry_policy = NO_RETRY
 
-    def prepare_data(self, pay_key):
+    # refundStatus values of receivers whose refund went through
+    refunded_statuses = ('REFUNDED', 'REFUNDED_PENDING', 'PARTIALLY_REFUNDED',
+                         'ALREADY_REVERSED_OR_REFUNDED')
+
+    def prepare_data(self, pay_key, receivers=None, currency_code=None):
         if not pay_key:
             raise ValueError("a payKey must be provided")
-        
-        return {'payKey': pay_key}
+
+        data = {'payKey': pay_key}
+
+        if receivers is not None:
+            if not isinstance(receivers, ReceiverList) or len(receivers) < 1:
+                raise ValueError("receivers must be an instance of "
+                                 "ReceiverList")
+            if not currency_code:
+                raise ValueError("a currency_code must be provided with "
+                                 "receivers")
+
+            data['currencyCode'] = currency_code
+            data['receiverList'] = {'receiver': [
+                {'email': r.email, 'amount': r.amount}
+                for r in receivers.receivers]}
+
+        return data
+
+    @property
+    def refund_info(self):
+        """List of refundInfo of the response, one per receiver"""
+
+        return self.response.get('refundInfoList', {}).get('refundInfo', [])
+
+    @property
+    def refunded(self):
+        """Whether the refund went through for every receiver"""
+
+        return all(info.get('refundStatus') in self.refunded_statuses
+                   for info in self.refund_info)
+
+    @property
+    def refund_has_become_full(self):
+        """Whether every receiver has now been refunded in full"""
+
+        return all(info.get('refundHasBecomeFull') == 'true'
+                   or info.get('refundStatus')
+                   == 'ALREADY_REVERSED_OR_REFUNDED'
+                   for info in self.refund_info)
 
 
 class CancelPreapproval(PaypalAdaptiveEndpoint):
@@ -242,6 +459,12 @@ class PreapprovalDetails(PaypalAdaptiveEndpoint):
 
     url = '%s%s' % (settings.PAYPAL_ENDPOINT, 'PreapprovalDetails')
     error_class = PaypalAdaptiveApiError
+    key_name = 'preapprovalKey'
+    details_cache = (DetailsCache('preapproval')
+                     if settings.USE_DETAILS_CACHE else None)
+    single_flight = (SingleFlight('preapproval')
+                     if settings.USE_SINGLE_FLIGHT else None)
+    retry_policy = RetryPolicy()
 
     def prepare_data(self, preapprovalKey):
         """Prepare data for PreapprovalDetails API call"""
@@ -2,6 +2,22 @@ class PaypalAdaptiveApiError(RuntimeError):
     pass
 
 
+class TransportError(PaypalAdaptiveApiError):
+    pass
+
+
+class RequestTimeout(TransportError):
+    pass
+
+
+class DeadlineExceeded(RequestTimeout):
+    pass
+
+
+class CircuitOpenError(TransportError):
+    pass
+
+
 class PayError(PaypalAdaptiveApiError):
     pass
 
@@ -22,5 +38,10 @@ class IpnError(PaypalAdaptiveApiError):
     pass
 
 
+class IpnUnavailableError(IpnError, TransportError):
+    """Paypal couldn't verify an IPN right now, it can be tried again"""
+    pass
+
+
 class ReceiverError(PaypalAdaptiveApiError):
     pass
\ No newline at end of file
@@ -1,4 +1,14 @@
-import urllib2
+import httplib
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+from paypaladaptive import settings
+
+from deadline import Deadline
+from errors import DeadlineExceeded, RequestTimeout
 
 
 class UrlResponse:
@@ -8,23 +18,191 @@ class UrlResponse:
         self.code = code
 
 
+class ConnectionPool(object):
+    """
+    Keeps persistent HTTP(S) connections to the hosts we talk to so that
+    consecutive calls can skip DNS lookup, TCP connect and TLS handshake.
+
+    Idle connections are kept per (scheme, host, port). At most `maxsize`
+    idle connections are kept per host and connections that have been idle
+    for longer than `idle_timeout` seconds are closed instead of reused.
+    The pool is safe to share between threads; a connection is only ever
+    used by the thread that checked it out.
+
+    """
+
+    connection_classes = {'http': httplib.HTTPConnection,
+                          'https': httplib.HTTPSConnection}
+
+    def __init__(self, maxsize=10, idle_timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def get(self, scheme, host, port=None):
+        """
+        Return a (connection, reused) tuple for the host, reusing an idle
+        connection if a fresh enough one is available.
+
+        """
+
+        self.evict_idle()
+
+        connection = None
+
+        with self._lock:
+            idle = self._idle.get((scheme, host, port))
+            if idle:
+                connection, __ = idle.pop()
+
+        if connection is not None:
+            return connection, True
+
+        return self.connection_classes[scheme](host, port), False
+
+    def put(self, scheme, host, port, connection):
+        """Return a connection to the pool after a completed response"""
+
+        key = (scheme, host, port)
+
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((connection, time.time()))
+                return
+
+        connection.close()
+
+    def evict_idle(self):
+        """Close all connections that have been idle for too long"""
+
+        now = time.time()
+        expired = []
+
+        with self._lock:
+            for key, idle in self._idle.items():
+                fresh = [(c, t) for c, t in idle
+                         if now - t <= self.idle_timeout]
+                expired.extend(c for c, t in idle
+                               if now - t > self.idle_timeout)
+                self._idle[key] = fresh
+
+        for connection in expired:
+            connection.close()
+
+    def clear(self):
+        """Close all idle connections"""
+
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for connection, __ in connections:
+                connection.close()
+
+
+pool = ConnectionPool(maxsize=settings.CONNECTION_POOL_SIZE,
+                      idle_timeout=settings.CONNECTION_IDLE_TIMEOUT)
+
+
 class UrlRequest:
-    def call(self, url, data=None, headers=None):
+    pool = pool
+
+    def call(self, url, data=None, headers=None, deadline=None):
         if headers is None:
             headers = {}
 
-        request = urllib2.Request(url, data=data, headers=headers)
+        deadline = Deadline.coerce(deadline)
 
-        try:
-            response = urllib2.urlopen(request)
+        parsed = urlparse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = '%s?%s' % (path, parsed.query)
+
+        method = 'POST' if data is not None else 'GET'
 
-            self._response = UrlResponse(response.read(), response.info(),
-                                         response.getcode())
-        except urllib2.URLError, e:
-            self._response = UrlResponse(e.reason, {}, None)
+        try:
+            self._response = self._request(parsed.scheme, parsed.hostname,
+                                           parsed.port, method, path, data,
+                                           headers, deadline)
+        except socket.timeout, e:
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded('Deadline exceeded waiting for %s'
+                                       % url)
+            raise RequestTimeout('Timed out waiting for %s: %s' % (url, e))
+        except (httplib.HTTPException, socket.error), e:
+            self._response = UrlResponse(e, {}, None)
 
         return self
 
+    def _request(self, scheme, host, port, method, path, data, headers,
+                 deadline=None):
+        connection, reused = self.pool.get(scheme, host, port)
+        args = (method, path, data, headers, deadline)
+
+        try:
+            self._send_request(connection, *args)
+        except socket.timeout:
+            raise
+        except (httplib.HTTPException, socket.error):
+            # The server may have closed an idle keep-alive connection, in
+            # which case sending the request fails before Paypal sees it and
+            # it's safe to send it once more on a brand new connection.
+            if not reused:
+                raise
+
+            connection = self.pool.connection_classes[scheme](host, port)
+            self._send_request(connection, *args)
+
+        # Paypal may have acted on the request by now, so failures from here
+        # on are left to the endpoint's retry policy.
+        response = self._get_response(connection)
+
+        try:
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(scheme, host, port, connection)
+
+        return UrlResponse(body, response.msg, response.status)
+
+    def _send_request(self, connection, method, path, data, headers,
+                      deadline=None):
+        connect_timeout = settings.CONNECT_TIMEOUT
+        read_timeout = settings.READ_TIMEOUT
+
+        if deadline is not None:
+            connect_timeout = deadline.timeout(connect_timeout)
+
+        try:
+            if connection.sock is None:
+                connection.timeout = connect_timeout
+                connection.connect()
+
+            if deadline is not None:
+                read_timeout = deadline.timeout(read_timeout)
+            connection.sock.settimeout(read_timeout)
+
+            connection.request(method, path, data, headers)
+        except Exception:
+            exc_info = sys.exc_info()
+            connection.close()
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _get_response(self, connection):
+        try:
+            return connection.getresponse()
+        except Exception:
+            exc_info = sys.exc_info()
+            connection.close()
+            raise exc_info[0], exc_info[1], exc_info[2]
+
     @property
     def response(self):
         return self._response.data
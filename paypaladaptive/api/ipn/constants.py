@@ -58,4 +58,8 @@ IPN_PIN_TYPE_NOT_REQUIRED = 'NOT_REQUIRED'
 IPN_PIN_TYPE_REQUIRED = 'REQUIRED'
 
 IPN_TIMEZONES = {'PDT': timezone('US/Pacific'),
-                 'PST': timezone('US/Pacific')}
\ No newline at end of file
+                 'PST': timezone('US/Pacific')}
+
+# UTC offsets in minutes of the timezones Paypal puts in IPN dates
+IPN_TIMEZONE_OFFSETS = {'PDT': -7 * 60,
+                        'PST': -8 * 60}
@@ -0,0 +1,127 @@
+"""
+Parsing of the dates in IPN messages, which Paypal sends in a few fixed
+formats:
+
+    Thu Jun 09 07:23:38 PDT 2011    (payments)
+    2013-07-06T11:34:05.000-07:00   (preapprovals)
+
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from dateutil.parser import parse
+from pytz import FixedOffset, utc
+
+from constants import IPN_TIMEZONES, IPN_TIMEZONE_OFFSETS
+
+
+MONTHS = dict((month, n) for n, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec'), 1))
+
+TIMEZONES = dict((name, FixedOffset(offset))
+                 for name, offset in IPN_TIMEZONE_OFFSETS.iteritems())
+
+ISO_DATE = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)'
+                      r'(?:\.(\d{1,6}))?(Z|[+-]\d\d:?\d\d)$')
+
+
+class LRUCache(object):
+    """A dict of at most maxsize items that drops the least recently used"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+def parse_paypal_date(date_str):
+    """Parse "Thu Jun 09 07:23:38 PDT 2011", or return None"""
+
+    parts = date_str.split()
+    if len(parts) != 6:
+        return None
+
+    weekday, month, day, time, zone, year = parts
+    month = MONTHS.get(month)
+    tz = TIMEZONES.get(zone)
+    time = time.split(':')
+    if month is None or tz is None or len(time) != 3:
+        return None
+
+    try:
+        return datetime(int(year), month, int(day), int(time[0]),
+                        int(time[1]), int(time[2]), tzinfo=tz)
+    except ValueError:
+        return None
+
+
+def parse_iso_date(date_str):
+    """Parse "2013-07-06T11:34:05.000-07:00", or return None"""
+
+    match = ISO_DATE.match(date_str)
+    if match is None:
+        return None
+
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+
+    if zone == 'Z':
+        tz = utc
+    else:
+        sign = -1 if zone[0] == '-' else 1
+        zone = zone[1:].replace(':', '')
+        tz = FixedOffset(sign * (int(zone[:2]) * 60 + int(zone[2:])))
+
+    try:
+        return datetime(int(year), int(month), int(day), int(hour),
+                        int(minute), int(second),
+                        int((fraction or '0').ljust(6, '0')), tzinfo=tz)
+    except ValueError:
+        return None
+
+
+_cache = LRUCache()
+
+
+def parse_date(date_str):
+    """
+    Parse an IPN date to a UTC datetime. The formats Paypal uses are parsed
+    directly, anything else by dateutil. Results are kept in a small LRU
+    cache since the same dates come in many times.
+
+    """
+
+    value = _cache.get(date_str)
+    if value is not None:
+        return value
+
+    value = parse_paypal_date(date_str) or parse_iso_date(date_str)
+    if value is None:
+        value = parse(date_str, tzinfos=IPN_TIMEZONES)
+
+    value = value.astimezone(utc)
+    _cache.set(date_str, value)
+    return value
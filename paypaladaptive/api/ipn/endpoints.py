@@ -1,20 +1,84 @@
 import logging
+import re
 import  urllib
 
 from django.utils import simplejson
 
-from dateutil.parser import parse
 from money.Money import Money, Currency
-from pytz import utc
 
 from constants import *
+from dates import parse_date
 from paypaladaptive import settings
-from paypaladaptive.api.errors import IpnError
+from paypaladaptive.api.errors import IpnError, IpnUnavailableError
+from paypaladaptive.api.deadline import Deadline
+from paypaladaptive.api.endpoints import is_transient
 from paypaladaptive.api.httpwrapper import UrlRequest
+from paypaladaptive.api.retry import RetryPolicy
 
 
 logger = logging.getLogger(__name__)
 
+# transaction[n].attribute
+TRANSACTION_KEY = re.compile(r'^transaction\[(\d+)\]\.(.+)$')
+
+
+class Field(object):
+    """
+    An IPN field that is decoded from the POST data when it's first read
+    and kept in the IPN's `_<name>` slot. Fields that aren't part of the
+    IPN's type are `default` without being decoded.
+
+    """
+
+    def __init__(self, name, convert=None, *args, **kwargs):
+        self.name = name
+        self.slot = '_%s' % name
+        self.convert = convert
+        self.args = args
+        self.default = kwargs.get('default', None)
+
+    def decode(self, ipn):
+        value = ipn._post.get(self.name, None)
+        if self.convert is None:
+            return value
+        convert = self.convert
+        if isinstance(convert, basestring):
+            convert = getattr(ipn, convert)
+        return convert(value, *self.args)
+
+    def __get__(self, ipn, owner):
+        if ipn is None:
+            return self
+
+        try:
+            return getattr(ipn, self.slot)
+        except AttributeError:
+            pass
+
+        if self.name not in ipn.FIELDS[ipn.type]:
+            return self.default
+
+        try:
+            value = self.decode(ipn)
+        except Exception:
+            logger.error('Could not parse IPN field %s' % self.name)
+            raise
+
+        setattr(ipn, self.slot, value)
+        return value
+
+
+class AmountField(Field):
+    """An amount that has its currency in another field"""
+
+    def __init__(self, name, currency_field):
+        super(AmountField, self).__init__(name)
+        self.currency_field = currency_field
+
+    def decode(self, ipn):
+        return Money(ipn._post.get(self.name, None),
+                     ipn._post.get(self.currency_field, None))
+
 
 class IPN(object):
     """
@@ -25,7 +89,73 @@ class IPN(object):
 
     """
 
+    verify_retry_policy = RetryPolicy()
+
+    # payments and adjustments define these
+    sender_email = Field('sender_email')
+    payment_request_date = Field('payment_request_date', 'process_date')
+    reverse_all_parallel_payments_on_error = Field(
+        'reverse_all_parallel_payments_on_error', 'process_bool',
+        default=False)
+    return_url = Field('return_url')
+    cancel_url = Field('cancel_url')
+    ipn_notification_url = Field('ipn_notification_url')
+    pay_key = Field('pay_key')
+    memo = Field('memo')
+    fees_payer = Field('fees_payer')
+    trackingId = Field('trackingId')
+    preapproval_key = Field('preapproval_key')
+    reason_code = Field('reason_code')
+
+    # preapprovals define these
+    approved = Field('approved', 'process_bool', default=False)
+    current_number_of_payments = Field('current_number_of_payments',
+                                       'process_int')
+    current_total_amount_of_all_payments = Field(
+        'current_total_amount_of_all_payments', 'process_money')
+    current_period_attempts = Field('current_period_attempts', 'process_int')
+    currency_code = Field('currency_code', Currency)
+    date_of_month = Field('date_of_month', 'process_int')
+    day_of_week = Field('day_of_week', 'process_int', None)
+    starting_date = Field('starting_date', 'process_date')
+    ending_date = Field('ending_date', 'process_date')
+    max_total_amount_of_all_payments = AmountField(
+        'max_total_amount_of_all_payments', 'currency_code')
+    max_amount_per_payment = Field('max_amount_per_payment', 'process_money')
+    max_number_of_payments = Field('max_number_of_payments', 'process_int')
+    payment_period = Field('payment_period')
+    pin_type = Field('pin_type')
+
+    PAYMENT_FIELDS = frozenset([
+        'sender_email', 'payment_request_date',
+        'reverse_all_parallel_payments_on_error', 'return_url', 'cancel_url',
+        'ipn_notification_url', 'pay_key', 'memo', 'fees_payer', 'trackingId',
+        'preapproval_key', 'reason_code'])
+
+    PREAPPROVAL_FIELDS = frozenset([
+        'sender_email', 'return_url', 'cancel_url', 'ipn_notification_url',
+        'memo', 'preapproval_key', 'approved', 'current_number_of_payments',
+        'current_total_amount_of_all_payments', 'current_period_attempts',
+        'currency_code', 'date_of_month', 'day_of_week', 'starting_date',
+        'ending_date', 'max_total_amount_of_all_payments',
+        'max_amount_per_payment', 'max_number_of_payments', 'payment_period',
+        'pin_type'])
+
+    FIELDS = {IPN_TYPE_PAYMENT: PAYMENT_FIELDS,
+              IPN_TYPE_ADJUSTMENT: PAYMENT_FIELDS,
+              IPN_TYPE_PREAPPROVAL: PREAPPROVAL_FIELDS}
+
+    # a slot per field holds its decoded value, unset until it's read
+    __slots__ = (('type', 'status', 'action_type', 'transactions', 'attempts',
+                  '_post')
+                 + tuple(sorted('_%s' % name for name
+                                in PAYMENT_FIELDS | PREAPPROVAL_FIELDS)))
+
     class Transaction(object):
+        __slots__ = ('id', 'status', 'id_for_sender', 'status_for_sender_txn',
+                     'refund_id', 'refund_amount', 'refund_account_charged',
+                     'receiver', 'invoiceId', 'amount', 'is_primary_receiver')
+
         def __init__(self, **kwargs):
             self.id = kwargs.get('id', None)
             self.status = kwargs.get('status', None)
@@ -55,16 +185,24 @@ class IPN(object):
             d = dict((str(k.replace(s, '', 1)), v) for k,v in d.iteritems() if k.startswith(s))
             return d
 
-    def __init__(self, request):
+    def __init__(self, request, deadline=None):
         # verify that the request is paypal's
         url = '%s?cmd=_notify-validate' % settings.PAYPAL_PAYMENT_HOST
         post_data = {}
         for k, v in request.POST.copy().iteritems():
             post_data[k] = unicode(v).encode('utf-8')
         data = urllib.urlencode(post_data)
-        verify_request = UrlRequest().call(url, data=data)
+        deadline = Deadline.coerce(deadline)
+        self.attempts = []
+        verify_request = self.verify_retry_policy.run(
+            lambda: UrlRequest().call(url, data=data, deadline=deadline),
+            deadline=deadline, retry_result=is_transient,
+            attempts=self.attempts)
 
         # check code
+        if is_transient(verify_request):
+            raise IpnUnavailableError('PayPal response code was %s'
+                                      % verify_request.code)
         if verify_request.code != 200:
             raise IpnError('PayPal response code was %s' % verify_request.code)
 
@@ -85,42 +223,10 @@ class IPN(object):
         
         self.process_transactions(request)
 
-        try:
-            # payments and adjustments define these
-            self.status = request.POST.get('status', None)
-            self.sender_email = request.POST.get('sender_email', None)
-            self.action_type = request.POST.get('action_type', None)
-            self.payment_request_date = IPN.process_date(request.POST.get('payment_request_date', None))
-            self.reverse_all_parallel_payments_on_error = request.POST.get('reverse_all_parallel_payments_on_error', 'false') == 'true'
-            self.return_url = request.POST.get('return_url', None)
-            self.cancel_url = request.POST.get('cancel_url', None)
-            self.ipn_notification_url = request.POST.get('ipn_notification_url', None)
-            self.pay_key = request.POST.get('pay_key', None)
-            self.memo = request.POST.get('memo', None)
-            self.fees_payer = request.POST.get('fees_payer', None) 
-            self.trackingId = request.POST.get('trackingId', None)
-            self.preapproval_key = request.POST.get('preapproval_key', None)
-            self.reason_code = request.POST.get('reason_code', None)
-
-            # preapprovals define these
-            self.approved = request.POST.get('approved', 'false') == 'true'            
-            self.current_number_of_payments = IPN.process_int(request.POST.get('current_number_of_payments', None))
-            self.current_total_amount_of_all_payments = IPN.process_money(request.POST.get('current_total_amount_of_all_payments', None))
-            self.current_period_attempts = IPN.process_int(request.POST.get('current_period_attempts', None))
-            self.currency_code = Currency(request.POST.get('currency_code', None))
-            self.date_of_month = IPN.process_int(request.POST.get('date_of_month', None))
-            self.day_of_week = IPN.process_int(request.POST.get('day_of_week', None), None)
-            self.starting_date = IPN.process_date(request.POST.get('starting_date', None))
-            self.ending_date = IPN.process_date(request.POST.get('ending_date', None))
-            self.max_total_amount_of_all_payments = Money(request.POST.get('max_total_amount_of_all_payments', None),
-                                                          request.POST.get('currency_code', None))
-            self.max_amount_per_payment = IPN.process_money(request.POST.get('max_amount_per_payment', None))
-            self.max_number_of_payments = IPN.process_int(request.POST.get('max_number_of_payments', None))
-            self.payment_period = request.POST.get('payment_period', None)
-            self.pin_type = request.POST.get('pin_type', None)
-        except Exception, e:
-            logger.error('Could not parse request')
-            raise e
+        # the other fields are decoded when they're first read
+        self._post = request.POST
+        self.status = request.POST.get('status', None)
+        self.action_type = request.POST.get('action_type', None)
         
         # Verify enumerations
         allowed_statuses = [IPN_STATUS_CREATED,
@@ -161,6 +267,10 @@ class IPN(object):
         
         return val
     
+    @classmethod
+    def process_bool(cls, bool_str):
+        return bool_str == 'true'
+
     @classmethod
     def process_money(cls, money_str):
         """
@@ -187,22 +297,25 @@ class IPN(object):
 
         if not date_str:
             return None
-        
-        return parse(date_str, tzinfos=IPN_TIMEZONES).astimezone(utc)
+
+        return parse_date(date_str)
     
     def process_transactions(self, request):
         """
-        Paypal sends transactions in the form transaction[n].[attribute], where
-        n is 0 - 5 inclusive. We'll attempt to pull POST dictionary keys
-        matching each transaction and build an IPN. Transaction object from
-        them.
+        Paypal sends transactions in the form transaction[n].[attribute], one
+        for every receiver. The POST items are walked once, grouping the
+        attributes by n, and an IPN.Transaction is built for each n in order.
 
         """
 
-        self.transactions = []
+        transactions = {}
+        match = TRANSACTION_KEY.match
+
+        for key, value in request.POST.iteritems():
+            m = match(key)
+            if m is not None:
+                num, attribute = m.groups()
+                transactions.setdefault(int(num), {})[str(attribute)] = value
 
-        transaction_nums = range(6)
-        for transaction_num in transaction_nums:
-            transdict = IPN.Transaction.slicedict(request.POST, 'transaction[%s].' % transaction_num)
-            if len(transdict) > 0:
-                self.transactions.append(IPN.Transaction(**transdict))
\ No newline at end of file
+        self.transactions = [IPN.Transaction(**transactions[num])
+                             for num in sorted(transactions)]
\ No newline at end of file
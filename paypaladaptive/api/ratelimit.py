@@ -0,0 +1,54 @@
+"""Rate limiting of calls to Paypal"""
+
+import threading
+import time
+
+from errors import DeadlineExceeded
+
+
+class RateLimiter(object):
+    """
+    Token bucket that lets at most `rate` calls per second through on
+    average, and bursts of up to `burst` calls. Shared by the threads of a
+    bulk operation, each of which calls `acquire()` before calling Paypal.
+
+    """
+
+    sleep = staticmethod(time.sleep)
+    clock = staticmethod(time.time)
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated_at = self.clock()
+
+    def _take(self):
+        """Take a token, or return the seconds until one is available"""
+
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens
+                               + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, deadline=None):
+        """Wait until a call may be made"""
+
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            if deadline is not None and deadline.remaining() < wait:
+                raise DeadlineExceeded('Deadline exceeded waiting for the '
+                                       'rate limit')
+            self.sleep(wait)
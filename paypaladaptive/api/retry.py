@@ -0,0 +1,118 @@
+"""Retrying of failed calls to Paypal"""
+
+import logging
+import random
+import time
+
+from paypaladaptive import metrics, settings
+
+from errors import CircuitOpenError, DeadlineExceeded, TransportError
+
+logger = logging.getLogger(__name__)
+
+
+class Attempt(object):
+    """Record of a single try of a call"""
+
+    def __init__(self, number, duration, error=None, backoff=0):
+        self.number = number
+        self.duration = duration
+        self.error = error
+        self.backoff = backoff
+
+    def __repr__(self):
+        return '<Attempt %s: %.3fs error=%r backoff=%.3fs>' % (
+            self.number, self.duration, self.error, self.backoff)
+
+
+class RetryPolicy(object):
+    """
+    Retries a call with exponential backoff and jitter.
+
+    A call is retried when it raises one of `retry_on` (except
+    DeadlineExceeded and CircuitOpenError) or when its result matches
+    `retry_result`. The n:th retry waits `backoff * 2 ** (n - 1)` seconds,
+    capped at `max_backoff` and reduced by up to `jitter` of itself at
+    random so that clients that failed together don't retry together. No
+    retry is made that would not fit within the deadline.
+
+    """
+
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, max_attempts=None, backoff=None, max_backoff=None,
+                 jitter=None, retry_on=(TransportError,)):
+        self.max_attempts = (settings.RETRY_MAX_ATTEMPTS
+                             if max_attempts is None else max_attempts)
+        self.backoff = settings.RETRY_BACKOFF if backoff is None else backoff
+        self.max_backoff = (settings.RETRY_MAX_BACKOFF
+                            if max_backoff is None else max_backoff)
+        self.jitter = settings.RETRY_JITTER if jitter is None else jitter
+        self.retry_on = retry_on
+
+    def get_backoff(self, retry):
+        delay = min(self.backoff * 2 ** (retry - 1), self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+    def run(self, function, deadline=None, retry_result=None, attempts=None):
+        """
+        Call function until it succeeds, the attempts run out or the
+        deadline would be exceeded. Each try is appended to attempts as an
+        Attempt, if given.
+
+        """
+
+        if attempts is None:
+            attempts = []
+
+        number = 0
+
+        while True:
+            number += 1
+            started = time.time()
+            error = None
+            result = None
+
+            try:
+                result = function()
+            except (DeadlineExceeded, CircuitOpenError):
+                raise
+            except self.retry_on, e:
+                error = e
+                if number >= self.max_attempts:
+                    self._record(attempts, number, started, error)
+                    raise
+            else:
+                retryable = retry_result is not None and retry_result(result)
+                if not retryable or number >= self.max_attempts:
+                    self._record(attempts, number, started)
+                    return result
+                error = result
+
+            backoff = self.get_backoff(number)
+
+            if deadline is not None and deadline.remaining() <= backoff:
+                self._record(attempts, number, started, error)
+                if isinstance(error, Exception):
+                    raise error
+                return result
+
+            self._record(attempts, number, started, error, backoff)
+            logger.info('Retrying in %.3fs after attempt %s failed: %r'
+                        % (backoff, number, error))
+            self.sleep(backoff)
+
+    def _record(self, attempts, number, started, error=None, backoff=0):
+        attempt = Attempt(number, time.time() - started, error, backoff)
+        attempts.append(attempt)
+
+        if number > 1:
+            metrics.incr('api.retry.attempts')
+            metrics.incr('api.retry.seconds', attempt.duration)
+        if backoff:
+            metrics.incr('api.retry.seconds', backoff)
+
+        return attempt
+
+
+NO_RETRY = RetryPolicy(max_attempts=1)
@@ -0,0 +1,140 @@
+"""Coalescing of concurrent identical calls to Paypal"""
+
+import logging
+import sys
+import threading
+import time
+import uuid
+
+from django.core.cache import get_cache
+
+from paypaladaptive import metrics, settings
+
+from errors import DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+
+class _Call(object):
+    """A call in flight in this process"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """
+    Lets concurrent callers asking for the same key share a single call.
+
+    The first caller of `do()` for a key makes the call; callers arriving
+    while it is in flight wait for it and get the same result, or the same
+    exception. Nothing is remembered once the call has finished.
+
+    Within a process this is always done. When `cache_alias` is set the
+    first caller also takes a lock in that cache, so callers in other
+    processes wait for the result as well instead of calling Paypal. If the
+    lock holder fails or dies they make the call themselves.
+
+    """
+
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, name, cache_alias=None, lock_timeout=None,
+                 poll_interval=None):
+        self.name = name
+        self.cache_alias = (settings.SINGLE_FLIGHT_CACHE
+                            if cache_alias is None else cache_alias)
+        self.lock_timeout = (settings.SINGLE_FLIGHT_LOCK_TIMEOUT
+                             if lock_timeout is None else lock_timeout)
+        self.poll_interval = (settings.SINGLE_FLIGHT_POLL_INTERVAL
+                              if poll_interval is None else poll_interval)
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.cache_alias)
+        return self._cache
+
+    def _key(self, key, suffix):
+        return 'paypaladaptive:flight:%s:%s:%s' % (self.name, key, suffix)
+
+    def do(self, key, function, deadline=None):
+        """Return function(), sharing the call with concurrent callers"""
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            return self._wait(call, deadline)
+
+        try:
+            call.result = self._run(key, function, deadline)
+            return call.result
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def _wait(self, call, deadline):
+        timeout = deadline.remaining() if deadline is not None else None
+
+        if not call.event.wait(timeout):
+            raise DeadlineExceeded('Deadline exceeded waiting for a shared '
+                                   'call to Paypal')
+
+        metrics.incr('api.single_flight.shared')
+
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+    def _run(self, key, function, deadline):
+        if not self.cache_alias:
+            return function()
+
+        cache = self.cache
+        lock_key = self._key(key, 'lock')
+        result_key = self._key(key, 'result')
+        token = uuid.uuid4().hex
+
+        if cache.add(lock_key, token, self.lock_timeout):
+            try:
+                result = function()
+                cache.set(result_key, (token, result), self.lock_timeout)
+                return result
+            finally:
+                if cache.get(lock_key) == token:
+                    cache.delete(lock_key)
+
+        # Another process is making the call, wait for the result it stores
+        # under its token. The result is stored before the lock is released.
+        owner = cache.get(lock_key)
+
+        while owner is not None:
+            current = cache.get(lock_key)
+            stored = cache.get(result_key)
+
+            if stored is not None and stored[0] == owner:
+                metrics.incr('api.single_flight.shared')
+                return stored[1]
+            if current != owner:
+                break
+            if deadline is not None and deadline.remaining() <= 0:
+                raise DeadlineExceeded('Deadline exceeded waiting for a '
+                                       'shared call to Paypal')
+            self.sleep(self.poll_interval)
+
+        logger.info('Shared call for %s %s gave no result, calling Paypal'
+                    % (self.name, key))
+        return function()
@@ -0,0 +1,70 @@
+"""
+Capturing of requests to and responses from Paypal for the audit log.
+
+Payloads are redacted and compressed before they are stored in an
+AuditRecord. Failed calls are always captured, successful ones only for a
+sample of `PAYPAL_AUDIT_SAMPLE_RATE` of them.
+
+"""
+
+import base64
+import random
+import zlib
+
+from django.utils import simplejson as json
+
+import settings
+
+REDACTED = '[redacted]'
+
+
+def redact(value, fields=None):
+    """Replace the values of credential fields anywhere in value"""
+
+    if fields is None:
+        fields = settings.AUDIT_REDACTED_FIELDS
+    fields = set(field.lower() for field in fields)
+
+    def _redact(value):
+        if isinstance(value, dict):
+            return dict((k, REDACTED if k.lower() in fields else _redact(v))
+                        for k, v in value.iteritems())
+        elif isinstance(value, (list, tuple)):
+            return [_redact(v) for v in value]
+        return value
+
+    return _redact(value)
+
+
+def redact_json(raw):
+    """Redact a JSON document, returned as is if it can't be parsed"""
+
+    if not raw:
+        return raw
+
+    try:
+        return json.dumps(redact(json.loads(raw)))
+    except ValueError:
+        return raw
+
+
+def compress(text):
+    if text is None:
+        return None
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return base64.b64encode(zlib.compress(text))
+
+
+def decompress(data):
+    if data is None:
+        return None
+    return zlib.decompress(base64.b64decode(data)).decode('utf-8')
+
+
+def should_capture(failed, sample_rate=None):
+    if failed:
+        return True
+    if sample_rate is None:
+        sample_rate = settings.AUDIT_SAMPLE_RATE
+    return random.random() < sample_rate
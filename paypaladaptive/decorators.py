@@ -1,16 +1,32 @@
 import logging
 
-from django.http import HttpResponseBadRequest
+from django.http import HttpResponseBadRequest, HttpResponse, Http404
 
+import settings
 from api.ipn import IPN
-from api import IpnError
+from api import IpnError, TransportError
+from processing import precheck, NOT_FOUND
 
 logger = logging.getLogger(__name__)
 
 def takes_ipn(function):
     def _view(request, *args, **kwargs):
+        if 'object_id' in kwargs and 'object_secret_uuid' in kwargs:
+            # junk isn't worth a call to Paypal
+            reason = precheck(request.POST, kwargs['object_id'],
+                              kwargs['object_secret_uuid'])
+            if reason == NOT_FOUND:
+                raise Http404
+            if reason is not None:
+                return HttpResponseBadRequest(reason.replace('_', ' '))
+
         try:
-            kwargs['ipn'] = IPN(request)
+            kwargs['ipn'] = IPN(request,
+                                deadline=settings.IPN_VERIFY_DEADLINE)
+        except TransportError, e:
+            # also when Paypal answered with a 5xx, so that it retries
+            logger.warning("PayPal IPN verify call failed: %s" % e)
+            return HttpResponse('verify unavailable', status=503)
         except IpnError, e:
             logger.warning("PayPal IPN verify failed: %s" % e)
             logger.debug("Request was: %s" % request)
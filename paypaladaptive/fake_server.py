@@ -0,0 +1,590 @@
+"""
+Local stand-in for the Paypal Adaptive Payments API, for load and
+integration testing without the sandbox.
+
+It answers the Pay, PaymentDetails, Refund, Preapproval, PreapprovalDetails
+and CancelPreapproval operations from in-memory state, lets a user "approve"
+payments and preapprovals through the webscr URLs that `next_url()` points
+to, POSTs IPN messages back to the application and verifies them again on
+`_notify-validate`. Latency and server errors can be added to every call.
+
+Run it with::
+
+    $ python -m paypaladaptive.fake_server --port 8009 --latency 0.2
+
+and point the application at it::
+
+    PAYPAL_ENDPOINT = 'http://localhost:8009/AdaptivePayments/'
+    PAYPAL_PAYMENT_HOST = 'http://localhost:8009/webscr'
+
+The module doesn't depend on Django, so it can run outside of the project.
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = '/AdaptivePayments/'
+PAYMENT_PATH = '/webscr'
+
+# Paypal reports dates in US Pacific time
+DATE_FORMAT = '%a %b %d %H:%M:%S PDT %Y'
+
+
+def paypal_date(value=None):
+    if value is None:
+        return time.strftime(DATE_FORMAT, time.gmtime(time.time() - 7 * 3600))
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').strftime(
+        DATE_FORMAT)
+
+
+def money(currency, amount):
+    return '%s %.2f' % (currency, float(amount))
+
+
+class FakePaypal(object):
+    """
+    In-memory Paypal account. All operations are safe to call from several
+    threads.
+
+    `latency` seconds, plus up to `latency_jitter` more at random, are spent
+    on every API and verification call, and `error_rate` of them fail with
+    HTTP 500. With `auto_approve` payments and preapprovals are approved as
+    soon as they are created, skipping the webscr step. IPN messages are
+    sent `ipn_delay` seconds after the change they report.
+
+    """
+
+    def __init__(self, latency=0, latency_jitter=0, error_rate=0,
+                 auto_approve=False, ipn_delay=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.auto_approve = auto_approve
+        self.ipn_delay = ipn_delay
+
+        self.lock = threading.RLock()
+        self.counter = itertools.count(1)
+        self.payments = {}
+        self.preapprovals = {}
+        self.sent_ipns = set()
+        self.ipn_log = []
+
+    def simulate_network(self):
+        """Sleep and return True if the call should fail"""
+
+        delay = self.latency + self.latency_jitter * random.random()
+        if delay:
+            time.sleep(delay)
+        return random.random() < self.error_rate
+
+    def _next_id(self, prefix):
+        return '%s-FAKE%012d' % (prefix, self.counter.next())
+
+    # Adaptive Payments operations, each takes and returns a JSON dict
+
+    def call(self, operation, data):
+        method = getattr(self, 'op_%s' % operation, None)
+        if method is None:
+            return self.failure('Unknown operation %s' % operation, '500000')
+
+        with self.lock:
+            return method(data)
+
+    def success(self, **kwargs):
+        kwargs['responseEnvelope'] = {'ack': 'Success',
+                                      'timestamp': paypal_date(),
+                                      'build': 'fake'}
+        return kwargs
+
+    def failure(self, message, error_id='580001'):
+        return {'responseEnvelope': {'ack': 'Failure',
+                                     'timestamp': paypal_date(),
+                                     'build': 'fake'},
+                'error': [{'errorId': error_id, 'message': message,
+                           'severity': 'Error'}]}
+
+    def find_payment(self, data):
+        if data.get('payKey'):
+            return self.payments.get(data['payKey'])
+        for payment in self.payments.itervalues():
+            if (data.get('trackingId')
+                    and payment['trackingId'] == data['trackingId']):
+                return payment
+        return None
+
+    def op_Pay(self, data):
+        receivers = data.get('receiverList', {}).get('receiver', [])
+        if not receivers:
+            return self.failure('Receiver list is empty', '580022')
+
+        tracking_id = data.get('trackingId')
+        if tracking_id and self.find_payment({'trackingId': tracking_id}):
+            return self.failure('The trackingId is already in use', '579040')
+
+        preapproval = None
+        if data.get('preapprovalKey'):
+            preapproval = self.preapprovals.get(data['preapprovalKey'])
+            if (preapproval is None or preapproval['status'] != 'ACTIVE'
+                    or not preapproval['approved']):
+                return self.failure('The preapproval key is not valid',
+                                    '569013')
+            if preapproval['curPayments'] >= preapproval['maxNumberOfPayments']:
+                return self.failure('The preapproval has been used up',
+                                    '569017')
+
+        pay_key = self._next_id('AP')
+        payment = {
+            'payKey': pay_key,
+            'status': 'CREATED',
+            'actionType': data.get('actionType', 'PAY'),
+            'currencyCode': data.get('currencyCode'),
+            'returnUrl': data.get('returnUrl'),
+            'cancelUrl': data.get('cancelUrl'),
+            'ipnNotificationUrl': data.get('ipnNotificationUrl'),
+            'trackingId': tracking_id,
+            'preapprovalKey': data.get('preapprovalKey'),
+            'senderEmail': data.get('senderEmail', 'buyer@example.com'),
+            'receivers': [dict(receiver, transactionId=None,
+                               transactionStatus=None, refunded=0)
+                          for receiver in receivers],
+        }
+        self.payments[pay_key] = payment
+
+        if preapproval is not None or self.auto_approve:
+            self.complete_payment(payment)
+
+        return self.success(payKey=pay_key,
+                            paymentExecStatus=payment['status'])
+
+    def op_PaymentDetails(self, data):
+        payment = self.find_payment(data)
+        if payment is None:
+            return self.failure('The payment request is invalid', '580022')
+
+        payment_info = [{
+            'receiver': {'amount': '%.2f' % float(r['amount']),
+                         'email': r['email'],
+                         'primary': str(bool(r.get('primary'))).lower()},
+            'transactionId': r['transactionId'],
+            'transactionStatus': r['transactionStatus'],
+            'senderTransactionStatus': r['transactionStatus'],
+            'refundedAmount': '%.2f' % r['refunded'],
+        } for r in payment['receivers']]
+
+        fields = dict((key, payment[key]) for key in (
+            'payKey', 'status', 'actionType', 'currencyCode', 'returnUrl',
+            'cancelUrl', 'ipnNotificationUrl', 'trackingId', 'preapprovalKey',
+            'senderEmail') if payment[key] is not None)
+
+        return self.success(paymentInfoList={'paymentInfo': payment_info},
+                            **fields)
+
+    def op_Refund(self, data):
+        payment = self.find_payment(data)
+        if payment is None:
+            return self.failure('The payment request is invalid', '580022')
+
+        wanted = dict((r['email'], float(r['amount']))
+                      for r in data.get('receiverList', {}).get('receiver', []))
+        refund_info = []
+
+        for receiver in payment['receivers']:
+            if wanted and receiver['email'] not in wanted:
+                continue
+
+            amount = wanted.get(receiver['email'],
+                                float(receiver['amount']) - receiver['refunded'])
+
+            if payment['status'] != 'COMPLETED':
+                refund_status = 'NOT_PAID'
+            elif receiver['refunded'] + amount > float(receiver['amount']):
+                refund_status = 'REFUND_NOT_ALLOWED'
+            else:
+                receiver['refunded'] += amount
+                fully = receiver['refunded'] >= float(receiver['amount'])
+                receiver['transactionStatus'] = ('REFUNDED' if fully
+                                                 else 'PARTIALLY_REFUNDED')
+                refund_status = 'REFUNDED' if fully else 'PARTIALLY_REFUNDED'
+
+            refund_info.append({
+                'receiver': {'amount': '%.2f' % float(receiver['amount']),
+                             'email': receiver['email']},
+                'refundStatus': refund_status,
+                'refundNetAmount': '%.2f' % amount,
+                'refundGrossAmount': '%.2f' % amount,
+                'refundFeeAmount': '0.00',
+                'refundHasBecomeFull': str(
+                    receiver['refunded'] >= float(receiver['amount'])).lower(),
+                'encryptedRefundTransactionId': self._next_id('RT'),
+            })
+
+        return self.success(currencyCode=payment['currencyCode'],
+                            refundInfoList={'refundInfo': refund_info})
+
+    def op_Preapproval(self, data):
+        key = self._next_id('PA')
+        preapproval = {
+            'preapprovalKey': key,
+            'status': 'ACTIVE',
+            'approved': False,
+            'currencyCode': data.get('currencyCode'),
+            'returnUrl': data.get('returnUrl'),
+            'cancelUrl': data.get('cancelUrl'),
+            'ipnNotificationUrl': data.get('ipnNotificationUrl'),
+            'startingDate': data.get('startingDate'),
+            'endingDate': data.get('endingDate'),
+            'maxNumberOfPayments': int(data.get('maxNumberOfPayments', 1)),
+            'maxTotalAmountOfAllPayments': float(
+                data.get('maxTotalAmountOfAllPayments', 0)),
+            'pinType': data.get('pinType', 'NOT_REQUIRED'),
+            'curPayments': 0,
+            'curPaymentsAmount': 0.0,
+        }
+        self.preapprovals[key] = preapproval
+
+        if self.auto_approve:
+            self.approve_preapproval(key)
+
+        return self.success(preapprovalKey=key)
+
+    def op_PreapprovalDetails(self, data):
+        preapproval = self.preapprovals.get(data.get('preapprovalKey'))
+        if preapproval is None:
+            return self.failure('The preapproval key is not valid', '569013')
+
+        return self.success(
+            approved=str(preapproval['approved']).lower(),
+            status=preapproval['status'],
+            currencyCode=preapproval['currencyCode'],
+            curPayments=str(preapproval['curPayments']),
+            curPaymentsAmount='%.2f' % preapproval['curPaymentsAmount'],
+            maxNumberOfPayments=str(preapproval['maxNumberOfPayments']),
+            maxTotalAmountOfAllPayments=(
+                '%.2f' % preapproval['maxTotalAmountOfAllPayments']),
+            startingDate=preapproval['startingDate'],
+            endingDate=preapproval['endingDate'],
+            pinType=preapproval['pinType'],
+            returnUrl=preapproval['returnUrl'],
+            cancelUrl=preapproval['cancelUrl'])
+
+    def op_CancelPreapproval(self, data):
+        preapproval = self.preapprovals.get(data.get('preapprovalKey'))
+        if preapproval is None:
+            return self.failure('The preapproval key is not valid', '569013')
+
+        preapproval['status'] = 'CANCELED'
+        self.send_preapproval_ipn(preapproval)
+        return self.success()
+
+    # State changes made by the buyer
+
+    def total(self, payment):
+        """Amount paid by the sender, all of it goes to a primary receiver"""
+
+        amounts = [float(r['amount']) for r in payment['receivers']
+                   if r.get('primary')]
+        return sum(amounts or [float(r['amount'])
+                               for r in payment['receivers']])
+
+    def complete_payment(self, payment):
+        payment['status'] = 'COMPLETED'
+        for receiver in payment['receivers']:
+            receiver['transactionId'] = self._next_id('TX')
+            receiver['transactionStatus'] = 'COMPLETED'
+
+        preapproval = self.preapprovals.get(payment['preapprovalKey'])
+        if preapproval is not None:
+            preapproval['curPayments'] += 1
+            preapproval['curPaymentsAmount'] += self.total(payment)
+
+        self.send_payment_ipn(payment)
+
+    def approve_payment(self, pay_key):
+        """Complete the payment, returns the URL to send the buyer to"""
+
+        with self.lock:
+            payment = self.payments.get(pay_key)
+            if payment is None:
+                return None
+            if payment['status'] == 'CREATED':
+                self.complete_payment(payment)
+            return payment['returnUrl']
+
+    def approve_preapproval(self, key):
+        """Approve the preapproval, returns the URL to send the buyer to"""
+
+        with self.lock:
+            preapproval = self.preapprovals.get(key)
+            if preapproval is None:
+                return None
+            if not preapproval['approved']:
+                preapproval['approved'] = True
+                self.send_preapproval_ipn(preapproval)
+            return preapproval['returnUrl']
+
+    def cancel_url(self, key):
+        with self.lock:
+            obj = self.payments.get(key) or self.preapprovals.get(key)
+            return obj['cancelUrl'] if obj is not None else None
+
+    # IPN
+
+    def send_payment_ipn(self, payment):
+        fields = {
+            'transaction_type': 'Adaptive Payment PAY',
+            'status': payment['status'],
+            'action_type': payment['actionType'],
+            'pay_key': payment['payKey'],
+            'sender_email': payment['senderEmail'],
+            'payment_request_date': paypal_date(),
+            'return_url': payment['returnUrl'],
+            'cancel_url': payment['cancelUrl'],
+            'ipn_notification_url': payment['ipnNotificationUrl'],
+            'fees_payer': 'EACHRECEIVER',
+            'reverse_all_parallel_payments_on_error': 'false',
+            'charset': 'windows-1252',
+            'notify_version': 'UNVERSIONED',
+            'test_ipn': '1',
+        }
+        if payment['trackingId']:
+            fields['trackingId'] = payment['trackingId']
+        if payment['preapprovalKey']:
+            fields['preapproval_key'] = payment['preapprovalKey']
+
+        for n, receiver in enumerate(payment['receivers']):
+            prefix = 'transaction[%s].' % n
+            fields.update({
+                prefix + 'id': receiver['transactionId'],
+                prefix + 'id_for_sender_txn': receiver['transactionId'],
+                prefix + 'status': 'Completed',
+                prefix + 'status_for_sender_txn': 'Completed',
+                prefix + 'amount': money(payment['currencyCode'],
+                                         receiver['amount']),
+                prefix + 'receiver': receiver['email'],
+                prefix + 'is_primary_receiver': str(
+                    bool(receiver.get('primary'))).lower(),
+            })
+
+        self.send_ipn(payment['ipnNotificationUrl'], fields)
+
+    def send_preapproval_ipn(self, preapproval):
+        fields = {
+            'transaction_type': 'Adaptive Payment PREAPPROVAL',
+            'status': preapproval['status'],
+            'approved': str(preapproval['approved']).lower(),
+            'preapproval_key': preapproval['preapprovalKey'],
+            'sender_email': 'buyer@example.com',
+            'currency_code': preapproval['currencyCode'],
+            'max_total_amount_of_all_payments': (
+                '%.2f' % preapproval['maxTotalAmountOfAllPayments']),
+            'max_number_of_payments': str(preapproval['maxNumberOfPayments']),
+            'current_number_of_payments': str(preapproval['curPayments']),
+            'current_total_amount_of_all_payments': money(
+                preapproval['currencyCode'], preapproval['curPaymentsAmount']),
+            'current_period_attempts': '0',
+            'date_of_month': '0',
+            'day_of_week': 'NO_DAY_SPECIFIED',
+            'payment_period': '0',
+            'pin_type': preapproval['pinType'],
+            'return_url': preapproval['returnUrl'],
+            'cancel_url': preapproval['cancelUrl'],
+            'ipn_notification_url': preapproval['ipnNotificationUrl'],
+            'charset': 'windows-1252',
+            'notify_version': 'UNVERSIONED',
+            'test_ipn': '1',
+        }
+        for field, key in (('starting_date', 'startingDate'),
+                           ('ending_date', 'endingDate')):
+            if preapproval[key]:
+                fields[field] = paypal_date(preapproval[key])
+
+        self.send_ipn(preapproval['ipnNotificationUrl'], fields)
+
+    def send_ipn(self, url, fields):
+        if not url:
+            return
+
+        fields = dict((k, v) for k, v in fields.iteritems() if v is not None)
+        self.sent_ipns.add(frozenset(fields.iteritems()))
+
+        timer = threading.Timer(self.ipn_delay, self.post_ipn, (url, fields))
+        timer.daemon = True
+        timer.start()
+
+    def post_ipn(self, url, fields):
+        try:
+            response = urllib2.urlopen(url, urllib.urlencode(fields),
+                                       timeout=30)
+            code = response.getcode()
+        except urllib2.HTTPError, e:
+            code = e.code
+        except Exception, e:
+            logger.warning('Could not send IPN to %s: %s' % (url, e))
+            code = None
+
+        with self.lock:
+            self.ipn_log.append((url, fields, code))
+
+    def verify_ipn(self, body):
+        """Answer a _notify-validate call for the IPN in body"""
+
+        fields = frozenset(urlparse.parse_qsl(body, keep_blank_values=True))
+
+        with self.lock:
+            return 'VERIFIED' if fields in self.sent_ipns else 'INVALID'
+
+
+class FakePaypalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Routes HTTP requests to the FakePaypal of the server"""
+
+    @property
+    def paypal(self):
+        return self.server.paypal
+
+    def reply(self, code, body='', content_type='text/plain', headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path, __, query = self.path.partition('?')
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length)
+
+        if self.paypal.simulate_network():
+            return self.reply(500, 'Internal Server Error')
+
+        if path.startswith(API_PREFIX):
+            try:
+                data = json.loads(body or '{}')
+            except ValueError:
+                data = None
+
+            if data is None:
+                response = self.paypal.failure('Invalid request', '580001')
+            elif not self.headers.getheader('X-PAYPAL-SECURITY-USERID'):
+                response = self.paypal.failure('Authentication failed',
+                                               '520003')
+            else:
+                response = self.paypal.call(path[len(API_PREFIX):], data)
+
+            return self.reply(200, json.dumps(response), 'application/json')
+
+        params = urlparse.parse_qs(query)
+        if path == PAYMENT_PATH and params.get('cmd') == ['_notify-validate']:
+            return self.reply(200, self.paypal.verify_ipn(body))
+
+        self.reply(404, 'Not Found')
+
+    def do_GET(self):
+        path, __, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+        cmd = params.get('cmd')
+        url = None
+
+        if path == PAYMENT_PATH:
+            key = params.get('paykey') or params.get('preapprovalkey')
+            if params.get('cancel'):
+                url = self.paypal.cancel_url(key)
+            elif cmd == '_ap-payment':
+                url = self.paypal.approve_payment(key)
+            elif cmd == '_ap-preapproval':
+                url = self.paypal.approve_preapproval(key)
+
+        if url is None:
+            return self.reply(404, 'Not Found')
+        self.reply(302, headers={'Location': url})
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class FakePaypalServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server for a FakePaypal. Bind to port 0 to get a free
+    port, e.g. in tests::
+
+        server = FakePaypalServer(('127.0.0.1', 0), FakePaypal(), quiet=True)
+        threading.Thread(target=server.serve_forever).start()
+        endpoint = 'http://127.0.0.1:%s/AdaptivePayments/' % server.port
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, paypal=None, quiet=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakePaypalHandler)
+        self.paypal = paypal if paypal is not None else FakePaypal()
+        self.quiet = quiet
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8009)
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds added to every call')
+    parser.add_option('--latency-jitter', type='float', default=0,
+                      help='up to this many more seconds at random')
+    parser.add_option('--error-rate', type='float', default=0,
+                      help='fraction of calls answered with HTTP 500')
+    parser.add_option('--auto-approve', action='store_true', default=False,
+                      help='approve payments and preapprovals right away')
+    parser.add_option('--ipn-delay', type='float', default=0,
+                      help='seconds to wait before sending an IPN')
+    parser.add_option('--quiet', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    paypal = FakePaypal(latency=options.latency,
+                        latency_jitter=options.latency_jitter,
+                        error_rate=options.error_rate,
+                        auto_approve=options.auto_approve,
+                        ipn_delay=options.ipn_delay)
+    server = FakePaypalServer((options.host, options.port), paypal,
+                              quiet=options.quiet)
+
+    print 'Fake Paypal listening on http://%s:%s/' % (options.host,
+                                                       server.port)
+    print '  PAYPAL_ENDPOINT = "http://%s:%s%s"' % (options.host, server.port,
+                                                    API_PREFIX)
+    print '  PAYPAL_PAYMENT_HOST = "http://%s:%s%s"' % (
+        options.host, server.port, PAYMENT_PATH)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,911 @@
+"""Managers and querysets for the Paypal Adaptive models"""
+
+import logging
+import operator
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+from django.db.models import F, Q
+from django.utils.encoding import force_unicode
+from django.utils import simplejson as json
+from money.Money import Money
+
+try:
+    # keep the Money lookups that MoneyField's own manager provides
+    from money.contrib.django.models.managers import (
+        QuerysetWithMoney as QuerySet)
+except ImportError:
+    from django.db.models.query import QuerySet
+
+from api import Deadline
+from api.ratelimit import RateLimiter
+import api
+import audit
+import settings
+
+logger = logging.getLogger(__name__)
+
+
+def get_check_interval(status, checks):
+    """
+    Time until the next check of an object in status that has been checked
+    `checks` times before; the interval for the status doubles with every
+    check, up to PAYPAL_SWEEP_MAX_INTERVAL. None when it shouldn't be
+    checked again.
+
+    """
+
+    interval = settings.SWEEP_INTERVALS.get(status)
+    if interval is None or checks >= settings.SWEEP_MAX_CHECKS:
+        return None
+    return min(interval * 2 ** min(checks, 16), settings.SWEEP_MAX_INTERVAL)
+
+
+def run_bulk(jobs, send, handle, max_workers=None, progress=None):
+    """
+    Call send(job) for every job on at most max_workers threads, and
+    handle(job, result) in the calling thread as each call finishes, so
+    that the database is only used from the calling thread. progress, if
+    given, is called with the number of jobs done and the total after each.
+
+    A job whose send or handle raises doesn't stop the others from being
+    handled, the first such error is raised once they all are. Errors
+    raised by progress are only logged.
+
+    """
+
+    if not jobs:
+        return
+
+    executor = ThreadPoolExecutor(
+        min(max_workers or settings.ASYNC_MAX_WORKERS, len(jobs)))
+    error = None
+
+    try:
+        futures = dict((executor.submit(send, job), job) for job in jobs)
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                handle(futures[future], future.result())
+            except Exception:
+                logger.exception('Could not handle %r' % futures[future])
+                if error is None:
+                    error = sys.exc_info()
+
+            if progress is not None:
+                try:
+                    progress(done, len(jobs))
+                except Exception:
+                    logger.exception('Progress callback failed')
+    finally:
+        executor.shutdown()
+
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+
+class PaypalAdaptiveQuerySet(QuerySet):
+    def pending(self):
+        """Objects that are waiting for Paypal or the user"""
+
+        return self.filter(status__in=self.model.pending_statuses)
+
+    def stale(self, older_than=None):
+        """
+        Pending objects created longer than older_than (a timedelta,
+        default the delayed update countdown) ago, oldest first.
+
+        """
+
+        if older_than is None:
+            older_than = settings.DELAYED_UPDATE_COUNTDOWN
+
+        return self.pending().filter(
+            created_date__lt=datetime.now() - older_than
+        ).order_by('created_date')
+
+    def refresh_from_paypal(self, max_workers=None, deadline=None,
+                            fields=None):
+        """
+        Look up every object in the queryset on Paypal, concurrently on at
+        most max_workers threads, and write the changes back with one
+        UPDATE per batch of objects that got the same new values.
+
+        Returns a dict with the number of objects that were updated, were
+        unchanged and that could not be looked up.
+
+        """
+
+        model = self.model
+        endpoint_class = getattr(model, 'update_endpoint', None)
+
+        if endpoint_class is None:
+            raise NotImplementedError(
+                'Model need to specify an update endpoint')
+
+        if fields is None:
+            fields = ['status', 'status_detail']
+
+        stats = {'updated': 0, 'unchanged': 0, 'failed': 0}
+        objects = {}
+        for obj in self:
+            try:
+                key = obj.get_update_kwargs().get(endpoint_class.key_name)
+            except ValueError:
+                continue
+            if key is not None:
+                objects.setdefault(key, []).append(obj)
+                continue
+
+            # e.g. a payment only Paypal knows the payKey of, looked up by
+            # its trackingId on its own
+            before = [getattr(obj, field) for field in fields]
+            try:
+                obj.update(fields=fields, deadline=deadline)
+            except api.PaypalAdaptiveApiError, e:
+                logger.warning('Could not refresh %s %s: %s'
+                               % (model.__name__, obj.pk, e))
+                stats['failed'] += 1
+            else:
+                after = [getattr(obj, field) for field in fields]
+                stats['updated' if after != before else 'unchanged'] += 1
+
+        results = endpoint_class.bulk(objects.keys(), max_workers=max_workers,
+                                      deadline=deadline)
+
+        changes = defaultdict(list)
+
+        for key, endpoint in results.iteritems():
+            if isinstance(endpoint, Exception):
+                logger.warning('Could not refresh %s %s: %s'
+                               % (model.__name__, key, endpoint))
+                stats['failed'] += len(objects[key])
+                continue
+
+            for obj in objects[key]:
+                values = obj.parse_update(endpoint.response, fields)
+                changed = [f for f in fields if getattr(obj, f) != values[f]]
+
+                if not changed or not obj.can_transition(
+                        values.get('status', obj.status)):
+                    stats['unchanged'] += 1
+                    continue
+
+                changes[tuple(sorted(values.items()))].append(
+                    (obj.pk, obj.version))
+
+                for field in fields:
+                    setattr(obj, field, values[field])
+
+        batch_size = settings.BULK_UPDATE_BATCH_SIZE
+        for values, rows in changes.iteritems():
+            values = dict(values)
+            queryset = model._default_manager.all()
+            if 'status' in values:
+                queryset = queryset.filter(
+                    status__in=model.transition_sources(values['status']))
+
+            for i in range(0, len(rows), batch_size):
+                batch = rows[i:i + batch_size]
+                # like transition(), only rows that nobody changed since
+                # they were read
+                read = reduce(operator.or_, [Q(pk=pk, version=version)
+                                             for pk, version in batch])
+                updated = queryset.filter(read).update(
+                    version=F('version') + 1, **values)
+                stats['updated'] += updated
+                stats['unchanged'] += len(batch) - updated
+
+        return stats
+
+    def due(self, now=None):
+        """Objects whose next check by the sweeper is due, earliest first"""
+
+        if now is None:
+            now = datetime.now()
+
+        return self.filter(next_check_at__lte=now).order_by('next_check_at')
+
+    def _claim(self, due, claimed_until):
+        """
+        Move the next check of the due (pk, next_check_at) rows to
+        claimed_until, unless another sweep did so first. Returns the pks
+        of the rows that were claimed.
+
+        """
+
+        manager = self.model._default_manager
+        return [pk for pk, next_check_at in due
+                if manager.filter(pk=pk, next_check_at=next_check_at)
+                .update(next_check_at=claimed_until)]
+
+    def sweep(self, chunk_size=None, max_workers=None, deadline=None):
+        """
+        Refresh the due objects from Paypal, chunk_size at a time, and
+        schedule their next check with get_check_interval(). Objects in a
+        status that isn't in PAYPAL_SWEEP_INTERVALS are only unscheduled.
+        Each object of a chunk is claimed first by moving its next check
+        PAYPAL_SWEEP_CLAIM_TIMEOUT seconds ahead, so sweeps that overlap
+        don't check the same objects. Stops early when deadline (seconds or
+        a Deadline) passes.
+
+        Returns the summed stats of refresh_from_paypal().
+
+        """
+
+        if chunk_size is None:
+            chunk_size = settings.SWEEP_CHUNK_SIZE
+
+        deadline = Deadline.coerce(deadline)
+        manager = self.model._default_manager
+        now = datetime.now()
+        stats = {'updated': 0, 'unchanged': 0, 'failed': 0}
+
+        while deadline is None or deadline.remaining() > 0:
+            due = list(self.due(now).values_list('pk', 'next_check_at')
+                       [:chunk_size])
+            if not due:
+                break
+
+            pks = self._claim(due, datetime.now() + timedelta(
+                seconds=settings.SWEEP_CLAIM_TIMEOUT))
+            if not pks:
+                # another sweep is working through them
+                break
+
+            chunk = manager.filter(pk__in=pks)
+            result = chunk.filter(
+                status__in=settings.SWEEP_INTERVALS.keys()
+            ).refresh_from_paypal(max_workers=max_workers, deadline=deadline)
+            for key, count in result.iteritems():
+                stats[key] += count
+
+            schedule = defaultdict(list)
+            for pk, status, checks in chunk.values_list(
+                    'pk', 'status', 'check_count'):
+                schedule[(status, checks)].append(pk)
+
+            checked_at = datetime.now()
+            for (status, checks), scheduled in schedule.iteritems():
+                interval = get_check_interval(status, checks)
+                manager.filter(pk__in=scheduled).update(
+                    next_check_at=(checked_at + interval
+                                   if interval is not None else None),
+                    check_count=F('check_count') + 1)
+
+        return stats
+
+
+class PaymentQuerySet(PaypalAdaptiveQuerySet):
+    def by_pay_key(self, pay_key):
+        return self.filter(pay_key=pay_key)
+
+    def in_bulk_by_tracking_id(self, tracking_ids):
+        """Dict of the given trackingIds to their payments"""
+
+        return dict((payment.tracking_id, payment) for payment in
+                    self.filter(tracking_id__in=tracking_ids))
+
+    def by_transaction_id(self, transaction_id):
+        return self.filter(transaction_id=transaction_id)
+
+
+class PreapprovalQuerySet(PaypalAdaptiveQuerySet):
+    def by_preapproval_key(self, preapproval_key):
+        return self.filter(preapproval_key=preapproval_key)
+
+    def mark_as_used(self):
+        """Mark the preapprovals used with one UPDATE, returns how many"""
+
+        return self.filter(
+            status__in=self.model.transition_sources('used')
+        ).update(status='used', version=F('version') + 1)
+
+    def settle(self, get_receivers, max_workers=None, rate=None,
+               deadline=None, progress=None, retry_failed=False, **kwargs):
+        """
+        Charge the approved preapprovals with a Pay call each to the
+        receivers (a ReceiverList) returned by get_receivers(preapproval),
+        on at most max_workers threads and at most rate
+        (PAYPAL_SETTLEMENT_RATE) calls a second. Extra kwargs are passed to
+        Pay. progress is called like by Refund.objects.bulk_refund().
+
+        The Payment of every preapproval is created with a trackingId
+        derived from the preapproval, and marked created, before Paypal is
+        called. A later run looks payments that are left created up on
+        Paypal by their trackingId before paying them again, so a run that
+        was interrupted is resumed by settling the same preapprovals again
+        without charging any of them twice. Failed payments are only tried
+        again with retry_failed. Preapprovals that were paid are marked used
+        in bulk.
+
+        Returns a dict with the number of payments that completed, failed
+        and were left for a later run, of preapprovals that were skipped,
+        the seconds it took and the payments completed a second, and
+        'failures', a dict of preapproval ids to the detail of their
+        failure.
+
+        """
+
+        started = time.time()
+        deadline = Deadline.coerce(deadline)
+        if rate is None:
+            rate = settings.SETTLEMENT_RATE
+        limiter = RateLimiter(rate) if rate else None
+
+        report = {'completed': 0, 'failed': 0, 'remaining': 0, 'skipped': 0,
+                  'failures': {}}
+        pks = list(self.values_list('pk', flat=True))
+        manager = self.model._default_manager
+        jobs = []
+        used = []
+
+        batch_size = settings.BULK_UPDATE_BATCH_SIZE
+        for i in range(0, len(pks), batch_size):
+            batch = manager.in_bulk(pks[i:i + batch_size]).values()
+            batch_jobs = self._settlement_jobs(
+                batch, get_receivers, retry_failed, used, deadline, kwargs)
+            report['skipped'] += len(batch) - len(batch_jobs)
+            jobs.extend(batch_jobs)
+
+        def lookup(payment):
+            """PaymentDetails of payment, None if Paypal doesn't know it"""
+
+            if limiter is not None:
+                limiter.acquire(deadline)
+
+            details = api.PaymentDetails(trackingId=payment.tracking_id,
+                                         deadline=deadline)
+            try:
+                details.call()
+            except api.TransportError:
+                raise
+            except api.PaypalAdaptiveApiError:
+                if details.not_found:
+                    return None
+                raise
+            return details
+
+        def send(job):
+            payment, preapproval, endpoint, look_up = job
+            if deadline is not None and deadline.remaining() <= 0:
+                return None, None
+
+            if look_up:
+                try:
+                    details = lookup(payment)
+                except api.PaypalAdaptiveApiError, e:
+                    # can't tell if it was paid, leave it created
+                    return None, e
+                if details is not None:
+                    return details, None
+
+            try:
+
+                if limiter is not None:
+                    limiter.acquire(deadline)
+                endpoint.call()
+            except api.TransportError, e:
+                # Paypal may or may not have got it, leave it created
+                return None, e
+            except api.PaypalAdaptiveApiError, e:
+                return endpoint, e
+            except Exception, e:
+                # fail this payment only, a retry looks it up first
+                logger.exception('Could not pay %r' % payment)
+                return endpoint, e
+            return endpoint, None
+
+        def handle(job, result):
+            payment, preapproval, __, __ = job
+            endpoint, error = result
+
+            if endpoint is None:
+                report['remaining'] += 1
+                return
+
+            payment._capture(endpoint, error=error)
+
+            if error is not None:
+                payment.transition('error', audit_record=payment.audit_record,
+                                   status_detail=force_unicode(
+                                       error, errors='replace')[:2048])
+            elif isinstance(endpoint, api.Pay):
+                payment.apply_pay_response(endpoint)
+            else:
+                payment.transition(
+                    payment._parse_update_status(endpoint.response),
+                    pay_key=endpoint.response.get('payKey', payment.pay_key),
+                    audit_record=payment.audit_record)
+
+            if payment.status == 'completed':
+                report['completed'] += 1
+                used.append(preapproval.pk)
+            else:
+                report['failed'] += 1
+                report['failures'][preapproval.pk] = (payment.status_detail
+                                                      or payment.status)
+
+            if len(used) >= batch_size:
+                manager.filter(pk__in=used).mark_as_used()
+                del used[:]
+
+        run_bulk(jobs, send, handle, max_workers=max_workers,
+                 progress=progress)
+
+        if used:
+            manager.filter(pk__in=used).mark_as_used()
+
+        report['seconds'] = time.time() - started
+        report['per_second'] = (report['completed'] / report['seconds']
+                                if report['seconds'] else 0)
+
+        logger.info('Settled %(completed)i preapprovals in %(seconds).1fs '
+                    '(%(per_second).1f/s), %(failed)i failed, %(remaining)i '
+                    'remaining, %(skipped)i skipped' % report)
+        return report
+
+    def _settlement_jobs(self, preapprovals, get_receivers, retry_failed,
+                         used, deadline, kwargs):
+        """
+        The payments to make for a batch of preapprovals, as (payment,
+        preapproval, Pay endpoint, whether to look it up first) tuples.
+        The payments are created if needed and marked created.
+
+        """
+
+        payment_model = models.get_model('paypaladaptive', 'Payment')
+        payments = payment_model._default_manager
+        preapprovals = dict((preapproval.settlement_tracking_id, preapproval)
+                            for preapproval in preapprovals)
+        existing = payments.in_bulk_by_tracking_id(preapprovals.keys())
+
+        todo = []
+        missing = []
+        receivers = {}
+        for tracking_id, preapproval in preapprovals.iteritems():
+            payment = existing.get(tracking_id)
+
+            if payment is None:
+                if preapproval.status == 'approved':
+                    missing.append(preapproval)
+            elif payment.status in ('completed', 'refunded'):
+                if preapproval.status != 'used':
+                    used.append(preapproval.pk)
+            elif (payment.status in ('new', 'created', 'returned')
+                    or (payment.status == 'error' and retry_failed)):
+                todo.append((payment, preapproval,
+                             payment.status != 'new'))
+
+        if missing:
+            new_payments = []
+            for preapproval in missing:
+                receivers[preapproval.pk] = get_receivers(preapproval)
+                new_payments.append(payment_model(
+                    money=Money(receivers[preapproval.pk].total_amount,
+                                preapproval.money.currency),
+                    preapproval=preapproval,
+                    tracking_id=preapproval.settlement_tracking_id,
+                    next_check_at=payment_model.get_first_check_at()))
+            # bulk_create doesn't call save(), which schedules the check
+            payments.bulk_create(new_payments)
+
+            created = payments.in_bulk_by_tracking_id(
+                [preapproval.settlement_tracking_id for preapproval in missing])
+            for preapproval in missing:
+                todo.append((created[preapproval.settlement_tracking_id],
+                             preapproval, False))
+
+        if todo:
+            # checkpoint: from here on they may have reached Paypal
+            payments.filter(
+                pk__in=[payment.pk for payment, __, __ in todo],
+                status__in=payment_model.transition_sources('created')
+            ).update(status='created', version=F('version') + 1)
+
+        jobs = []
+        for payment, preapproval, look_up in todo:
+            if payment.status in payment_model.transition_sources('created'):
+                payment.status = 'created'
+                payment.version += 1
+
+            if preapproval.pk not in receivers:
+                receivers[preapproval.pk] = get_receivers(preapproval)
+
+            try:
+                endpoint = api.Pay(**payment.get_pay_kwargs(
+                    receivers[preapproval.pk], preapproval=preapproval,
+                    deadline=deadline, **kwargs))
+            except ValueError, e:
+                payment.transition('error', status_detail=force_unicode(
+                    e, errors='replace'))
+                continue
+
+            jobs.append((payment, preapproval, endpoint, look_up))
+
+        return jobs
+
+
+class PaypalAdaptiveManager(models.Manager):
+    queryset_class = PaypalAdaptiveQuerySet
+
+    def get_query_set(self):
+        return self.queryset_class(self.model, using=self._db)
+
+    def refresh_from_paypal(self, *args, **kwargs):
+        return self.get_query_set().refresh_from_paypal(*args, **kwargs)
+
+    def pending(self):
+        return self.get_query_set().pending()
+
+    def stale(self, older_than=None):
+        return self.get_query_set().stale(older_than)
+
+    def due(self, now=None):
+        return self.get_query_set().due(now)
+
+    def sweep(self, *args, **kwargs):
+        return self.get_query_set().sweep(*args, **kwargs)
+
+
+class PaymentManager(PaypalAdaptiveManager):
+    queryset_class = PaymentQuerySet
+
+    def by_pay_key(self, pay_key):
+        return self.get_query_set().by_pay_key(pay_key)
+
+    def by_transaction_id(self, transaction_id):
+        return self.get_query_set().by_transaction_id(transaction_id)
+
+    def in_bulk_by_tracking_id(self, tracking_ids):
+        return self.get_query_set().in_bulk_by_tracking_id(tracking_ids)
+
+
+class PreapprovalManager(PaypalAdaptiveManager):
+    queryset_class = PreapprovalQuerySet
+
+    def by_preapproval_key(self, preapproval_key):
+        return self.get_query_set().by_preapproval_key(preapproval_key)
+
+    def mark_as_used(self):
+        return self.get_query_set().mark_as_used()
+
+    def settle(self, *args, **kwargs):
+        return self.get_query_set().settle(*args, **kwargs)
+
+
+class RefundManager(PaypalAdaptiveManager):
+    def bulk_refund(self, payments, max_workers=None, rate=None,
+                    deadline=None, progress=None, retry_failed=False):
+        """
+        Refund completed payments in full, calling Paypal on at most
+        max_workers threads and at most rate (PAYPAL_REFUND_RATE) times a
+        second. After each refund progress, if given, is called with the
+        number of refunds done and the total.
+
+        A Refund is created for every payment before Paypal is called, and
+        is reused by later runs until it completes, so an interrupted run is
+        resumed by calling bulk_refund() with the same payments again.
+        Refunds that may have reached Paypal before, and calls that failed
+        on the way to or from Paypal, are looked up with PaymentDetails
+        rather than sent again. Failed refunds are only tried again with
+        retry_failed.
+
+        Returns a dict with the number of refunds that completed, failed
+        and were left for a later run because deadline passed or Paypal
+        couldn't tell whether they went through, and of payments that were
+        skipped as they aren't completed or already have a refund.
+
+        """
+
+        deadline = Deadline.coerce(deadline)
+        if rate is None:
+            rate = settings.REFUND_RATE
+        limiter = RateLimiter(rate) if rate else None
+
+        stats = {'completed': 0, 'failed': 0, 'remaining': 0, 'skipped': 0}
+        pks = [getattr(payment, 'pk', payment) for payment in payments]
+        jobs = []
+
+        batch_size = settings.BULK_UPDATE_BATCH_SIZE
+        for i in range(0, len(pks), batch_size):
+            batch = self._open_refunds(pks[i:i + batch_size], retry_failed)
+            stats['skipped'] += len(pks[i:i + batch_size]) - len(batch)
+            jobs.extend(batch)
+
+        if not jobs:
+            return stats
+
+        def look_up(refund):
+            if limiter is not None:
+                try:
+                    limiter.acquire(deadline)
+                except api.DeadlineExceeded:
+                    return None
+            return refund.look_up(deadline=deadline)
+
+        def send(job):
+            refund, sent_before = job
+            if deadline is not None and deadline.remaining() <= 0:
+                return None, None
+
+            if sent_before:
+                details = look_up(refund)
+                if details is None:
+                    # can't tell if it was refunded, leave it created
+                    return None, None
+                if refund.refunded_on_paypal(details):
+                    return details, None
+
+            endpoint = api.Refund(refund.payment.pay_key, deadline=deadline,
+                                  **refund.get_endpoint_kwargs())
+            try:
+                if limiter is not None:
+                    limiter.acquire(deadline)
+                endpoint.call()
+            except api.DeadlineExceeded, e:
+                if not endpoint.attempts:
+                    # never sent, leave it for the next run
+                    return None, None
+                error = e
+            except api.TransportError, e:
+                error = e
+            except Exception, e:
+                return endpoint, e
+            else:
+                return endpoint, None
+
+            # Paypal may or may not have got it
+            details = look_up(refund)
+            if details is None:
+                return None, None
+            if refund.refunded_on_paypal(details):
+                return details, None
+            return endpoint, error
+
+        def handle(job, result):
+            refund, __ = job
+            endpoint, error = result
+
+            if endpoint is None:
+                stats['remaining'] += 1
+                return
+
+            if isinstance(endpoint, api.PaymentDetails):
+                refund.apply_details(endpoint)
+                stats['completed'] += 1
+                return
+
+            refund._capture(endpoint, error=error)
+            if refund.apply_response(endpoint, error=error):
+                stats['completed'] += 1
+            else:
+                stats['failed'] += 1
+
+        run_bulk(jobs, send, handle, max_workers=max_workers,
+                 progress=progress)
+
+        logger.info('Bulk refund: %(completed)i completed, %(failed)i failed, '
+                    '%(remaining)i remaining, %(skipped)i skipped' % stats)
+        return stats
+
+    def _open_refunds(self, payment_pks, retry_failed):
+        """
+        The full refunds to make of a batch of payments, marked as created,
+        as (refund, whether it may have been sent before) tuples. Existing
+        unfinished ones are reused, the others are bulk created.
+
+        """
+
+        payment_model = self.model._meta.get_field('payment').rel.to
+        payments = payment_model._default_manager.in_bulk(payment_pks)
+        open_statuses = ['new', 'created'] + (['error'] if retry_failed
+                                              else [])
+
+        existing = {}
+        for refund in self.filter(payment__in=payment_pks, receiver_amounts=''
+                                  ).exclude(status='canceled'):
+            existing.setdefault(refund.payment_id, []).append(refund)
+
+        refunds = []
+        missing = []
+        for pk in payment_pks:
+            payment = payments.get(pk)
+            if payment is None or payment.status != 'completed':
+                continue
+
+            previous = existing.get(pk, [])
+            if any(refund.status == 'completed' for refund in previous):
+                continue
+
+            reusable = [refund for refund in previous
+                        if refund.status in open_statuses]
+            if reusable:
+                reusable[0].payment = payment
+                refunds.append((reusable[0], reusable[0].status != 'new'))
+            elif not previous:
+                missing.append(payment)
+
+        if missing:
+            self.bulk_create([self.model.for_payment(payment)
+                              for payment in missing])
+            for refund in self.filter(
+                    payment__in=[payment.pk for payment in missing],
+                    receiver_amounts='', status='new'):
+                refund.payment = payments[refund.payment_id]
+                refunds.append((refund, False))
+
+        if refunds:
+            self.filter(pk__in=[refund.pk for refund, __ in refunds],
+                        status__in=self.model.transition_sources('created')
+                        ).update(status='created', version=F('version') + 1)
+            for refund, __ in refunds:
+                refund.status = 'created'
+                refund.version += 1
+
+        return refunds
+
+
+class AuditRecordManager(models.Manager):
+    def capture(self, endpoint, obj=None, error=None, sample_rate=None):
+        """
+        Store the redacted and compressed request and response of a called
+        endpoint, if the call failed or was picked by sampling. Returns the
+        new AuditRecord or None.
+
+        """
+
+        failed = error is not None
+        if not audit.should_capture(failed, sample_rate):
+            return None
+
+        record = self.model(
+            endpoint=endpoint.__class__.__name__,
+            failed=failed,
+            error=(force_unicode(error, errors='replace')[:2048] if failed
+                   else ''),
+            object_type=obj._meta.module_name if obj is not None else '',
+            object_id=obj.pk if obj is not None else None)
+        record.request = json.dumps(audit.redact(dict(endpoint.data)),
+                                    cls=DjangoJSONEncoder)
+        record.response = audit.redact_json(
+            getattr(endpoint, 'raw_response', None))
+        record.save()
+        return record
+
+    def for_object(self, obj):
+        return self.filter(object_type=obj._meta.module_name,
+                           object_id=obj.pk)
+
+    def prune(self, older_than=None, batch_size=None):
+        """
+        Delete records older than the retention period, in batches so that
+        the table isn't locked for long. Returns the number deleted.
+
+        """
+
+        if older_than is None:
+            older_than = settings.AUDIT_RETENTION
+        if batch_size is None:
+            batch_size = settings.BULK_UPDATE_BATCH_SIZE
+
+        cutoff = datetime.now() - older_than
+        deleted = 0
+
+        while True:
+            pks = list(self.filter(created_date__lt=cutoff)
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            self.filter(pk__in=pks).delete()
+            deleted += len(pks)
+
+
+class IPNMessageManager(models.Manager):
+    def receive(self, object_id, object_secret_uuid, body):
+        """
+        Store an incoming IPN message, or find the stored copy of one Paypal
+        sent before by its content hash. Returns the message and whether it
+        was stored now.
+
+        """
+
+        content_hash = self.model.hash_content(object_id, object_secret_uuid,
+                                               body)
+
+        # also copes with the same message coming in twice at once
+        return self.get_or_create(content_hash=content_hash, defaults={
+            'object_id': object_id,
+            'object_secret_uuid': object_secret_uuid,
+            'body': body})
+
+    def _claimable(self, now, include_failed=False):
+        """
+        New messages and ones whose claim timed out, and failed ones with
+        include_failed
+
+        """
+
+        claimable = (Q(status='new')
+                     | Q(status='processing', claimed_at__lt=now - timedelta(
+                         seconds=settings.IPN_CLAIM_TIMEOUT)))
+        if include_failed:
+            claimable |= Q(status='failed')
+        return claimable
+
+    def claim_message(self, message):
+        """
+        Claim a single message, e.g. one Paypal sent again after it failed.
+        Returns whether it was claimed.
+
+        """
+
+        now = datetime.now()
+        token = uuid.uuid4().hex
+
+        if not self.filter(self._claimable(now, include_failed=True),
+                           pk=message.pk).update(
+                status='processing', claimed_at=now, claim_token=token):
+            return False
+
+        message.status = 'processing'
+        message.claimed_at = now
+        message.claim_token = token
+        return True
+
+    def claim(self, batch_size=None):
+        """
+        Take up to batch_size messages to process and mark them processing.
+        Messages that a worker claimed but didn't finish within
+        PAYPAL_IPN_CLAIM_TIMEOUT seconds are taken again.
+
+        """
+
+        if batch_size is None:
+            batch_size = settings.IPN_BATCH_SIZE
+
+        now = datetime.now()
+        claimable = self._claimable(now)
+
+        pks = list(self.filter(claimable).order_by('pk')
+                   .values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return []
+
+        token = uuid.uuid4().hex
+        self.filter(claimable, pk__in=pks).update(
+            status='processing', claimed_at=now, claim_token=token)
+
+        # other workers may have claimed some of them first
+        return list(self.filter(claim_token=token).order_by('pk'))
+
+    def prune(self, older_than=None, batch_size=None):
+        """
+        Delete processed, rejected and failed messages older than the
+        retention period, in batches. Returns the number deleted.
+
+        """
+
+        if older_than is None:
+            older_than = settings.IPN_RETENTION
+        if batch_size is None:
+            batch_size = settings.BULK_UPDATE_BATCH_SIZE
+
+        cutoff = datetime.now() - older_than
+        deleted = 0
+
+        while True:
+            pks = list(self.filter(status__in=('processed', 'rejected',
+                                               'failed'),
+                                   created_date__lt=cutoff)
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            self.filter(pk__in=pks).delete()
+            deleted += len(pks)
+
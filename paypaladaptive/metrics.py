@@ -0,0 +1,42 @@
+"""
+In-process counters for monitoring the Paypal integration.
+
+Counters are kept per process and can be read with `snapshot()`, e.g. from
+a management command or a monitoring view, and every increment is logged
+at debug level so that log based metrics can pick them up as well.
+
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_counters = {}
+
+
+def incr(name, value=1):
+    """Add value to the counter called name"""
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+    logger.debug('metric %s += %s' % (name, value))
+
+
+def get(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    """Return a copy of all counters"""
+
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
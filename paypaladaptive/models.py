@@ -1,17 +1,26 @@
 """Models to support Paypal Adaptive API"""
+import hashlib
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
+from decimal import Decimal
 
-from django.core.urlresolvers import reverse
 from django.db import models, transaction
+from django.db.models import F
+from django.utils.encoding import force_unicode, smart_str
 from django.utils.translation import ugettext_lazy as _
-from django.contrib.sites.models import Site
 from django.utils import simplejson as json
 
 from money.contrib.django.models.fields import MoneyField
+from money.Money import Money
 
 import settings
 import api
+import audit
+from managers import (AuditRecordManager, IPNMessageManager,
+                      PaypalAdaptiveManager, PaymentManager,
+                      PreapprovalManager, RefundManager)
+from urlbuilder import url_builder
 
 
 try:
@@ -41,28 +50,263 @@ class UUIDField(models.CharField) :
         return value
 
 
+class AuditRecord(models.Model):
+    """Redacted and compressed request and response of a call to Paypal"""
+
+    created_date = models.DateTimeField(_(u'created on'), auto_now_add=True,
+                                        db_index=True)
+    endpoint = models.CharField(_(u'endpoint'), max_length=64)
+    failed = models.BooleanField(_(u'failed'), default=False)
+    error = models.CharField(_(u'error'), max_length=2048, blank=True)
+    object_type = models.CharField(_(u'object type'), max_length=32,
+                                   blank=True)
+    object_id = models.PositiveIntegerField(_(u'object ID'), blank=True,
+                                            null=True)
+    compressed_request = models.TextField(_(u'request'), blank=True,
+                                          null=True)
+    compressed_response = models.TextField(_(u'response'), blank=True,
+                                           null=True)
+
+    objects = AuditRecordManager()
+
+    def get_request(self):
+        return audit.decompress(self.compressed_request)
+
+    def set_request(self, value):
+        self.compressed_request = audit.compress(value)
+
+    request = property(get_request, set_request)
+
+    def get_response(self):
+        return audit.decompress(self.compressed_response)
+
+    def set_response(self, value):
+        self.compressed_response = audit.compress(value)
+
+    response = property(get_response, set_response)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.endpoint, self.created_date)
+
+
+class IPNMessage(models.Model):
+    """
+    An IPN message as it was received, kept to be verified and applied
+    later when PAYPAL_ASYNC_IPN is on.
+
+    """
+
+    STATUS_CHOICES = (
+        ('new', _(u'New')),  # waiting to be processed
+        ('processing', _(u'Processing')),  # claimed by a worker
+        ('processed', _(u'Processed')),  # verified and applied
+        ('rejected', _(u'Rejected')),  # not verified, or no such object
+        ('failed', _(u'Failed')),  # gave up, check error
+    )
+
+    created_date = models.DateTimeField(_(u'created on'), auto_now_add=True,
+                                        db_index=True)
+    object_id = models.PositiveIntegerField(_(u'object ID'))
+    object_secret_uuid = models.CharField(_(u'object secret UUID'),
+                                          max_length=32)
+    body = models.TextField(_(u'body'))
+    content_hash = models.CharField(_(u'content hash'), max_length=40,
+                                    unique=True)
+    verified = models.NullBooleanField(_(u'verified'))
+    status = models.CharField(_(u'status'), max_length=10,
+                              choices=STATUS_CHOICES, default='new',
+                              db_index=True)
+    attempts = models.PositiveIntegerField(_(u'attempts'), default=0)
+    error = models.CharField(_(u'error'), max_length=2048, blank=True)
+    claimed_at = models.DateTimeField(_(u'claimed on'), blank=True,
+                                      null=True)
+    claim_token = models.CharField(_(u'claim token'), max_length=32,
+                                   blank=True, db_index=True)
+    processed_date = models.DateTimeField(_(u'processed on'), blank=True,
+                                          null=True)
+
+    objects = IPNMessageManager()
+
+    def __unicode__(self):
+        return u'IPN %s for %s' % (self.pk, self.object_id)
+
+    @staticmethod
+    def hash_content(object_id, object_secret_uuid, body):
+        """Paypal sends the same body again until it gets a 2xx answer"""
+
+        return hashlib.sha1(smart_str(u'%s:%s:' % (object_id,
+                                                    object_secret_uuid))
+                            + smart_str(body)).hexdigest()
+
+
 class PaypalAdaptive(models.Model):
     """Base fields used by all PaypalAdaptive models"""
     money = MoneyField(_(u'money'), max_digits=settings.MAX_DIGITS,
                        decimal_places=settings.DECIMAL_PLACES)
-    created_date = models.DateTimeField(_(u'created on'), auto_now_add=True)
+    created_date = models.DateTimeField(_(u'created on'), auto_now_add=True,
+                                        db_index=True)
     secret_uuid = UUIDField(_(u'secret UUID'))  # to verify return_url
-    debug_request = models.TextField(_(u'raw request'), blank=True, null=True)
-    debug_response = models.TextField(_(u'raw response'), blank=True,
-                                      null=True)
+    audit_record = models.ForeignKey(AuditRecord, verbose_name=_(u'last call'),
+                                     blank=True, null=True, related_name='+',
+                                     on_delete=models.SET_NULL)
+    version = models.PositiveIntegerField(_(u'version'), default=0)
+    next_check_at = models.DateTimeField(_(u'next check on'), blank=True,
+                                         null=True, db_index=True)
+    check_count = models.PositiveIntegerField(_(u'checks'), default=0)
+
+    objects = PaypalAdaptiveManager()
+
+    # statuses of objects that wait for Paypal or the user
+    pending_statuses = ('created', 'returned')
+
+    # status -> statuses it may change to, see transition()
+    STATUS_TRANSITIONS = {}
+
+    @classmethod
+    def get_first_check_at(cls):
+        """When the sweep_updates task first checks a new object, if at all"""
+
+        if settings.USE_DELAYED_UPDATES and hasattr(cls, 'update_endpoint'):
+            return datetime.now() + settings.DELAYED_UPDATE_COUNTDOWN
+        return None
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            self.version += 1
+        elif self.next_check_at is None:
+            # picked up by the sweep_updates task
+            self.next_check_at = self.get_first_check_at()
+        super(PaypalAdaptive, self).save(*args, **kwargs)
 
     def call(self, endpoint_class, *args, **kwargs):
+        """
+        Call the endpoint and capture it for the audit log. Nothing is saved
+        on success: the caller saves `audit_record` along with the rest of
+        the fields its transition changed. On failure only the audit record
+        is saved.
+
+        """
+
         endpoint = endpoint_class(*args, **kwargs)
 
         try:
             res = endpoint.call()
-        finally:
-            self.debug_request = json.dumps(endpoint.data)
-            self.debug_response = endpoint.raw_response
-            self.save()
+        except Exception, e:
+            if self._capture(endpoint, error=e):
+                self.save_fields('audit_record')
+            raise
 
+        self._capture(endpoint)
         return res, endpoint
 
+    def _capture(self, endpoint, error=None):
+        record = AuditRecord.objects.capture(endpoint, obj=self, error=error)
+        if record is not None:
+            self.audit_record = record
+        return record is not None
+
+    def save_fields(self, *fields):
+        """
+        Write only the given fields with a single UPDATE, like
+        save(update_fields=...) of later Django versions. Objects that
+        aren't in the database yet are saved in full.
+
+        """
+
+        if self.pk is None:
+            self.save()
+            return
+
+        values = dict((field, getattr(self, field)) for field in fields)
+        if values:
+            type(self)._default_manager.filter(pk=self.pk).update(
+                version=F('version') + 1, **values)
+            self.version += 1
+
+    def can_transition(self, status, from_status=None):
+        if from_status is None:
+            from_status = self.status
+        return (status == from_status
+                or status in self.STATUS_TRANSITIONS.get(from_status, ()))
+
+    @classmethod
+    def transition_sources(cls, status):
+        """Statuses that may change to status"""
+
+        return [from_status for from_status in
+                set(cls.STATUS_TRANSITIONS) | set([status])
+                if status == from_status
+                or status in cls.STATUS_TRANSITIONS.get(from_status, ())]
+
+    def transition(self, status, **values):
+        """
+        Change the status, and write values along with it, if the
+        transition is allowed by STATUS_TRANSITIONS.
+
+        The change is made as a single conditional UPDATE that only matches
+        while the row has the version this object was loaded with and a
+        status the new status may follow. If another process changed the
+        row in the meantime the current status is reloaded and the
+        transition tried again, as long as it is still allowed. No row lock
+        is held, so it is safe to call around calls to Paypal.
+
+        Returns True if the status was changed, False if the transition
+        isn't allowed; self.status then holds the current status. Unsaved
+        objects are saved in full.
+
+        """
+
+        if self.pk is None:
+            # nobody else can have seen it yet
+            if not self.can_transition(status):
+                return False
+            self.status = status
+            for field, value in values.iteritems():
+                setattr(self, field, value)
+            self.save()
+            return True
+
+        sources = self.transition_sources(status)
+        manager = type(self)._default_manager
+
+        while self.can_transition(status):
+            updated = manager.filter(
+                pk=self.pk, version=self.version, status__in=sources
+            ).update(status=status, version=F('version') + 1, **values)
+
+            if updated:
+                self.status = status
+                self.version += 1
+                for field, value in values.iteritems():
+                    setattr(self, field, value)
+                return True
+
+            try:
+                self.status, self.version = manager.filter(
+                    pk=self.pk).values_list('status', 'version')[0]
+            except IndexError:
+                return False
+
+        logger.info('Refused to change %s %s from %s to %s'
+                    % (self.__class__.__name__, self.pk, self.status, status))
+        return False
+
+    @property
+    def debug_request(self):
+        """Request of the last captured call"""
+
+        if self.audit_record_id is None:
+            return None
+        return self.audit_record.request
+
+    @property
+    def debug_response(self):
+        """Response of the last captured call"""
+
+        if self.audit_record_id is None:
+            return None
+        return self.audit_record.response
+
     def get_amount(self):
         return self.money.amount
 
@@ -79,13 +323,12 @@ class PaypalAdaptive(models.Model):
 
     currency = property(get_currency, set_currency)
 
-    @property
-    def ipn_url(self):
-        current_site = Site.objects.get_current()
-        kwargs = {'object_id': self.id,
-                  'object_secret_uuid': self.secret_uuid}
-        ipn_url = reverse('paypal-adaptive-ipn', kwargs=kwargs)
-        return "http://%s%s" % (current_site, ipn_url)
+    def get_ipn_url(self, request=None):
+        return url_builder.build('paypal-adaptive-ipn', request=request,
+                                 object_id=self.id,
+                                 object_secret_uuid=self.secret_uuid)
+
+    ipn_url = property(get_ipn_url)
     
     class Meta:
         abstract = True
@@ -93,10 +336,25 @@ class PaypalAdaptive(models.Model):
     def get_update_kwargs(self):
         return {}
 
+    def invalidate_details_cache(self):
+        """Make the next update fetch fresh details from Paypal"""
+
+        endpoint = getattr(self, 'update_endpoint', None)
+        if endpoint is None or endpoint.key_name is None:
+            return
+
+        try:
+            key = self.get_update_kwargs().get(endpoint.key_name)
+        except ValueError:
+            return
+
+        if key is not None:
+            endpoint.invalidate_cache(key)
+
     def _parse_update_status_detail(self, response):
         return ''
 
-    def update(self, save=True, fields=None):
+    def update(self, save=True, fields=None, deadline=None):
         if not hasattr(self, 'update_endpoint'):
             raise NotImplementedError(
                 'Model need to specify an update endpoint')
@@ -104,21 +362,51 @@ class PaypalAdaptive(models.Model):
         if fields is None:
             fields = ['status', 'status_detail']
 
+        audit_record_id = self.audit_record_id
+
         try:
-            __, endpoint = self.call(self.update_endpoint,
+            __, endpoint = self.call(self.update_endpoint, deadline=deadline,
                                      **self.get_update_kwargs())
         except ValueError, e:
             model_name = self.__class__.__name__
             logger.warning('Could not update %s:\n%s' % (model_name, e.message))
         else:
-            response = endpoint.response
-
-            for field in fields:
-                val = getattr(self, '_parse_update_%s' % field)(response)
+            values = self.parse_update(endpoint.response, fields)
+            changed = dict((field, val) for field, val in values.iteritems()
+                           if getattr(self, field) != val)
+            status = changed.pop('status', None)
+
+            if status is not None and not self.can_transition(status):
+                logger.info('Ignoring update of %s %s from %s to %s'
+                            % (self.__class__.__name__, self.pk,
+                               self.status, status))
+                status = None
+                changed = {}
+
+            if self.audit_record_id != audit_record_id:
+                changed['audit_record'] = self.audit_record
+
+            if save and status is not None:
+                if (not self.transition(status, **changed)
+                        and 'audit_record' in changed):
+                    # lost to a concurrent change, keep the record of the call
+                    self.save_fields('audit_record')
+                return
+
+            if status is not None:
+                self.status = status
+            for field, val in changed.iteritems():
                 setattr(self, field, val)
 
             if save:
-                self.save()
+                self.save_fields(*changed)
+
+    def parse_update(self, response, fields):
+        """Return the new value of each field according to response"""
+
+        return dict(
+            (field, getattr(self, '_parse_update_%s' % field)(response))
+            for field in fields)
 
 
 class Payment(PaypalAdaptive):
@@ -136,60 +424,95 @@ class Payment(PaypalAdaptive):
         ('refunded', _(u'Refunded')),  # payment has been refunded
     )
 
-    pay_key = models.CharField(_(u'paykey'), max_length=255)
+    STATUS_TRANSITIONS = {
+        'new': ('created', 'completed', 'error', 'canceled'),
+        'created': ('returned', 'completed', 'error', 'canceled'),
+        'returned': ('completed', 'error', 'canceled'),
+        'error': ('created', 'completed', 'canceled'),
+        # a late IPN or update, the money has moved
+        'canceled': ('completed',),
+        'completed': ('refunded',),
+        'refunded': (),
+    }
+
+    pay_key = models.CharField(_(u'paykey'), max_length=255, db_index=True)
+    tracking_id = models.CharField(_(u'tracking ID'), max_length=127,
+                                   blank=True, null=True, unique=True)
+    preapproval = models.ForeignKey('Preapproval', verbose_name=_(
+        u'preapproval'), blank=True, null=True, related_name='payments',
+        on_delete=models.SET_NULL)
     transaction_id = models.CharField(_(u'paypal transaction ID'),
-                                      max_length=128, blank=True, null=True)
+                                      max_length=128, blank=True, null=True,
+                                      db_index=True)
     status = models.CharField(_(u'status'), max_length=10,
                               choices=STATUS_CHOICES, default='new')
     status_detail = models.CharField(_(u'detailed status'), max_length=2048)
 
-    def save(self, *args, **kwargs):
-        is_new = self.id is None
+    objects = PaymentManager()
 
-        super(Payment, self).save(*args, **kwargs)
+    def get_return_url(self, request=None):
+        return url_builder.build('paypal-adaptive-payment-return',
+                                 request=request, payment_id=self.id,
+                                 secret_uuid=self.secret_uuid)
 
-        if settings.USE_DELAYED_UPDATES and is_new:
-            from .tasks import update_payment
-            update_payment.apply_async(
-                args=[self.id],
-                eta=datetime.now() + settings.DELAYED_UPDATE_COUNTDOWN)
+    return_url = property(get_return_url)
 
-    @property
-    def return_url(self):
-        current_site = Site.objects.get_current()
-        kwargs = {'payment_id': self.id, 'secret_uuid': self.secret_uuid}
-        return_url = reverse('paypal-adaptive-payment-return', kwargs=kwargs)
-        return "http://%s%s" % (current_site, return_url)
+    def get_cancel_url(self, request=None):
+        return url_builder.build('paypal-adaptive-payment-cancel',
+                                 request=request, payment_id=self.id,
+                                 secret_uuid=self.secret_uuid)
 
-    @property
-    def cancel_url(self):
-        current_site = Site.objects.get_current()
-        kwargs = {'payment_id': self.id, 'secret_uuid': self.secret_uuid}
-        cancel_url = reverse('paypal-adaptive-payment-cancel', kwargs=kwargs)
-        return "http://%s%s" % (current_site, cancel_url)
+    cancel_url = property(get_cancel_url)
 
     @transaction.autocommit
-    def process(self, receivers, preapproval=None, **kwargs):
-        """Process the payment"""
+    def process(self, receivers, preapproval=None, deadline=None,
+                request=None, **kwargs):
+        """
+        Process the payment. If request is given the return, cancel and IPN
+        urls are on its host.
+
+        """
+
+        endpoint_kwargs = self.get_pay_kwargs(
+            receivers, preapproval=preapproval, deadline=deadline,
+            request=request, **kwargs)
+
+        # Call endpoint
+        try:
+            res, endpoint = self.call(api.Pay, **endpoint_kwargs)
+        except api.TransportError:
+            if self.tracking_id:
+                # Paypal may have got it, update() looks it up by trackingId
+                self.transition('created')
+            raise
+
+        return self.apply_pay_response(endpoint)
+
+    def get_pay_kwargs(self, receivers, preapproval=None, deadline=None,
+                       request=None, **kwargs):
+        """Arguments of the Pay call made by process()"""
+
+        return_url = self.get_return_url(request)
+        cancel_url = self.get_cancel_url(request)
 
         endpoint_kwargs = {'money': self.money,
-                           'return_url': self.return_url,
-                           'cancel_url': self.cancel_url}
+                           'return_url': return_url,
+                           'cancel_url': cancel_url,
+                           'deadline': deadline}
 
         # Update return_url with ?next param
         if 'next' in kwargs:
-            return_next = "%s?next=%s" % (self.return_url, kwargs.pop('next'))
+            return_next = "%s?next=%s" % (return_url, kwargs.pop('next'))
             endpoint_kwargs.update({'return_url': return_next})
 
         # Update cancel_url
         if 'cancel' in kwargs:
-            return_cancel = "%s?next=%s" % (self.cancel_url,
-                                            kwargs.pop('cancel'))
+            return_cancel = "%s?next=%s" % (cancel_url, kwargs.pop('cancel'))
             endpoint_kwargs.update({'cancel_url': return_cancel})
 
         # Set ipn_url
         if settings.USE_IPN:
-            endpoint_kwargs.update({'ipn_url': self.ipn_url})
+            endpoint_kwargs.update({'ipn_url': self.get_ipn_url(request)})
 
         # Append extra arguments
         endpoint_kwargs.update(**kwargs)
@@ -213,64 +536,83 @@ class Payment(PaypalAdaptive):
             key = preapproval.preapproval_key
             endpoint_kwargs.update({'preapprovalKey': key})
 
+        if self.tracking_id:
+            endpoint_kwargs.update({'trackingId': self.tracking_id})
+
         # Append extra arguments
         endpoint_kwargs.update(kwargs)
 
-        # Call endpoint
-        res, endpoint = self.call(api.Pay, **endpoint_kwargs)
+        return endpoint_kwargs
+
+    def apply_pay_response(self, endpoint):
+        """
+        Persist the outcome of a called Pay endpoint. Returns whether the
+        payment was created or completed.
 
-        self.pay_key = endpoint.paykey
+        """
+
+        status_detail = self.status_detail
 
         if endpoint.status == 'ERROR':
-            self.status = 'error'
+            status = 'error'
             if 'payErrorList' in endpoint.response:
                 if 'payError' in endpoint.response['payErrorList']:
                     payError = endpoint.response[
                         'payErrorList']['payError'][0]['error']
-                    self.status_detail = "%s %s: %s" % (
+                    status_detail = "%s %s: %s" % (
                         payError['severity'],
                         payError['errorId'],
                         payError['message'])
                 else:
-                    self.status_detail = json.dumps(
+                    status_detail = json.dumps(
                         endpoint.response.payErrorList)
 
         elif endpoint.status == 'COMPLETED':
-            self.status = 'completed'
+            status = 'completed'
         elif endpoint.paykey or endpoint.status == 'CREATED':
-            self.status = 'created'
+            status = 'created'
         else:
-            self.status = 'error'
-            
-        self.save()
-        
+            status = 'error'
+
+        self.transition(status, pay_key=endpoint.paykey,
+                        status_detail=status_detail,
+                        audit_record=self.audit_record)
+
         return self.status in ['created', 'completed']
 
     @transaction.autocommit
-    def refund(self):
-        """Refund this payment"""
+    def refund(self, receivers=None, deadline=None):
+        """
+        Refund this payment in full, or only the amounts of the given
+        receivers (a ReceiverList). Returns the Refund, which is completed
+        if Paypal refunded every receiver.
 
-        # TODO: flow should create a Refund object and call Refund.process()
+        """
 
-        self.save()
-        
         if self.status != 'completed':
             raise ValueError('Cannot refund a Payment until it is completed.')
 
-        res, refund_call = self.call(api.Refund, self.pay_key)
-
-        self.status = 'refunded'
-        self.save()
-    
-        refund = Refund(payment=self,
-                        debug_request=json.dumps(refund_call.data),
-                        debug_response=refund_call.raw_response)
+        # nobody else can see the refund yet, so it's saved as created
+        refund = Refund.for_payment(self, receivers, status='created')
         refund.save()
+        refund.process(deadline=deadline)
+
+        return refund
 
     def get_update_kwargs(self):
-        if not self.pay_key:
-            raise ValueError("Can't update unprocessed payments")
-        return {'payKey': self.pay_key}
+        if self.pay_key:
+            return {'payKey': self.pay_key}
+        if self.tracking_id and self.status == 'created':
+            # a Pay call whose answer was lost
+            return {'trackingId': self.tracking_id}
+        raise ValueError("Can't update unprocessed payments")
+
+    def parse_update(self, response, fields):
+        values = super(Payment, self).parse_update(response, fields)
+        if not self.pay_key and response.get('payKey'):
+            # looked up by trackingId
+            values['pay_key'] = response['payKey']
+        return values
 
     def _parse_update_status(self, response):
         status = response.get('status', None)
@@ -304,12 +646,196 @@ class Refund(PaypalAdaptive):
         ('completed', _(u'Completed')),
     )
 
-    payment = models.OneToOneField(Payment)
+    STATUS_TRANSITIONS = {
+        'new': ('created', 'completed', 'error', 'canceled'),
+        'created': ('returned', 'completed', 'error', 'canceled'),
+        'returned': ('completed', 'error', 'canceled'),
+        'error': ('created', 'completed', 'canceled'),
+        'canceled': (),
+        'completed': (),
+    }
+
+    payment = models.ForeignKey(Payment, related_name='refunds')
     status = models.CharField(_(u'status'), max_length=10,
                               choices=STATUS_CHOICES, default='new')
     status_detail = models.CharField(_(u'detailed status'), max_length=2048)
-    
-    # TODO: finish model
+    # JSON list of the emails and amounts to refund, blank for a full refund
+    receiver_amounts = models.TextField(_(u'receiver amounts'), blank=True)
+
+    objects = RefundManager()
+
+    @classmethod
+    def for_payment(cls, payment, receivers=None, **kwargs):
+        """
+        Build a refund of payment, in full or of the amounts of the given
+        receivers (a ReceiverList). It isn't saved.
+
+        """
+
+        refund = cls(payment=payment, **kwargs)
+
+        if receivers is None:
+            refund.money = payment.money
+        else:
+            if not isinstance(receivers, api.ReceiverList):
+                raise ValueError("receivers must be an instance of "
+                                 "ReceiverList")
+            refund.money = Money(receivers.total_amount,
+                                 payment.money.currency)
+            refund.receiver_amounts = json.dumps(
+                [{'email': r.email, 'amount': str(r.amount)}
+                 for r in receivers.receivers])
+
+        return refund
+
+    @property
+    def receivers(self):
+        """ReceiverList of a partial refund, None for a full refund"""
+
+        if not self.receiver_amounts:
+            return None
+
+        return api.ReceiverList([
+            api.Receiver(email=r['email'], amount=r['amount'])
+            for r in json.loads(self.receiver_amounts)])
+
+    def get_endpoint_kwargs(self):
+        kwargs = {}
+        receivers = self.receivers
+
+        if receivers is not None:
+            kwargs.update(receivers=receivers,
+                          currency_code=self.money.currency.code)
+
+        return kwargs
+
+    @transaction.autocommit
+    def process(self, deadline=None):
+        """Refund the payment on Paypal. Returns whether it went through."""
+
+        if self.payment.status != 'completed':
+            raise ValueError('Cannot refund a Payment until it is completed.')
+
+        if self.status != 'created' and not self.transition('created'):
+            return self.status == 'completed'
+
+        try:
+            res, endpoint = self.call(api.Refund, self.payment.pay_key,
+                                      deadline=deadline,
+                                      **self.get_endpoint_kwargs())
+        except api.TransportError, e:
+            # Paypal may have refunded it all the same
+            details = self.look_up(deadline=deadline)
+            if details is not None and self.refunded_on_paypal(details):
+                return self.apply_details(details)
+            self.apply_response(None, error=e)
+            raise
+        except api.PaypalAdaptiveApiError, e:
+            self.apply_response(None, error=e)
+            raise
+
+        return self.apply_response(endpoint)
+
+    def look_up(self, deadline=None):
+        """
+        Fresh PaymentDetails of the payment, to tell whether a Refund call
+        that may have reached Paypal went through. Returns None if Paypal
+        couldn't be asked.
+
+        """
+
+        self.payment.invalidate_details_cache()
+        details = api.PaymentDetails(payKey=self.payment.pay_key,
+                                     deadline=deadline)
+        try:
+            details.call()
+        except api.PaypalAdaptiveApiError, e:
+            logger.warning('Could not look up payment %s of refund %s: %s'
+                           % (self.payment.pay_key, self.pk, e))
+            return None
+        return details
+
+    def refunded_on_paypal(self, details):
+        """
+        Whether details, the PaymentDetails returned by look_up(), show
+        this refund went through. For a partial refund the amounts of the
+        payment's other completed partial refunds are read from the
+        database.
+
+        """
+
+        payment_info = details.payment_info
+        if not payment_info:
+            return False
+
+        if self.receivers is None:
+            return all(info.get('transactionStatus') == 'REFUNDED'
+                       for info in payment_info)
+
+        expected = defaultdict(Decimal)
+        others = self.payment.refunds.filter(status='completed').exclude(
+            pk=self.pk).exclude(receiver_amounts='')
+        for refund in [self] + list(others):
+            for receiver in refund.receivers.receivers:
+                expected[receiver.email] += Decimal(str(receiver.amount))
+
+        refunded = dict(
+            (info.get('receiver', {}).get('email'),
+             Decimal(info.get('refundedAmount') or '0'))
+            for info in payment_info)
+        return all(refunded.get(email, Decimal('0')) >= amount
+                   for email, amount in expected.iteritems())
+
+    def apply_details(self, details):
+        """
+        Mark this refund completed after refunded_on_paypal() found it went
+        through, and the payment refunded if it now is in full. Returns
+        whether the refund is completed.
+
+        """
+
+        self.transition('completed', audit_record=self.audit_record,
+                        status_detail=u'Found refunded on Paypal')
+        self.payment.invalidate_details_cache()
+        if all(info.get('transactionStatus') == 'REFUNDED'
+               for info in details.payment_info):
+            self.payment.transition('refunded')
+
+        return self.status == 'completed'
+
+    def apply_response(self, endpoint, error=None):
+        """
+        Persist the outcome of a Refund call for this refund, the called
+        endpoint or the error it raised, and mark the payment refunded once
+        it has been refunded in full. Returns whether the refund went
+        through.
+
+        """
+
+        if error is not None:
+            self.transition('error', audit_record=self.audit_record,
+                            status_detail=force_unicode(
+                                error, errors='replace')[:2048])
+            return False
+
+        status = 'completed' if endpoint.refunded else 'error'
+        status_detail = u', '.join(
+            u'%s: %s' % (info.get('receiver', {}).get('email'),
+                         info.get('refundStatus'))
+            for info in endpoint.refund_info)
+
+        self.transition(status, status_detail=status_detail[:2048],
+                        audit_record=self.audit_record)
+
+        if status == 'completed':
+            self.payment.invalidate_details_cache()
+            if self.receivers is None or endpoint.refund_has_become_full:
+                self.payment.transition('refunded')
+
+        return status == 'completed'
+
+    def __unicode__(self):
+        return u'Refund of %s' % self.payment_id
 
 
 class Preapproval(PaypalAdaptive):
@@ -329,96 +855,106 @@ class Preapproval(PaypalAdaptive):
         ('used', _(u'Used')),
         ('returned', _(u'Returned')),
     )
-    
+
+    STATUS_TRANSITIONS = {
+        'new': ('created', 'error'),
+        'created': ('returned', 'approved', 'used', 'canceled', 'error'),
+        'returned': ('approved', 'used', 'canceled', 'error'),
+        'error': ('created', 'approved', 'canceled'),
+        'approved': ('used', 'canceled'),
+        'used': (),
+        'canceled': (),
+    }
+
     valid_until_date = models.DateTimeField(_(u'valid until'),
                                             default=default_valid_date)
-    preapproval_key = models.CharField(_(u'preapprovalkey'), max_length=255)
+    preapproval_key = models.CharField(_(u'preapprovalkey'), max_length=255,
+                                       db_index=True)
     status = models.CharField(_(u'status'), max_length=10,
                               choices=STATUS_CHOICES, default='new')
     status_detail = models.CharField(_(u'detailed status'), max_length=2048)
 
-    def save(self, *args, **kwargs):
-        is_new = self.id is None
+    objects = PreapprovalManager()
 
-        super(Preapproval, self).save(*args, **kwargs)
+    def get_return_url(self, request=None):
+        return url_builder.build('paypal-adaptive-preapproval-return',
+                                 request=request, preapproval_id=self.id,
+                                 secret_uuid=self.secret_uuid)
 
-        if settings.USE_DELAYED_UPDATES and is_new:
-            from .tasks import update_preapproval
-            update_preapproval.apply_async(
-                args=[self.id],
-                eta=datetime.now() + settings.DELAYED_UPDATE_COUNTDOWN)
+    return_url = property(get_return_url)
 
-    @property
-    def return_url(self):
-        current_site = Site.objects.get_current()
-        kwargs = {'preapproval_id': self.id, 'secret_uuid': self.secret_uuid}
-        return_url = reverse('paypal-adaptive-preapproval-return',
-                             kwargs=kwargs)
-        return "http://%s%s" % (current_site, return_url)
+    def get_cancel_url(self, request=None):
+        return url_builder.build('paypal-adaptive-preapproval-cancel',
+                                 request=request, preapproval_id=self.id)
 
-    @property
-    def cancel_url(self):
-        current_site = Site.objects.get_current()
-        kwargs = {'preapproval_id': self.id}
-        cancel_url = reverse('paypal-adaptive-preapproval-cancel',
-                             kwargs=kwargs)
-        return "http://%s%s" % (current_site, cancel_url)
+    cancel_url = property(get_cancel_url)
 
     @transaction.autocommit
-    def process(self, **kwargs):
-        """Process the preapproval"""
+    def process(self, deadline=None, request=None, **kwargs):
+        """
+        Process the preapproval. If request is given the return, cancel and
+        IPN urls are on its host.
+
+        """
+
+        return_url = self.get_return_url(request)
+        cancel_url = self.get_cancel_url(request)
 
         endpoint_kwargs = {'money': self.money,
-                           'return_url': self.return_url,
-                           'cancel_url': self.cancel_url,
+                           'return_url': return_url,
+                           'cancel_url': cancel_url,
                            'starting_date': self.created_date,
-                           'ending_date': self.valid_until_date}
+                           'ending_date': self.valid_until_date,
+                           'deadline': deadline}
 
         if 'next' in kwargs:
-            return_next = "%s?next=%s" % (self.return_url, kwargs.pop('next'))
+            return_next = "%s?next=%s" % (return_url, kwargs.pop('next'))
             endpoint_kwargs.update({'return_url': return_next})
 
         if 'cancel' in kwargs:
-            return_cancel = "%s?next=%s" % (self.cancel_url,
-                                            kwargs.pop('cancel'))
+            return_cancel = "%s?next=%s" % (cancel_url, kwargs.pop('cancel'))
             endpoint_kwargs.update({'cancel_url': return_cancel})
 
         if settings.USE_IPN:
-            endpoint_kwargs.update({'ipn_url': self.ipn_url})
+            endpoint_kwargs.update({'ipn_url': self.get_ipn_url(request)})
 
         # Append extra arguments
         endpoint_kwargs.update(**kwargs)
 
         res, preapprove = self.call(api.Preapprove, **endpoint_kwargs)
-    
+
         if preapprove.preapprovalkey:
-            self.preapproval_key = preapprove.preapprovalkey
-            self.status = 'created'
+            self.transition('created',
+                            preapproval_key=preapprove.preapprovalkey,
+                            audit_record=self.audit_record)
         else:
-            self.status = 'error'
-            
-        self.save()
-        
+            self.transition('error', audit_record=self.audit_record)
+
         return self.status == 'created'
         
     @transaction.autocommit
     def cancel_preapproval(self):
         res, cancel = self.call(api.CancelPreapproval,
                                 preapproval_key=self.preapproval_key)
+        self.invalidate_details_cache()
 
         # TODO: validate response
 
-        self.status = 'canceled'
-        self.save()
+        self.transition('canceled', audit_record=self.audit_record)
         return self.status == 'canceled'
         
     @transaction.autocommit
     def mark_as_used(self):
-        self.status = 'used'
-        self.save()
-        
+        self.transition('used')
+
         return self.status == 'used'
 
+    @property
+    def settlement_tracking_id(self):
+        """trackingId of the Payment made from this preapproval by settle()"""
+
+        return 'PA%s-%s' % (self.pk, self.secret_uuid[:12])
+
     def get_update_kwargs(self):
         if self.preapproval_key is None:
             raise ValueError("Can't update unprocessed preapprovals")
@@ -0,0 +1,263 @@
+"""
+Applying IPNs to Payments and Preapprovals, either right away from the IPN
+view or later from IPN messages stored by it
+
+"""
+
+import logging
+from datetime import datetime
+
+from django.db.models import F
+from django.http import QueryDict
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_unicode
+
+import metrics
+import settings
+from api import IpnError, TransportError
+from api.ipn import IPN, constants
+from managers import run_bulk
+from models import IPNMessage, Payment, Preapproval
+
+
+logger = logging.getLogger(__name__)
+
+PROCESSED = 'processed'
+NOT_FOUND = 'not_found'
+SECRET_MISMATCH = 'secret_mismatch'
+UNKNOWN_TYPE = 'unknown_type'
+
+OBJECT_CLASSES = {
+    constants.IPN_TYPE_PAYMENT: Payment,
+    constants.IPN_TYPE_PREAPPROVAL: Preapproval,
+    constants.IPN_TYPE_ADJUSTMENT: Payment
+}
+
+
+def precheck(post, object_id, object_secret_uuid):
+    """
+    Cheap checks of an IPN before it's verified with Paypal: that its
+    transaction_type is known, that the object exists and that the secret
+    matches. Returns None if it passes, otherwise UNKNOWN_TYPE, NOT_FOUND or
+    SECRET_MISMATCH, which are counted in the ipn.rejected.<reason> metrics.
+
+    """
+
+    object_class = OBJECT_CLASSES.get(post.get('transaction_type', ''))
+
+    if object_class is None:
+        reason = UNKNOWN_TYPE
+    else:
+        secrets = list(object_class.objects.filter(pk=object_id)
+                       .values_list('secret_uuid', flat=True)[:1])
+        if not secrets:
+            reason = NOT_FOUND
+        elif not constant_time_compare(secrets[0], object_secret_uuid):
+            reason = SECRET_MISMATCH
+        else:
+            return None
+
+    metrics.incr('ipn.rejected.%s' % reason)
+    logger.warning('Rejected IPN for object ID %s before verifying it: %s'
+                   % (object_id, reason))
+    return reason
+
+
+def apply_ipn(ipn, object_id, object_secret_uuid):
+    """
+    Apply a verified IPN to the object it was sent for. Returns PROCESSED,
+    or NOT_FOUND or SECRET_MISMATCH when it couldn't be applied.
+
+    """
+
+    object_class = OBJECT_CLASSES[ipn.type]
+
+    try:
+        obj = object_class.objects.get(pk=object_id)
+    except object_class.DoesNotExist:
+        logger.warning('Could not find %s ID %s for IPN'
+                       % (object_class.__name__, object_id))
+        return NOT_FOUND
+
+    if obj.secret_uuid != object_secret_uuid:
+        obj.transition('error', status_detail=(
+            'IPN secret "%s" did not match db' % object_secret_uuid))
+        return SECRET_MISMATCH
+
+    # Paypal's view of the object just changed
+    obj.invalidate_details_cache()
+
+    # IPN type-specific operations
+    status = None
+    values = {}
+
+    if ipn.type == constants.IPN_TYPE_PAYMENT:
+        values['transaction_id'] = ipn.transactions[0].id
+
+        if obj.money != ipn.transactions[0].amount:
+            status = 'error'
+            values['status_detail'] = (
+                "IPN amounts didn't match. Payment requested %s. Payment "
+                "made %s" % (obj.money, ipn.transactions[0].amount))
+
+        # check payment status
+        elif ipn.status != 'COMPLETED':
+            status = 'error'
+            values['status_detail'] = 'PayPal status was "%s"' % ipn.status
+        else:
+            status = 'completed'
+
+            # TODO: mark preapproval 'used'
+    elif ipn.type == constants.IPN_TYPE_PREAPPROVAL:
+        if obj.money != ipn.max_total_amount_of_all_payments:
+            status = 'error'
+            values['status_detail'] = (
+                "IPN amounts didn't match. Preapproval requested %s. "
+                "Preapproval made %s"
+                % (obj.money, ipn.max_total_amount_of_all_payments))
+        elif ipn.status == constants.IPN_STATUS_CANCELED:
+            status = 'canceled'
+            values['status_detail'] = 'Cancellation received via IPN'
+        elif not ipn.approved:
+            status = 'error'
+            values['status_detail'] = "The preapproval is not approved"
+        else:
+            status = 'approved'
+    else:
+        logger.warning(
+            'No action found for IPN Type "%s" with status "%s" (id: "%s", '
+            'secret_uuid: %s)'
+            % (ipn.type, ipn.status, obj.id, obj.secret_uuid))
+
+    if status is not None and not obj.transition(status, **values):
+        # e.g. a late or repeated IPN for a completed payment, the final
+        # state wins
+        logger.warning('Ignored IPN changing %s %s from %s to %s'
+                       % (object_class.__name__, obj.id, obj.status, status))
+
+    return PROCESSED
+
+
+def stored_body(request):
+    """
+    The body of an IPN request as it's stored. Multipart posts are form
+    encoded again, as the stored body is parsed without its content type.
+
+    """
+
+    # read the body before anything parses the request stream
+    body = request.body
+    if request.META.get('CONTENT_TYPE', '').startswith('multipart/'):
+        return request.POST.urlencode()
+    return body
+
+
+class StoredRequest(object):
+    """The parts of a request IPN needs, rebuilt from a stored body"""
+
+    def __init__(self, body):
+        self.body = body
+        self.POST = QueryDict(body)
+
+    def __str__(self):
+        return self.body
+
+
+def verify_message(message):
+    """
+    Verify a stored IPN message with Paypal. Returns the IPN and None, or
+    None and the error verifying it raised.
+
+    """
+
+    try:
+        return IPN(StoredRequest(message.body),
+                   deadline=settings.IPN_VERIFY_DEADLINE), None
+    except (IpnError, TransportError), e:
+        return None, e
+    except Exception, e:
+        # e.g. a body that doesn't parse, keep going with the rest
+        logger.exception('Could not verify IPN message %s' % message.pk)
+        return None, e
+
+
+def apply_message(message, ipn, error=None):
+    """
+    Apply a claimed message that verify_message returned ipn or error for,
+    and record the outcome on it. Returns the message's new status:
+    'processed', 'rejected', 'failed' or 'new' when Paypal couldn't verify
+    it now and it should be tried again.
+
+    """
+
+    values = {}
+
+    if isinstance(error, TransportError):
+        values['attempts'] = F('attempts') + 1
+        if message.attempts + 1 < settings.IPN_MAX_ATTEMPTS:
+            status = 'new'
+        else:
+            status = 'failed'
+    elif isinstance(error, IpnError):
+        logger.warning('IPN message %s failed verification: %s'
+                       % (message.pk, error))
+        status = 'rejected'
+        values['verified'] = False
+    elif error is not None:
+        status = 'failed'
+    else:
+        values['verified'] = True
+        try:
+            outcome = apply_ipn(ipn, message.object_id,
+                                message.object_secret_uuid)
+        except Exception, e:
+            logger.exception('Could not apply IPN message %s' % message.pk)
+            status, error = 'failed', e
+        else:
+            if outcome == PROCESSED:
+                status = 'processed'
+                values['processed_date'] = datetime.now()
+            else:
+                status, error = 'rejected', outcome
+
+    _record(message, status, error, **values)
+    return status
+
+
+def _record(message, status, error=None, **values):
+    message.status = status
+    message.error = force_unicode(error or u'', errors='replace')[:2048]
+
+    # a worker that took over a timed out claim owns the message now
+    IPNMessage.objects.filter(pk=message.pk,
+                              claim_token=message.claim_token
+                              ).update(status=message.status,
+                                       error=message.error, **values)
+
+
+def process_ipn_messages(batch_size=None, max_workers=None):
+    """
+    Verify and apply a batch of stored IPN messages. Verification calls
+    are made on up to max_workers threads, everything else happens in the
+    calling thread. Returns the number of messages per outcome.
+
+    """
+
+    stats = dict.fromkeys(['processed', 'rejected', 'retried', 'failed'], 0)
+    messages = []
+
+    for message in IPNMessage.objects.claim(batch_size):
+        reason = precheck(QueryDict(message.body), message.object_id,
+                          message.object_secret_uuid)
+        if reason is None:
+            messages.append(message)
+        else:
+            _record(message, 'rejected', reason)
+            stats['rejected'] += 1
+
+    def handle(message, result):
+        status = apply_message(message, *result)
+        stats['retried' if status == 'new' else status] += 1
+
+    run_bulk(messages, verify_message, handle, max_workers=max_workers)
+    return stats
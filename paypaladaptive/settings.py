@@ -19,6 +19,13 @@ else:
 
     PAYPAL_APPLICATION_ID = settings.PAYPAL_APPLICATION_ID
 
+# Point these elsewhere, e.g. at paypaladaptive.fake_server, to test offline
+PAYPAL_ENDPOINT = getattr(settings, 'PAYPAL_ENDPOINT', PAYPAL_ENDPOINT)
+PAYPAL_PAYMENT_HOST = getattr(settings, 'PAYPAL_PAYMENT_HOST',
+                              PAYPAL_PAYMENT_HOST)
+EMBEDDED_ENDPOINT = getattr(settings, 'PAYPAL_EMBEDDED_ENDPOINT',
+                            EMBEDDED_ENDPOINT)
+
 # These settings are required
 PAYPAL_USERID = settings.PAYPAL_USERID
 PAYPAL_PASSWORD = settings.PAYPAL_PASSWORD
@@ -39,5 +46,121 @@ set_default_currency(code=DEFAULT_CURRENCY)
 DECIMAL_PLACES = getattr(settings, 'PAYPAL_DECIMAL_PLACES', 2)
 MAX_DIGITS = getattr(settings, 'PAYPAL_MAX_DIGITS', 10)
 
+# Persistent connections to Paypal, kept per host
+CONNECTION_POOL_SIZE = getattr(settings, 'PAYPAL_CONNECTION_POOL_SIZE', 10)
+CONNECTION_IDLE_TIMEOUT = getattr(
+    settings, 'PAYPAL_CONNECTION_IDLE_TIMEOUT', 60)
+
+# Number of worker threads of the non-blocking client
+ASYNC_MAX_WORKERS = getattr(settings, 'PAYPAL_ASYNC_MAX_WORKERS', 10)
+
+# Cache PaymentDetails and PreapprovalDetails responses for a number of
+# seconds that depends on the status Paypal reports
+USE_DETAILS_CACHE = getattr(settings, 'PAYPAL_USE_DETAILS_CACHE', False)
+DETAILS_CACHE = getattr(settings, 'PAYPAL_DETAILS_CACHE', 'default')
+DETAILS_CACHE_DEFAULT_TTL = getattr(
+    settings, 'PAYPAL_DETAILS_CACHE_DEFAULT_TTL', 30)
+DETAILS_CACHE_TTLS = getattr(settings, 'PAYPAL_DETAILS_CACHE_TTLS', {
+    'CREATED': 30,
+    'PROCESSING': 30,
+    'PENDING': 30,
+    'INCOMPLETE': 60,
+    'ACTIVE': 60,
+    'ERROR': 300,
+    'REVERSALERROR': 300,
+    'COMPLETED': 3600,
+    'CANCELED': 3600,
+    'DEACTIVED': 3600,
+})
+
+# Let concurrent details lookups of the same key share one call to Paypal.
+# Set SINGLE_FLIGHT_CACHE to a cache alias to share calls across processes.
+USE_SINGLE_FLIGHT = getattr(settings, 'PAYPAL_USE_SINGLE_FLIGHT', True)
+SINGLE_FLIGHT_CACHE = getattr(settings, 'PAYPAL_SINGLE_FLIGHT_CACHE', None)
+SINGLE_FLIGHT_LOCK_TIMEOUT = getattr(
+    settings, 'PAYPAL_SINGLE_FLIGHT_LOCK_TIMEOUT', 60)
+SINGLE_FLIGHT_POLL_INTERVAL = getattr(
+    settings, 'PAYPAL_SINGLE_FLIGHT_POLL_INTERVAL', 0.05)
+
+# Requests and responses kept in the AuditRecord table. Failed calls are
+# always kept, successful ones for a sample of AUDIT_SAMPLE_RATE of them.
+AUDIT_SAMPLE_RATE = getattr(settings, 'PAYPAL_AUDIT_SAMPLE_RATE', 1.0)
+AUDIT_RETENTION = getattr(settings, 'PAYPAL_AUDIT_RETENTION',
+                          timedelta(days=90))
+AUDIT_REDACTED_FIELDS = getattr(settings, 'PAYPAL_AUDIT_REDACTED_FIELDS', (
+    'X-PAYPAL-SECURITY-USERID', 'X-PAYPAL-SECURITY-PASSWORD',
+    'X-PAYPAL-SECURITY-SIGNATURE', 'password', 'signature', 'pin',
+))
+
+# Base of the absolute urls sent to Paypal, e.g. 'https://example.com'.
+# Defaults to URL_SCHEME and the domain of the current Site.
+SITE_URL = getattr(settings, 'PAYPAL_SITE_URL', None)
+URL_SCHEME = getattr(settings, 'PAYPAL_URL_SCHEME', 'http')
+
+# Number of rows written per UPDATE by bulk refreshes
+BULK_UPDATE_BATCH_SIZE = getattr(settings, 'PAYPAL_BULK_UPDATE_BATCH_SIZE', 500)
+
+# Checks of due objects by the sweep_updates task. The interval of a status
+# doubles with every check of the object, up to the max interval.
+SWEEP_CHUNK_SIZE = getattr(settings, 'PAYPAL_SWEEP_CHUNK_SIZE', 100)
+SWEEP_INTERVALS = getattr(settings, 'PAYPAL_SWEEP_INTERVALS', {
+    'created': timedelta(minutes=30),
+    'returned': timedelta(minutes=5),
+    'approved': timedelta(days=1),
+})
+SWEEP_MAX_INTERVAL = getattr(settings, 'PAYPAL_SWEEP_MAX_INTERVAL',
+                             timedelta(days=1))
+SWEEP_MAX_CHECKS = getattr(settings, 'PAYPAL_SWEEP_MAX_CHECKS', 20)
+
+# Seconds a sweep holds the objects it's checking before another sweep may
+# check them
+SWEEP_CLAIM_TIMEOUT = getattr(settings, 'PAYPAL_SWEEP_CLAIM_TIMEOUT', 600)
+
+# Cache holding the leases that keep a single update task per object queued
+UPDATE_LEASE_CACHE = getattr(settings, 'PAYPAL_UPDATE_LEASE_CACHE', 'default')
+UPDATE_LEASE_TIMEOUT = getattr(settings, 'PAYPAL_UPDATE_LEASE_TIMEOUT', 600)
+
+# Calls per second made by bulk refunds, None for no limit
+REFUND_RATE = getattr(settings, 'PAYPAL_REFUND_RATE', 10)
+
+# Pay calls per second made by settling preapprovals, None for no limit
+SETTLEMENT_RATE = getattr(settings, 'PAYPAL_SETTLEMENT_RATE', 10)
+
+# Seconds to wait for a connection to be established and for each read
+CONNECT_TIMEOUT = getattr(settings, 'PAYPAL_CONNECT_TIMEOUT', 10)
+READ_TIMEOUT = getattr(settings, 'PAYPAL_READ_TIMEOUT', 30)
+
+# Retries of calls that are safe to repeat, with exponential backoff
+RETRY_MAX_ATTEMPTS = getattr(settings, 'PAYPAL_RETRY_MAX_ATTEMPTS', 3)
+RETRY_BACKOFF = getattr(settings, 'PAYPAL_RETRY_BACKOFF', 0.5)
+RETRY_MAX_BACKOFF = getattr(settings, 'PAYPAL_RETRY_MAX_BACKOFF', 5)
+RETRY_JITTER = getattr(settings, 'PAYPAL_RETRY_JITTER', 0.5)
+
+# Stop calling Paypal for BREAKER_RESET_TIMEOUT seconds after
+# BREAKER_FAILURE_THRESHOLD failed or slow calls within BREAKER_WINDOW seconds
+USE_CIRCUIT_BREAKER = getattr(settings, 'PAYPAL_USE_CIRCUIT_BREAKER', True)
+BREAKER_FAILURE_THRESHOLD = getattr(
+    settings, 'PAYPAL_BREAKER_FAILURE_THRESHOLD', 5)
+BREAKER_WINDOW = getattr(settings, 'PAYPAL_BREAKER_WINDOW', 60)
+BREAKER_RESET_TIMEOUT = getattr(settings, 'PAYPAL_BREAKER_RESET_TIMEOUT', 30)
+BREAKER_SLOW_CALL_THRESHOLD = getattr(
+    settings, 'PAYPAL_BREAKER_SLOW_CALL_THRESHOLD', 10)
+BREAKER_HALF_OPEN_PROBES = getattr(
+    settings, 'PAYPAL_BREAKER_HALF_OPEN_PROBES', 2)
+BREAKER_CACHE = getattr(settings, 'PAYPAL_BREAKER_CACHE', 'default')
+
+# Total number of seconds an IPN verification call may take, None to only
+# apply the connect and read timeouts
+IPN_VERIFY_DEADLINE = getattr(settings, 'PAYPAL_IPN_VERIFY_DEADLINE', None)
+
+# Store incoming IPNs and verify and apply them later in batches
+ASYNC_IPN = getattr(settings, 'PAYPAL_ASYNC_IPN', False)
+IPN_BATCH_SIZE = getattr(settings, 'PAYPAL_IPN_BATCH_SIZE', 100)
+IPN_MAX_ATTEMPTS = getattr(settings, 'PAYPAL_IPN_MAX_ATTEMPTS', 5)
+IPN_CLAIM_TIMEOUT = getattr(settings, 'PAYPAL_IPN_CLAIM_TIMEOUT', 300)
+
+# Age after which processed, rejected and failed IPN messages may be deleted
+IPN_RETENTION = getattr(settings, 'PAYPAL_IPN_RETENTION', timedelta(days=30))
+
 # Should tests hit Paypaladaptive or not? Defaults to using mock responses
 TEST_WITH_MOCK = getattr(settings, 'PAYPAL_TEST_WITH_MOCK', True)
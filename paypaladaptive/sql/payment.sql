@@ -0,0 +1,4 @@
+-- Composite index for status lookups, e.g. Payment.objects.stale(). Django
+-- runs this after creating the table; see the README for existing tables.
+CREATE INDEX paypaladaptive_payment_status_created_date
+    ON paypaladaptive_payment (status, created_date);
@@ -0,0 +1,5 @@
+-- Composite index for status lookups, e.g. Preapproval.objects.stale().
+-- Django runs this after creating the table; see the README for existing
+-- tables.
+CREATE INDEX paypaladaptive_preapproval_status_created_date
+    ON paypaladaptive_preapproval (status, created_date);
@@ -1,22 +1,119 @@
+import uuid
+
+from django.core.cache import get_cache
+
 from celery.task import task
 from celery.utils.log import get_task_logger
 
-from .models import Preapproval, Payment
+from . import metrics, settings
+from .models import AuditRecord, IPNMessage, Preapproval, Payment
+from .processing import process_ipn_messages as _process_ipn_messages
 
 logger = get_task_logger(__name__)
 
+_lease_cache = None
+
+
+def _get_lease_cache():
+    global _lease_cache
+    if _lease_cache is None:
+        _lease_cache = get_cache(settings.UPDATE_LEASE_CACHE)
+    return _lease_cache
+
+
+def _lease_key(model, object_id):
+    return 'paypaladaptive:update:%s:%s' % (model._meta.module_name,
+                                            object_id)
+
+
+def _release(model, object_id, lease):
+    if lease is None:
+        return
+    cache = _get_lease_cache()
+    key = _lease_key(model, object_id)
+    if cache.get(key) == lease:
+        cache.delete(key)
+
+
+def delay_update(obj):
+    """
+    Queue an update task for obj, unless one is already queued or running
+    for it. Returns whether a task was queued.
+
+    """
+
+    if isinstance(obj, Payment):
+        update_task, kwarg = update_payment, 'payment_id'
+    else:
+        update_task, kwarg = update_preapproval, 'preapproval_id'
+
+    lease = uuid.uuid4().hex
+    cache = _get_lease_cache()
+
+    if not cache.add(_lease_key(type(obj), obj.pk), lease,
+                     settings.UPDATE_LEASE_TIMEOUT):
+        metrics.incr('tasks.update.suppressed')
+        logger.debug('Update of %s %s already queued'
+                     % (type(obj).__name__, obj.pk))
+        return False
+
+    try:
+        update_task.delay(**{kwarg: obj.pk, 'lease': lease})
+    except Exception:
+        # nothing was queued to release it, don't block updates until the
+        # lease times out
+        _release(type(obj), obj.pk, lease)
+        raise
+    return True
+
+
+@task
+def update_preapproval(preapproval_id, lease=None):
+    try:
+        preapproval = Preapproval.objects.get(pk=preapproval_id)
+        if preapproval.status != 'used':
+            logger.info('Updating Preapproval %i' % preapproval.id)
+            preapproval.update()
+    finally:
+        _release(Preapproval, preapproval_id, lease)
+
+
+@task
+def update_payment(payment_id, lease=None):
+    try:
+        payment = Payment.objects.get(pk=payment_id)
+        if payment.status != 'completed':
+            logger.info('Updating Payment %i' % payment.id)
+            payment.update()
+    finally:
+        _release(Payment, payment_id, lease)
+
+
+@task
+def sweep_updates():
+    for model in (Payment, Preapproval):
+        stats = model.objects.sweep()
+        logger.info('Swept %s: %i updated, %i unchanged, %i failed'
+                    % (model.__name__, stats['updated'], stats['unchanged'],
+                       stats['failed']))
+
+
+@task
+def process_ipn_messages():
+    stats = _process_ipn_messages()
+    logger.info('Processed IPN messages: %i processed, %i rejected, '
+                '%i retried, %i failed'
+                % (stats['processed'], stats['rejected'], stats['retried'],
+                   stats['failed']))
+
 
 @task
-def update_preapproval(preapproval_id):
-    preapproval = Preapproval.objects.get(pk=preapproval_id)
-    if preapproval.status != 'used':
-        logger.info('Updating Preapproval %i' % preapproval.id)
-        preapproval.update()
+def prune_audit_records():
+    deleted = AuditRecord.objects.prune()
+    logger.info('Pruned %i audit records' % deleted)
 
 
 @task
-def update_payment(payment_id):
-    payment = Payment.objects.get(pk=payment_id)
-    if payment.status != 'completed':
-        logger.info('Updating Payment %i' % payment.id)
-        payment.update()
+def prune_ipn_messages():
+    deleted = IPNMessage.objects.prune()
+    logger.info('Pruned %i IPN messages' % deleted)
@@ -1,5 +1,6 @@
 from tests import AdaptiveTests
-from ipn import TestPaymentIPN, TestPreapprovalIPN, TestIPNVerification
+from ipn import (TestPaymentIPN, TestPreapprovalIPN, TestIPNVerification,
+                 TestIPNTransactions, TestIPNFields, TestIPNPrecheck)
 from preapproval_return_url import TestPreapprovalReturnURL
 from preapproval_cancel import TestPreapprovalCancel
 from preapproval_update import TestPreapprovalUpdate
@@ -7,3 +8,26 @@ from payment import PaymentDBTest
 from payment_return_url import TestPaymentReturnURL
 from payment_response import TestPaymentResponses
 from payment_update import TestPaymentUpdate
+from httpwrapper import (TestConnectionPool, TestUrlRequestPooling,
+                         TestDeadline)
+from retry import TestRetryPolicy, TestEndpointRetries
+from breaker import TestCircuitBreaker, TestEndpointCircuitBreaker
+from client import TestAsyncClient
+from endpoint_state import TestEndpointState
+from bulk import TestBulkRefresh
+from details_cache import TestDetailsCache
+from singleflight import (TestSingleFlight, TestSharedSingleFlight,
+                          TestEndpointSingleFlight)
+from fake_server import TestFakeServer
+from audit import TestAudit, TestAuditRecords
+from queries import TestTransitionQueries, TestUpdateQueries
+from urlbuilder import TestUrlBuilder
+from managers import TestLookupManagers
+from transitions import TestStatusTransitions
+from sweeper import TestSweeper
+from update_tasks import TestUpdateDeduplication
+from refund import (TestRefundEndpoint, TestRateLimiter, TestRefund,
+                    TestBulkRefund)
+from settlement import TestSettlement
+from ipn_async import TestAsyncIPN, TestIPNDeduplication
+from ipn_dates import TestIPNDates
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from mock import patch
+
+from .. import audit
+from ..api import PaymentDetails, PaypalAdaptiveApiError
+from ..models import AuditRecord, Payment
+from .factories import PaymentFactory
+from .payment_update import MockUpdateRequest
+
+
+class TestAudit(TestCase):
+    def testRedact(self):
+        payload = {'payKey': 'AP-1',
+                   'Password': 'secret',
+                   'receiverList': {'receiver': [{'email': 'a@example.com',
+                                                  'pin': '1234'}]}}
+
+        self.assertEqual({'payKey': 'AP-1',
+                          'Password': '[redacted]',
+                          'receiverList': {'receiver': [
+                              {'email': 'a@example.com',
+                               'pin': '[redacted]'}]}},
+                         audit.redact(payload, fields=['password', 'pin']))
+
+    def testRedactJsonKeepsInvalidJson(self):
+        self.assertEqual('<html>', audit.redact_json('<html>'))
+        self.assertEqual(None, audit.redact_json(None))
+
+    def testCompressRoundTrip(self):
+        text = u'{"status": "COMPLETED", "memo": "\\u00e5\\u00e4\\u00f6"}' * 50
+        compressed = audit.compress(text)
+
+        self.assertTrue(len(compressed) < len(text))
+        self.assertEqual(text, audit.decompress(compressed))
+
+    def testSampling(self):
+        self.assertTrue(audit.should_capture(True, sample_rate=0))
+        self.assertFalse(audit.should_capture(False, sample_rate=0))
+        self.assertTrue(audit.should_capture(False, sample_rate=1))
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', MockUpdateRequest)
+class TestAuditRecords(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.payment = PaymentFactory.create(status='created',
+                                             pay_key='AP-123')
+
+    def testCallIsCaptured(self):
+        MockUpdateRequest.set_response({'status': 'COMPLETED'})
+        self.payment.update()
+
+        payment = Payment.objects.get(pk=self.payment.pk)
+        record = payment.audit_record
+
+        self.assertEqual('PaymentDetails', record.endpoint)
+        self.assertFalse(record.failed)
+        self.assertEqual('payment', record.object_type)
+        self.assertEqual(payment.pk, record.object_id)
+        self.assertTrue('AP-123' in payment.debug_request)
+        self.assertTrue('COMPLETED' in payment.debug_response)
+        self.assertEqual([record],
+                         list(AuditRecord.objects.for_object(payment)))
+
+    @patch('paypaladaptive.settings.AUDIT_SAMPLE_RATE', 0)
+    def testSuccessIsSampled(self):
+        MockUpdateRequest.set_response({'status': 'COMPLETED'})
+        self.payment.update()
+
+        self.assertEqual(0, AuditRecord.objects.count())
+        self.assertEqual(None, self.payment.debug_response)
+
+    @patch('paypaladaptive.settings.AUDIT_SAMPLE_RATE', 0)
+    def testFailureIsAlwaysCaptured(self):
+        MockUpdateRequest._response = (
+            '{"responseEnvelope": {"ack": "Failure"}, '
+            '"error": [{"message": "Invalid payKey"}]}')
+
+        with self.assertRaises(PaypalAdaptiveApiError):
+            self.payment.update()
+
+        record = AuditRecord.objects.get()
+        self.assertTrue(record.failed)
+        self.assertEqual('Invalid payKey', record.error)
+
+    def testNonAsciiByteStringError(self):
+        endpoint = PaymentDetails(payKey='AP-123')
+
+        record = AuditRecord.objects.capture(
+            endpoint, error=PaypalAdaptiveApiError('Ung\xc3\xbcltig \xff'))
+
+        self.assertTrue(record.error.startswith(u'Ung'))
+
+    def testPrune(self):
+        MockUpdateRequest.set_response({'status': 'COMPLETED'})
+        self.payment.update()
+        self.payment.update()
+        AuditRecord.objects.filter(pk=self.payment.audit_record_id).update(
+            created_date=datetime.now() - timedelta(days=100))
+
+        self.assertEqual(1, AuditRecord.objects.prune(timedelta(days=90)))
+        self.assertEqual(1, AuditRecord.objects.count())
+        self.assertEqual(None,
+                         Payment.objects.get(pk=self.payment.pk).audit_record)
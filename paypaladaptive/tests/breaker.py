@@ -0,0 +1,132 @@
+import time
+
+from django.core.cache import cache, get_cache
+from django.test import TestCase
+
+from mock import patch
+
+from ..api import PaymentDetails
+from ..api.breaker import CircuitBreaker
+from ..api.errors import CircuitOpenError, TransportError
+from ..api.httpwrapper import UrlResponse
+
+
+class FailingRequest(object):
+    calls = 0
+
+    def call(self, url, data=None, headers=None, deadline=None):
+        FailingRequest.calls += 1
+        self._response = UrlResponse('connection refused', {}, None)
+        return self
+
+    @property
+    def response(self):
+        return self._response.data
+
+    @property
+    def code(self):
+        return self._response.code
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker('test', failure_threshold=2, window=60,
+                                      reset_timeout=30,
+                                      slow_call_threshold=5,
+                                      half_open_probes=2)
+
+    def open_half(self):
+        """Open the breaker as if reset_timeout has already passed"""
+
+        self.breaker.open()
+        cache.set(self.breaker._key('opened_at'), time.time() - 31)
+
+    def fail(self):
+        def function():
+            raise TransportError('down')
+
+        with self.assertRaises(TransportError):
+            self.breaker.call(function)
+
+    def testOpensAfterThreshold(self):
+        self.fail()
+        self.assertEqual('closed', self.breaker.state)
+
+        self.fail()
+        self.assertEqual('open', self.breaker.state)
+
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(lambda: 'not called')
+
+    def testCacheIsResolvedOnce(self):
+        with patch('paypaladaptive.api.breaker.get_cache',
+                   wraps=get_cache) as mock_get_cache:
+            self.fail()
+            self.breaker.call(lambda: 'ok')
+            self.assertEqual('closed', self.breaker.state)
+
+        self.assertEqual(1, mock_get_cache.call_count)
+
+    def testSlowCallsCountAsFailures(self):
+        self.breaker.record_success(duration=6)
+        self.breaker.record_success(duration=6)
+
+        self.assertEqual('open', self.breaker.state)
+
+    def testFailingResultsCountAsFailures(self):
+        for __ in range(2):
+            self.breaker.call(lambda: None, is_failure=lambda r: r is None)
+
+        self.assertEqual('open', self.breaker.state)
+
+    def testHalfOpenProbesCloseBreaker(self):
+        self.open_half()
+        self.assertEqual('half-open', self.breaker.state)
+
+        self.assertEqual('ok', self.breaker.call(lambda: 'ok'))
+        self.assertEqual('half-open', self.breaker.state)
+
+        self.assertEqual('ok', self.breaker.call(lambda: 'ok'))
+        self.assertEqual('closed', self.breaker.state)
+
+    def testFailingProbeReopensBreaker(self):
+        self.open_half()
+        self.fail()
+
+        self.assertEqual('open', self.breaker.state)
+
+    def testLimitsNumberOfProbes(self):
+        self.open_half()
+
+        self.assertTrue(self.breaker.before_call())
+        self.assertTrue(self.breaker.before_call())
+
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+
+@patch('paypaladaptive.api.retry.RetryPolicy.sleep',
+       staticmethod(lambda seconds: None))
+@patch('paypaladaptive.api.endpoints.UrlRequest', FailingRequest)
+class TestEndpointCircuitBreaker(TestCase):
+    def setUp(self):
+        cache.clear()
+        FailingRequest.calls = 0
+
+    def tearDown(self):
+        cache.clear()
+
+    def testEndpointFailsFastWhenOpen(self):
+        breaker = CircuitBreaker('test-endpoint', failure_threshold=2)
+
+        with patch.object(PaymentDetails, 'circuit_breaker', breaker):
+            with self.assertRaises(CircuitOpenError):
+                PaymentDetails(payKey='AP-123').call()
+
+            self.assertEqual(2, FailingRequest.calls)
+
+            with self.assertRaises(CircuitOpenError):
+                PaymentDetails(payKey='AP-123').call()
+
+            self.assertEqual(2, FailingRequest.calls)
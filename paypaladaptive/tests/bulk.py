@@ -0,0 +1,77 @@
+import json
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from mock import patch
+
+from ..api import PaymentDetails, PaypalAdaptiveApiError
+from ..api.httpwrapper import UrlResponse
+from ..models import Payment
+from .factories import PaymentFactory
+
+
+class MockBulkDetailsRequest(object):
+    """Answers with the status that is part of the payKey, AP-<STATUS>-n"""
+
+    def call(self, url, data=None, headers=None, deadline=None):
+        pay_key = json.loads(data)['payKey']
+        status = pay_key.split('-')[1]
+
+        if status == 'FAIL':
+            body = {'responseEnvelope': {'ack': 'Failure'},
+                    'error': [{'message': 'Invalid payKey'}]}
+        else:
+            body = {'responseEnvelope': {'ack': 'Success'},
+                    'status': status}
+
+        self._response = UrlResponse(json.dumps(body), {}, 200)
+        return self
+
+    @property
+    def response(self):
+        return self._response.data
+
+    @property
+    def code(self):
+        return self._response.code
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', MockBulkDetailsRequest)
+class TestBulkRefresh(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def testEndpointBulk(self):
+        keys = ['AP-COMPLETED-1', 'AP-CREATED-2', 'AP-FAIL-3']
+        results = PaymentDetails.bulk(keys, max_workers=2)
+
+        self.assertEqual(set(keys), set(results))
+        self.assertEqual('COMPLETED',
+                         results['AP-COMPLETED-1'].response['status'])
+        self.assertEqual('CREATED', results['AP-CREATED-2'].response['status'])
+        self.assertTrue(isinstance(results['AP-FAIL-3'],
+                                   PaypalAdaptiveApiError))
+
+    def testRefreshFromPaypal(self):
+        completed = [PaymentFactory.create(status='created',
+                                           pay_key='AP-COMPLETED-%s' % n)
+                     for n in range(5)]
+        created = PaymentFactory.create(status='created',
+                                        pay_key='AP-CREATED-1')
+        failing = PaymentFactory.create(status='created', pay_key='AP-FAIL-1')
+        PaymentFactory.create(status='new', pay_key='')
+
+        # one SELECT and a single UPDATE for all completed payments
+        with self.assertNumQueries(2):
+            stats = Payment.objects.filter(
+                status__in=['new', 'created']).refresh_from_paypal(
+                    max_workers=4)
+
+        self.assertEqual({'updated': 5, 'unchanged': 1, 'failed': 1}, stats)
+
+        for payment in completed:
+            self.assertEqual('completed',
+                             Payment.objects.get(pk=payment.pk).status)
+        self.assertEqual('created', Payment.objects.get(pk=created.pk).status)
+        self.assertEqual('created', Payment.objects.get(pk=failing.pk).status)
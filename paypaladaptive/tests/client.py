@@ -0,0 +1,76 @@
+from django.core.cache import cache
+from django.http import HttpRequest
+from django.test import TestCase
+
+from mock import patch
+
+from ..api.client import AsyncClient, as_completed
+from ..api.errors import PaypalAdaptiveApiError
+from ..api.httpwrapper import UrlResponse
+from .helpers import MockIPNVerifyRequest
+
+
+class MockDetailsRequest(object):
+    def call(self, url, data=None, headers=None, deadline=None):
+        if 'AP-FAIL' in data:
+            body = ('{"responseEnvelope": {"ack": "Failure"}, '
+                    '"error": [{"message": "Invalid payKey"}]}')
+        else:
+            body = ('{"responseEnvelope": {"ack": "Success"}, '
+                    '"status": "COMPLETED"}')
+        self._response = UrlResponse(body, {}, 200)
+        return self
+
+    @property
+    def response(self):
+        return self._response.data
+
+    @property
+    def code(self):
+        return self._response.code
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', MockDetailsRequest)
+class TestAsyncClient(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = AsyncClient(max_workers=4)
+
+    def tearDown(self):
+        self.client.shutdown()
+
+    def testPaymentDetails(self):
+        future = self.client.payment_details(payKey='AP-123')
+        endpoint = future.result(timeout=5)
+
+        self.assertEqual('COMPLETED', endpoint.response['status'])
+
+    def testErrorsAreRaisedThroughFuture(self):
+        future = self.client.payment_details(payKey='AP-FAIL')
+
+        with self.assertRaises(PaypalAdaptiveApiError):
+            future.result(timeout=5)
+
+    def testInvalidArgumentsRaiseImmediately(self):
+        with self.assertRaises(PaypalAdaptiveApiError):
+            self.client.payment_details()
+
+    def testManyCalls(self):
+        futures = [self.client.payment_details(payKey='AP-123')
+                   for __ in range(20)]
+
+        results = [f.result() for f in as_completed(futures, timeout=5)]
+        self.assertEqual(20, len(results))
+
+    @patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+           MockIPNVerifyRequest)
+    def testVerifyIPN(self):
+        request = HttpRequest()
+        request.POST = {'transaction_type': 'Adaptive Payment PAY',
+                        'status': 'COMPLETED',
+                        'currency_code': 'USD',
+                        'max_total_amount_of_all_payments': '10.00'}
+
+        ipn = self.client.verify_ipn(request).result(timeout=5)
+
+        self.assertEqual('COMPLETED', ipn.status)
@@ -0,0 +1,114 @@
+import json
+
+from django.core.cache import cache, get_cache
+from django.test import TestCase
+
+from mock import patch
+
+from .. import metrics
+from ..api import PaymentDetails, PreapprovalDetails, PaypalAdaptiveApiError
+from ..api.details_cache import DetailsCache
+from ..api.httpwrapper import UrlResponse
+
+
+class CountingDetailsRequest(object):
+    """Answers with `status` and counts the calls made"""
+
+    calls = 0
+    status = 'CREATED'
+    ack = 'Success'
+
+    def call(self, url, data=None, headers=None, deadline=None):
+        CountingDetailsRequest.calls += 1
+        body = {'responseEnvelope': {'ack': CountingDetailsRequest.ack},
+                'status': CountingDetailsRequest.status}
+        self._response = UrlResponse(json.dumps(body), {}, 200)
+        return self
+
+    @property
+    def response(self):
+        return self._response.data
+
+    @property
+    def code(self):
+        return self._response.code
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', CountingDetailsRequest)
+@patch.object(PaymentDetails, 'details_cache',
+              DetailsCache('payment', ttls={'CREATED': 30, 'ERROR': 0}))
+class TestDetailsCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        CountingDetailsRequest.calls = 0
+        CountingDetailsRequest.status = 'CREATED'
+        CountingDetailsRequest.ack = 'Success'
+
+    def testSecondLookupIsCached(self):
+        first = PaymentDetails(payKey='AP-1')
+        first.call()
+        second = PaymentDetails(payKey='AP-1')
+        second.call()
+
+        self.assertEqual(1, CountingDetailsRequest.calls)
+        self.assertFalse(first.cached)
+        self.assertTrue(second.cached)
+        self.assertEqual('CREATED', second.response['status'])
+        self.assertEqual(1, metrics.get('api.details_cache.hits'))
+        self.assertEqual(1, metrics.get('api.details_cache.misses'))
+
+    def testKeysAreCachedSeparately(self):
+        PaymentDetails(payKey='AP-1').call()
+        PaymentDetails(payKey='AP-2').call()
+
+        self.assertEqual(2, CountingDetailsRequest.calls)
+
+    def testZeroTtlIsNotCached(self):
+        CountingDetailsRequest.status = 'ERROR'
+        PaymentDetails(payKey='AP-1').call()
+        PaymentDetails(payKey='AP-1').call()
+
+        self.assertEqual(2, CountingDetailsRequest.calls)
+
+    def testFailuresAreNotCached(self):
+        CountingDetailsRequest.ack = 'Failure'
+
+        for __ in range(2):
+            with self.assertRaises(PaypalAdaptiveApiError):
+                PaymentDetails(payKey='AP-1').call()
+
+        self.assertEqual(2, CountingDetailsRequest.calls)
+
+    def testInvalidate(self):
+        PaymentDetails(payKey='AP-1').call()
+        PaymentDetails.invalidate_cache('AP-1')
+        PaymentDetails(payKey='AP-1').call()
+
+        self.assertEqual(2, CountingDetailsRequest.calls)
+
+    def testOtherEndpointsAreNotCached(self):
+        self.assertEqual(None, PreapprovalDetails.details_cache)
+        PreapprovalDetails(preapprovalKey='PA-1').call()
+        PreapprovalDetails(preapprovalKey='PA-1').call()
+
+        self.assertEqual(2, CountingDetailsRequest.calls)
+
+    def testTtlDependsOnStatus(self):
+        details_cache = DetailsCache('payment', ttls={'COMPLETED': 3600},
+                                     default_ttl=10)
+
+        self.assertEqual(3600, details_cache.get_ttl('COMPLETED'))
+        self.assertEqual(10, details_cache.get_ttl('CREATED'))
+        self.assertEqual(10, details_cache.get_ttl(None))
+
+    def testCacheIsResolvedOnce(self):
+        details_cache = DetailsCache('payment', ttls={'CREATED': 30})
+
+        with patch('paypaladaptive.api.details_cache.get_cache',
+                   wraps=get_cache) as mock_get_cache:
+            details_cache.set('AP-1', '{}', 'CREATED')
+            self.assertEqual('{}', details_cache.get('AP-1'))
+            details_cache.delete('AP-1')
+
+        self.assertEqual(1, mock_get_cache.call_count)
@@ -0,0 +1,77 @@
+import json
+import threading
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from mock import patch
+
+from ..api import PaymentDetails
+from ..api.httpwrapper import UrlResponse
+
+
+class EchoRequest(object):
+    """Responds with the payKey and device IP address it was sent"""
+
+    def call(self, url, data=None, headers=None, deadline=None):
+        body = {'responseEnvelope': {'ack': 'Success'},
+                'payKey': json.loads(data)['payKey'],
+                'ip': headers.get('X-PAYPAL-DEVICE-IPADDRESS')}
+        self._response = UrlResponse(json.dumps(body), {}, 200)
+        return self
+
+    @property
+    def response(self):
+        return self._response.data
+
+    @property
+    def code(self):
+        return self._response.code
+
+
+class TestEndpointState(TestCase):
+    def testStateIsPerInstance(self):
+        first = PaymentDetails(payKey='AP-1', remote_address='10.0.0.1')
+        second = PaymentDetails(transactionId='123')
+
+        self.assertEqual('AP-1', first.data['payKey'])
+        self.assertNotIn('payKey', second.data)
+        self.assertNotIn('X-PAYPAL-DEVICE-IPADDRESS', second.headers)
+        self.assertEqual({'errorLanguage': 'en_US'},
+                         second.data['requestEnvelope'])
+
+    def testStateIsImmutable(self):
+        endpoint = PaymentDetails(payKey='AP-1')
+
+        with self.assertRaises(TypeError):
+            endpoint.data['payKey'] = 'AP-2'
+
+        with self.assertRaises(TypeError):
+            endpoint.headers.update({'X-PAYPAL-DEVICE-IPADDRESS': '10.0.0.1'})
+
+        with self.assertRaises(TypeError):
+            endpoint.data['requestEnvelope']['errorLanguage'] = 'sv_SE'
+
+    @patch('paypaladaptive.api.endpoints.UrlRequest', EchoRequest)
+    def testNoCrossTalkBetweenThreads(self):
+        cache.clear()
+        errors = []
+
+        def worker(n):
+            for i in range(25):
+                key = 'AP-%s-%s' % (n, i)
+                ip = '10.0.%s.%s' % (n, i)
+                endpoint = PaymentDetails(payKey=key, remote_address=ip)
+                endpoint.call()
+                if (endpoint.response['payKey'] != key
+                        or endpoint.response['ip'] != ip):
+                    errors.append((key, ip, endpoint.response))
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
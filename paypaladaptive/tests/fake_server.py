@@ -0,0 +1,182 @@
+import BaseHTTPServer
+import threading
+import urllib2
+import urlparse
+
+from django.core.cache import cache
+from django.http import HttpRequest, QueryDict
+from django.test import TestCase
+
+from mock import patch
+from money.Money import Money
+
+from ..api import (Pay, PaymentDetails, Preapprove, PreapprovalDetails,
+                   CancelPreapproval, Refund, Receiver, ReceiverList,
+                   PayError, TransportError)
+from ..api.ipn import IPN
+from ..fake_server import FakePaypal, FakePaypalServer
+
+
+class IPNReceiver(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Collects the bodies of IPN messages POSTed to it"""
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length'))
+        self.server.received.append(self.rfile.read(length))
+        self.server.event.set()
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@patch('paypaladaptive.api.retry.RetryPolicy.sleep',
+       staticmethod(lambda seconds: None))
+class TestFakeServer(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.paypal = FakePaypal()
+        self.server = serve(FakePaypalServer(('127.0.0.1', 0), self.paypal,
+                                             quiet=True))
+        self.receiver = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                  IPNReceiver)
+        self.receiver.received = []
+        self.receiver.event = threading.Event()
+        serve(self.receiver)
+
+        base = 'http://127.0.0.1:%s' % self.server.port
+        self.payment_host = base + '/webscr'
+        self.ipn_url = 'http://127.0.0.1:%s/ipn/' % self.receiver.server_port
+
+        self.patches = [patch.object(endpoint, 'url',
+                                     '%s/AdaptivePayments/%s' % (base, name))
+                        for endpoint, name in (
+                            (Pay, 'Pay'),
+                            (PaymentDetails, 'PaymentDetails'),
+                            (Refund, 'Refund'),
+                            (Preapprove, 'Preapproval'),
+                            (PreapprovalDetails, 'PreapprovalDetails'),
+                            (CancelPreapproval, 'CancelPreapproval'))]
+        self.patches.append(patch('paypaladaptive.settings.PAYPAL_PAYMENT_HOST',
+                                  self.payment_host))
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.receiver.shutdown()
+        self.receiver.server_close()
+        cache.clear()
+
+    def pay(self, **kwargs):
+        receivers = ReceiverList([Receiver(amount=10, email='a@example.com',
+                                           primary=True),
+                                  Receiver(amount=8, email='b@example.com')])
+        pay = Pay(Money(10, 'USD'), 'http://return/', 'http://cancel/',
+                  receivers, ipn_url=self.ipn_url, **kwargs)
+        pay.call()
+        return pay
+
+    def approve(self, cmd, key_name, key):
+        # answers with a redirect to the return url, which isn't served
+        url = '%s?cmd=%s&%s=%s' % (self.payment_host, cmd, key_name, key)
+        try:
+            urllib2.urlopen(url)
+        except urllib2.URLError:
+            pass
+
+    def receive_ipn(self):
+        self.assertTrue(self.receiver.event.wait(5))
+        self.receiver.event.clear()
+        return self.receiver.received[-1]
+
+    def verify(self, body):
+        return urllib2.urlopen(self.payment_host + '?cmd=_notify-validate',
+                               body).read()
+
+    def parse_ipn(self, body):
+        request = HttpRequest()
+        request.method = 'POST'
+        request.POST = QueryDict(body)
+        return IPN(request)
+
+    def details(self, pay_key):
+        details = PaymentDetails(payKey=pay_key)
+        details.call()
+        return details.response
+
+    def testPaymentFlow(self):
+        pay = self.pay()
+        self.assertEqual('CREATED', pay.status)
+        self.assertEqual('CREATED', self.details(pay.paykey)['status'])
+
+        self.approve('_ap-payment', 'paykey', pay.paykey)
+
+        body = self.receive_ipn()
+        self.assertEqual('VERIFIED', self.verify(body))
+
+        ipn = dict(urlparse.parse_qsl(body))
+        self.assertEqual('COMPLETED', ipn['status'])
+        self.assertEqual(pay.paykey, ipn['pay_key'])
+        self.assertEqual('USD 10.00', ipn['transaction[0].amount'])
+        self.assertEqual('USD 8.00', ipn['transaction[1].amount'])
+        self.assertEqual('COMPLETED', self.details(pay.paykey)['status'])
+
+    def testRefund(self):
+        pay = self.pay()
+        self.approve('_ap-payment', 'paykey', pay.paykey)
+
+        refund = Refund(pay.paykey)
+        refund.call()
+
+        statuses = [info['refundStatus'] for info in
+                    refund.response['refundInfoList']['refundInfo']]
+        self.assertEqual(['REFUNDED', 'REFUNDED'], statuses)
+
+    def testTrackingIdIsUnique(self):
+        self.pay(trackingId='payment-1')
+
+        with self.assertRaises(PayError):
+            self.pay(trackingId='payment-1')
+
+    def testPreapprovalFlow(self):
+        preapprove = Preapprove(Money(10, 'USD'), 'http://return/',
+                                'http://cancel/', ipn_url=self.ipn_url)
+        preapprove.call()
+        key = preapprove.preapprovalkey
+
+        self.approve('_ap-preapproval', 'preapprovalkey', key)
+        ipn = self.parse_ipn(self.receive_ipn())
+        self.assertTrue(ipn.approved)
+        self.assertEqual(Money(10, 'USD'), ipn.max_total_amount_of_all_payments)
+
+        self.pay(preapprovalKey=key)
+        self.receive_ipn()
+
+        details = PreapprovalDetails(preapprovalKey=key)
+        details.call()
+        self.assertEqual('1', details.response['curPayments'])
+
+        CancelPreapproval(preapproval_key=key).call()
+        self.assertEqual('CANCELED',
+                         self.parse_ipn(self.receive_ipn()).status)
+
+    def testUnknownIPNIsInvalid(self):
+        self.assertEqual('INVALID', self.verify('status=COMPLETED&pay_key=AP-1'))
+
+    def testErrors(self):
+        self.paypal.error_rate = 1
+
+        with self.assertRaises(TransportError):
+            self.details('AP-1')
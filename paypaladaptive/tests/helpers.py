@@ -5,7 +5,7 @@ from mock import patch
 from ..api.httpwrapper import UrlRequest, UrlResponse
 
 class MockIPNVerifyRequest(UrlRequest):
-    def call(self, url, data=None, headers=None):
+    def call(self, url, data=None, headers=None, deadline=None):
         MockIPNVerifyRequest.data = data
         self._response = UrlResponse(data='VERIFIED', meta={}, code=200)
         return self
@@ -13,7 +13,7 @@ class MockIPNVerifyRequest(UrlRequest):
 
 class MockIPNVerifyRequestInvalid(UrlRequest):
     data = None
-    def call(self, url, data=None, headers=None):
+    def call(self, url, data=None, headers=None, deadline=None):
         self.data = data
         self._response = UrlResponse(data='invalid', meta={}, code=200)
         return self
@@ -21,7 +21,7 @@ class MockIPNVerifyRequestInvalid(UrlRequest):
 
 class MockIPNVerifyRequestFail(UrlRequest):
     data = None
-    def call(self, url, data=None, headers=None):
+    def call(self, url, data=None, headers=None, deadline=None):
         self.data = data
         self._response = UrlResponse(data='invalid', meta={}, code=None)
         return self
@@ -29,7 +29,7 @@ class MockIPNVerifyRequestFail(UrlRequest):
 
 class MockIPNVerifyRequestInvalidCode(UrlRequest):
     data = None
-    def call(self, url, data=None, headers=None):
+    def call(self, url, data=None, headers=None, deadline=None):
         self.data = data
         self._response = UrlResponse(data='VERIFIED', meta={}, code=500)
         return self
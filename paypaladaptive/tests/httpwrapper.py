@@ -0,0 +1,180 @@
+import socket
+
+from django.test import TestCase
+
+from mock import Mock, patch
+
+from ..api.deadline import Deadline
+from ..api.errors import DeadlineExceeded, RequestTimeout
+from ..api.httpwrapper import ConnectionPool, UrlRequest
+
+
+class FakeConnection(object):
+    sock = None
+
+    def __init__(self, host, port=None):
+        self.host = host
+        self.port = port
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeResponse(object):
+    status = 200
+    msg = {}
+    will_close = False
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(maxsize=2, idle_timeout=60)
+        self.pool.connection_classes = {'https': FakeConnection}
+
+    def testReusesIdleConnection(self):
+        connection, reused = self.pool.get('https', 'svcs.paypal.com')
+        self.assertFalse(reused)
+
+        self.pool.put('https', 'svcs.paypal.com', None, connection)
+        again, reused = self.pool.get('https', 'svcs.paypal.com')
+
+        self.assertTrue(reused)
+        self.assertIs(connection, again)
+
+    def testConnectionsArePerHost(self):
+        connection, __ = self.pool.get('https', 'svcs.paypal.com')
+        self.pool.put('https', 'svcs.paypal.com', None, connection)
+
+        other, reused = self.pool.get('https', 'www.paypal.com')
+
+        self.assertFalse(reused)
+        self.assertIsNot(connection, other)
+
+    def testMaxSize(self):
+        connections = [self.pool.get('https', 'svcs.paypal.com')[0]
+                       for __ in range(3)]
+
+        for connection in connections:
+            self.pool.put('https', 'svcs.paypal.com', None, connection)
+
+        self.assertFalse(connections[0].closed)
+        self.assertFalse(connections[1].closed)
+        self.assertTrue(connections[2].closed)
+
+    def testIdleConnectionsAreEvicted(self):
+        connection, __ = self.pool.get('https', 'svcs.paypal.com')
+        self.pool.put('https', 'svcs.paypal.com', None, connection)
+
+        with patch('paypaladaptive.api.httpwrapper.time.time',
+                   return_value=10 ** 10):
+            fresh, reused = self.pool.get('https', 'svcs.paypal.com')
+
+        self.assertFalse(reused)
+        self.assertTrue(connection.closed)
+        self.assertFalse(fresh.closed)
+
+    def testEvictsOtherHosts(self):
+        connection, __ = self.pool.get('https', 'svcs.paypal.com')
+        self.pool.put('https', 'svcs.paypal.com', None, connection)
+
+        with patch('paypaladaptive.api.httpwrapper.time.time',
+                   return_value=10 ** 10):
+            self.pool.get('https', 'www.paypal.com')
+
+        self.assertTrue(connection.closed)
+
+
+class TestUrlRequestPooling(TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(maxsize=2, idle_timeout=60)
+        self.pool.connection_classes = {'https': FakeConnection}
+
+        request = UrlRequest()
+        request.pool = self.pool
+        self.request = request
+
+    def patch_send(self, send_request, get_response):
+        patcher = patch.multiple(self.request, _send_request=send_request,
+                                 _get_response=get_response)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testRetriesStaleConnectionOnce(self):
+        stale, __ = self.pool.get('https', 'svcs.paypal.com')
+        self.pool.put('https', 'svcs.paypal.com', None, stale)
+        sent = []
+
+        def send_request(connection, *args):
+            if connection is stale:
+                raise socket.error('broken pipe')
+            sent.append(connection)
+
+        self.patch_send(send_request, lambda c: FakeResponse('{}'))
+        self.request.call('https://svcs.paypal.com/Pay', data='{}')
+
+        self.assertEqual(1, len(sent))
+        self.assertEqual(self.request.code, 200)
+        self.assertEqual(self.request.response, '{}')
+
+    def testNoRetryOnceSent(self):
+        """A request Paypal may have received is not sent again"""
+
+        stale, __ = self.pool.get('https', 'svcs.paypal.com')
+        self.pool.put('https', 'svcs.paypal.com', None, stale)
+        sent = []
+
+        def get_response(connection):
+            raise socket.error('connection reset by peer')
+
+        self.patch_send(lambda c, *args: sent.append(c), get_response)
+        self.request.call('https://svcs.paypal.com/Pay', data='{}')
+
+        self.assertEqual([stale], sent)
+        self.assertEqual(self.request.code, None)
+
+    def testErrorOnFreshConnection(self):
+        self.patch_send(Mock(side_effect=socket.error('refused')), Mock())
+        self.request.call('https://svcs.paypal.com/Pay', data='{}')
+
+        self.assertEqual(self.request.code, None)
+
+
+class TestDeadline(TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(maxsize=2, idle_timeout=60)
+        self.pool.connection_classes = {'https': FakeConnection}
+
+        request = UrlRequest()
+        request.pool = self.pool
+        self.request = request
+
+    def testTimeoutIsCappedByDeadline(self):
+        deadline = Deadline(5)
+
+        self.assertTrue(deadline.timeout(30) <= 5)
+        self.assertEqual(deadline.timeout(1), 1)
+
+    def testCoerce(self):
+        deadline = Deadline(5)
+
+        self.assertIs(Deadline.coerce(deadline), deadline)
+        self.assertIs(Deadline.coerce(None), None)
+        self.assertTrue(isinstance(Deadline.coerce(5), Deadline))
+
+    def testExpiredDeadlineFailsFast(self):
+        with self.assertRaises(DeadlineExceeded):
+            self.request.call('https://svcs.paypal.com/Pay', data='{}',
+                              deadline=Deadline(-1))
+
+    def testReadTimeout(self):
+        with patch.object(self.request, '_send_request',
+                          side_effect=socket.timeout('timed out')):
+            with self.assertRaises(RequestTimeout):
+                self.request.call('https://svcs.paypal.com/Pay', data='{}')
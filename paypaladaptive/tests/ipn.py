@@ -1,14 +1,16 @@
 import django.test as test
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
-from django.http import HttpRequest
+from django.http import HttpRequest, QueryDict
 
 from money.Money import Money
 import mock
+import urllib
 import urlparse
 
+from paypaladaptive import metrics
 from paypaladaptive.api.ipn import IPN
-from paypaladaptive.models import Payment, Preapproval
+from paypaladaptive.models import IPNMessage, Payment, Preapproval
 from paypaladaptive.api.errors import IpnError
 
 from factories import PreapprovalFactory, PaymentFactory
@@ -123,12 +125,9 @@ class TestPaymentIPN(test.TestCase):
 
         response = self.mock_ipn_call(data, ipn_url)
 
+        # rejected before verifying, so it can't change the payment
         payment = self.get_payment()
-
-        self.assertEqual(payment.status, 'error')
-        self.assertEqual(payment.status_detail,
-                         ('IPN secret "%s" did not match db'
-                          % incorrect_UUID))
+        self.assertEqual(payment.status, 'created')
 
         self.assertEqual(response.status_code, 400)
 
@@ -296,3 +295,137 @@ class TestIPNVerification(test.TestCase):
 
         self.assertEqual(context.exception.message,
                          'PayPal response was "invalid"')
+
+
+class TestIPNTransactions(test.TestCase):
+    @mock.patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+                MockIPNVerifyRequest)
+    def get_ipn(self, data):
+        request = HttpRequest()
+        request.POST = QueryDict(urllib.urlencode(data))
+        return IPN(request)
+
+    def testAnyNumberOfTransactions(self):
+        data = {'status': 'COMPLETED',
+                'transaction_type': 'Adaptive Payment PAY'}
+        for n in (10, 2, 0, 1, 3, 4, 5, 6, 7, 8, 9):
+            data['transaction[%s].id' % n] = str(n)
+            data['transaction[%s].amount' % n] = 'USD %s.00' % n
+        data['transaction[6].is_primary_receiver'] = 'true'
+
+        ipn = self.get_ipn(data)
+
+        self.assertEqual([str(n) for n in range(11)],
+                         [t.id for t in ipn.transactions])
+        self.assertEqual(Money('10.00', 'USD'), ipn.transactions[10].amount)
+        self.assertTrue(ipn.transactions[6].is_primary_receiver)
+        self.assertFalse(ipn.transactions[5].is_primary_receiver)
+
+    def testNoTransactions(self):
+        ipn = self.get_ipn({'transaction_type': 'Adaptive Payment PAY',
+                            'status': 'COMPLETED',
+                            'transaction_count': '0'})
+
+        self.assertEqual([], ipn.transactions)
+
+
+class TestIPNFields(test.TestCase):
+    @mock.patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+                MockIPNVerifyRequest)
+    def get_ipn(self, data):
+        request = HttpRequest()
+        request.POST = QueryDict(urllib.urlencode(data))
+        return IPN(request)
+
+    def testDecodedOnFirstRead(self):
+        ipn = self.get_ipn({
+            'status': 'COMPLETED',
+            'transaction_type': 'Adaptive Payment PAY',
+            'payment_request_date': 'Thu Jun 09 07:23:38 PDT 2011'})
+
+        with mock.patch.object(IPN, 'process_date') as process_date:
+            self.assertFalse(process_date.called)
+            ipn.payment_request_date
+            ipn.payment_request_date
+            self.assertEqual(1, process_date.call_count)
+
+    def testFieldsOfOtherTypes(self):
+        payment = self.get_ipn({'status': 'COMPLETED',
+                                'transaction_type': 'Adaptive Payment PAY',
+                                'pay_key': 'AP-1',
+                                'approved': 'true'})
+
+        self.assertEqual('AP-1', payment.pay_key)
+        self.assertFalse(payment.approved)
+        self.assertEqual(None, payment.max_total_amount_of_all_payments)
+
+        preapproval = self.get_ipn({
+            'status': 'ACTIVE',
+            'transaction_type': 'Adaptive Payment PREAPPROVAL',
+            'approved': 'true',
+            'pay_key': 'AP-1',
+            'currency_code': 'USD',
+            'max_total_amount_of_all_payments': '10.00',
+            'day_of_week': 'NO_DAY_SPECIFIED'})
+
+        self.assertTrue(preapproval.approved)
+        self.assertEqual(Money('10.00', 'USD'),
+                         preapproval.max_total_amount_of_all_payments)
+        self.assertEqual(None, preapproval.day_of_week)
+        self.assertEqual(None, preapproval.pay_key)
+
+
+class TestIPNPrecheck(test.TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.payment = PaymentFactory.create(status='created')
+        self.data = {'status': 'COMPLETED',
+                     'transaction_type': 'Adaptive Payment PAY',
+                     'transaction[0].id': '1',
+                     'transaction[0].amount': str(self.payment.money),
+                     'transaction[0].status': 'COMPLETED'}
+
+    def post(self, object_id=None, secret_uuid=None):
+        kwargs = {'object_id': object_id or self.payment.id,
+                  'object_secret_uuid': (secret_uuid
+                                         or self.payment.secret_uuid)}
+        url = reverse('paypal-adaptive-ipn', kwargs=kwargs)
+
+        with mock.patch('paypaladaptive.api.ipn.endpoints.UrlRequest') as r:
+            response = test.Client().post(url, data=self.data)
+            self.assertFalse(r.called)
+        return response
+
+    def testUnknownObject(self):
+        self.assertEqual(404, self.post(object_id=9000).status_code)
+        self.assertEqual(1, metrics.get('ipn.rejected.not_found'))
+
+    def testSecretMismatch(self):
+        self.assertEqual(400, self.post(secret_uuid='wrong').status_code)
+        self.assertEqual(1, metrics.get('ipn.rejected.secret_mismatch'))
+
+    def testUnknownTransactionType(self):
+        self.data['transaction_type'] = 'Web Accept'
+
+        self.assertEqual(400, self.post().status_code)
+        self.assertEqual(1, metrics.get('ipn.rejected.unknown_type'))
+
+    def testNotStored(self):
+        self.post(secret_uuid='wrong')
+
+        self.assertFalse(IPNMessage.objects.exists())
+
+    @mock.patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+                MockIPNVerifyRequest)
+    def testMultipartPost(self):
+        """The test client posts multipart data, unlike Paypal"""
+
+        url = reverse('paypal-adaptive-ipn', kwargs={
+            'object_id': self.payment.id,
+            'object_secret_uuid': self.payment.secret_uuid})
+        response = test.Client().post(url, data=self.data)
+
+        self.assertEqual(204, response.status_code)
+        self.assertEqual('processed', IPNMessage.objects.get().status)
+        self.assertEqual('completed',
+                         Payment.objects.get(pk=self.payment.pk).status)
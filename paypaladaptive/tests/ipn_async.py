@@ -0,0 +1,195 @@
+import urllib
+from datetime import datetime, timedelta
+
+import django.test as test
+from django.core.cache import cache
+
+from mock import patch
+
+from .. import metrics, settings
+from ..models import IPNMessage, Payment
+from ..processing import process_ipn_messages
+from .factories import PaymentFactory
+from .helpers import (MockIPNVerifyRequest, MockIPNVerifyRequestInvalid,
+                      MockIPNVerifyRequestInvalidCode)
+
+
+class TestAsyncIPN(test.TestCase):
+    def setUp(self):
+        cache.clear()
+        self.payment = PaymentFactory.create(status='created')
+
+        patcher = patch.object(settings, 'ASYNC_IPN', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, payment=None, money=None, form_encoded=False):
+        payment = payment or self.payment
+        data = {'status': 'COMPLETED',
+                'transaction_type': 'Adaptive Payment PAY',
+                'transaction[0].id': '1',
+                'transaction[0].amount': str(money or payment.money),
+                'transaction[0].status': 'COMPLETED'}
+        if form_encoded:
+            # the way Paypal posts it
+            return test.Client().post(
+                payment.ipn_url, data=urllib.urlencode(data),
+                content_type='application/x-www-form-urlencoded')
+        return test.Client().post(payment.ipn_url, data=data)
+
+    def get(self, obj):
+        return type(obj).objects.get(pk=obj.pk)
+
+    @patch('paypaladaptive.api.ipn.endpoints.UrlRequest')
+    def testStoredWithoutVerifying(self, url_request):
+        response = self.post()
+
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(url_request.called)
+        message = IPNMessage.objects.get()
+        self.assertEqual('new', message.status)
+        self.assertEqual(self.payment.pk, message.object_id)
+        self.assertEqual('created', self.get(self.payment).status)
+
+    @patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+           MockIPNVerifyRequest)
+    def testProcess(self):
+        other = PaymentFactory.create(status='created')
+        self.post()
+        self.post(other)
+
+        stats = process_ipn_messages(max_workers=2)
+
+        self.assertEqual(2, stats['processed'])
+        self.assertEqual('completed', self.get(self.payment).status)
+        self.assertEqual('completed', self.get(other).status)
+        self.assertEqual(2, IPNMessage.objects.filter(
+            status='processed', processed_date__isnull=False).count())
+        self.assertEqual(0, process_ipn_messages()['processed'])
+
+    @patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+           MockIPNVerifyRequest)
+    def testProcessFormEncoded(self):
+        other = PaymentFactory.create(status='created')
+        self.post(form_encoded=True)
+        self.post(other)
+
+        stats = process_ipn_messages()
+
+        self.assertEqual(2, stats['processed'])
+        self.assertEqual('completed', self.get(self.payment).status)
+        self.assertEqual('completed', self.get(other).status)
+
+    @patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+           MockIPNVerifyRequestInvalid)
+    def testRejected(self):
+        self.post()
+
+        stats = process_ipn_messages()
+
+        self.assertEqual(1, stats['rejected'])
+        self.assertEqual('rejected', IPNMessage.objects.get().status)
+        self.assertEqual('created', self.get(self.payment).status)
+
+    @patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+           MockIPNVerifyRequest)
+    def testUnknownObjectRejected(self):
+        self.post()
+        Payment.objects.filter(pk=self.payment.pk).delete()
+
+        self.assertEqual(1, process_ipn_messages()['rejected'])
+
+    @patch.object(settings, 'IPN_MAX_ATTEMPTS', 2)
+    @patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+           MockIPNVerifyRequestInvalidCode)
+    @patch('paypaladaptive.api.ipn.endpoints.IPN.verify_retry_policy.sleep')
+    def testRetriedWhileUnavailable(self, sleep):
+        self.post()
+
+        self.assertEqual(1, process_ipn_messages()['retried'])
+        message = IPNMessage.objects.get()
+        self.assertEqual('new', message.status)
+        self.assertEqual(1, message.attempts)
+
+        self.assertEqual(1, process_ipn_messages()['failed'])
+        self.assertEqual('failed', IPNMessage.objects.get().status)
+
+    def testClaimedOnce(self):
+        self.post()
+
+        self.assertEqual(1, len(IPNMessage.objects.claim()))
+        self.assertEqual([], IPNMessage.objects.claim())
+
+
+class TestIPNDeduplication(test.TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        self.payment = PaymentFactory.create(status='created')
+        self.data = {'status': 'COMPLETED',
+                     'transaction_type': 'Adaptive Payment PAY',
+                     'transaction[0].id': '1',
+                     'transaction[0].amount': str(self.payment.money),
+                     'transaction[0].status': 'COMPLETED'}
+
+    def post(self):
+        return test.Client().post(self.payment.ipn_url, data=self.data)
+
+    def testRedeliveryNotVerifiedAgain(self):
+        with patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+                   MockIPNVerifyRequest):
+            self.assertEqual(204, self.post().status_code)
+
+        with patch('paypaladaptive.api.ipn.endpoints.UrlRequest') as request:
+            self.assertEqual(204, self.post().status_code)
+            self.assertFalse(request.called)
+
+        message = IPNMessage.objects.get()
+        self.assertEqual('processed', message.status)
+        self.assertTrue(message.verified)
+        self.assertEqual(1, metrics.get('ipn.duplicate'))
+
+    @patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+           MockIPNVerifyRequestInvalid)
+    def testRejectedRedelivery(self):
+        self.assertEqual(400, self.post().status_code)
+        self.assertEqual(400, self.post().status_code)
+
+        message = IPNMessage.objects.get()
+        self.assertEqual('rejected', message.status)
+        self.assertFalse(message.verified)
+
+    @patch.object(settings, 'ASYNC_IPN', True)
+    def testStoredOnce(self):
+        self.post()
+        self.post()
+
+        self.assertEqual(1, IPNMessage.objects.count())
+
+    def testDifferentBodies(self):
+        with patch.object(settings, 'ASYNC_IPN', True):
+            self.post()
+            self.data['transaction[0].id'] = '2'
+            self.post()
+
+        self.assertEqual(2, IPNMessage.objects.count())
+
+    def testPrune(self):
+        with patch.object(settings, 'ASYNC_IPN', True):
+            self.post()
+        old = datetime.now() - timedelta(days=31)
+        IPNMessage.objects.update(created_date=old)
+        self.assertEqual(0, IPNMessage.objects.prune())
+
+        IPNMessage.objects.update(status='processed')
+        self.assertEqual(1, IPNMessage.objects.prune(timedelta(days=30)))
+        self.assertEqual(0, IPNMessage.objects.count())
+
+    def testPruneFailed(self):
+        with patch.object(settings, 'ASYNC_IPN', True):
+            self.post()
+        old = datetime.now() - timedelta(days=31)
+        IPNMessage.objects.update(created_date=old, status='failed')
+
+        self.assertEqual(1, IPNMessage.objects.prune(timedelta(days=30)))
+        self.assertEqual(0, IPNMessage.objects.count())
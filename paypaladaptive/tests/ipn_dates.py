@@ -0,0 +1,62 @@
+from datetime import datetime
+
+from django.test import TestCase
+
+from mock import patch
+from pytz import utc
+
+from ..api.ipn import IPN, dates
+
+
+class TestIPNDates(TestCase):
+    def setUp(self):
+        dates._cache.clear()
+
+    def testPaypalFormat(self):
+        self.assertEqual(datetime(2011, 6, 9, 14, 23, 38, tzinfo=utc),
+                         IPN.process_date('Thu Jun 09 07:23:38 PDT 2011'))
+        self.assertEqual(datetime(2011, 1, 9, 15, 23, 38, tzinfo=utc),
+                         IPN.process_date('Sun Jan 09 07:23:38 PST 2011'))
+
+    def testIsoFormat(self):
+        self.assertEqual(
+            datetime(2013, 7, 6, 18, 34, 5, 120000, tzinfo=utc),
+            IPN.process_date(u'2013-07-06T11:34:05.120-07:00'))
+        self.assertEqual(datetime(2013, 7, 6, 11, 34, 5, tzinfo=utc),
+                         IPN.process_date('2013-07-06T11:34:05Z'))
+
+    def testEmpty(self):
+        self.assertEqual(None, IPN.process_date(''))
+        self.assertEqual(None, IPN.process_date(None))
+
+    @patch('paypaladaptive.api.ipn.dates.parse')
+    def testOnlyUnexpectedShapesUseDateutil(self, parse):
+        parse.return_value = datetime(2011, 6, 9, tzinfo=utc)
+
+        IPN.process_date('Thu Jun 09 07:23:38 PDT 2011')
+        IPN.process_date('2013-07-06T11:34:05.000-07:00')
+        self.assertFalse(parse.called)
+
+        self.assertEqual(parse.return_value,
+                         IPN.process_date('June 9th 2011 00:00 UTC'))
+        self.assertTrue(parse.called)
+
+    @patch('paypaladaptive.api.ipn.dates.parse_paypal_date')
+    def testCached(self, parse_paypal_date):
+        parse_paypal_date.return_value = datetime(2011, 6, 9, tzinfo=utc)
+
+        IPN.process_date('Thu Jun 09 07:23:38 PDT 2011')
+        IPN.process_date('Thu Jun 09 07:23:38 PDT 2011')
+
+        self.assertEqual(1, parse_paypal_date.call_count)
+
+    def testLRUCache(self):
+        cache = dates.LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+from django.db import connection
+from django.test import TestCase
+
+from ..models import Payment, Preapproval
+from .factories import PaymentFactory, PreapprovalFactory
+
+
+class TestLookupManagers(TestCase):
+    def age(self, obj, **kwargs):
+        type(obj).objects.filter(pk=obj.pk).update(
+            created_date=datetime.now() - timedelta(**kwargs))
+
+    def testByKeys(self):
+        payment = PaymentFactory.create(pay_key='AP-1', transaction_id='T-1')
+        PaymentFactory.create(pay_key='AP-2')
+        preapproval = PreapprovalFactory.create(preapproval_key='PA-1')
+
+        self.assertEqual([payment], list(Payment.objects.by_pay_key('AP-1')))
+        self.assertEqual([payment],
+                         list(Payment.objects.by_transaction_id('T-1')))
+        self.assertEqual([preapproval], list(
+            Preapproval.objects.by_preapproval_key('PA-1')))
+
+    def testPending(self):
+        created = PaymentFactory.create(status='created')
+        returned = PaymentFactory.create(status='returned')
+        PaymentFactory.create(status='completed')
+        PaymentFactory.create(status='new')
+
+        self.assertEqual(set([created.pk, returned.pk]),
+                         set(p.pk for p in Payment.objects.pending()))
+
+    def testStale(self):
+        old = PreapprovalFactory.create(status='created')
+        older = PreapprovalFactory.create(status='returned')
+        PreapprovalFactory.create(status='created')
+        done = PreapprovalFactory.create(status='approved')
+        self.age(old, hours=2)
+        self.age(older, hours=3)
+        self.age(done, hours=3)
+
+        self.assertEqual([older.pk, old.pk], [
+            p.pk for p in Preapproval.objects.stale(timedelta(hours=1))])
+
+    def testQuerysetMethodsChain(self):
+        PaymentFactory.create(status='created', pay_key='AP-1')
+
+        self.assertEqual(1, Payment.objects.filter(pay_key='AP-1')
+                         .pending().count())
+        self.assertEqual(0, Payment.objects.by_pay_key('AP-1')
+                         .stale(timedelta(hours=1)).count())
+
+    def testIndexes(self):
+        cursor = connection.cursor()
+
+        for model, fields in ((Payment, ['pay_key', 'transaction_id',
+                                         'created_date']),
+                              (Preapproval, ['preapproval_key',
+                                             'created_date'])):
+            indexes = connection.introspection.get_indexes(
+                cursor, model._meta.db_table)
+            for field in fields:
+                self.assertTrue(field in indexes,
+                                '%s.%s is not indexed'
+                                % (model.__name__, field))
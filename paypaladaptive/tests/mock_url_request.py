@@ -7,7 +7,7 @@ from paypaladaptive import settings
 
 
 class MockUrlRequest(object):
-    def call(self, url, data=None, headers=None):
+    def call(self, url, data=None, headers=None, deadline=None):
         self._assert_valid_url(url)
         self._assert_valid_data(json.loads(data))
         self._assert_valid_headers(headers)
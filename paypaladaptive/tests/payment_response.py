@@ -4,13 +4,14 @@ from mock import patch
 from money.Money import Money
 
 from .. import settings
+from ..api import TransportError
 from ..models import Payment
 from ..api.datatypes import Receiver, ReceiverList
 
 
 class MockPaymentRequest(object):
     _response = None
-    _code = None
+    _code = 200
 
     @property
     def response(self):
@@ -66,3 +67,15 @@ class TestPaymentResponses(TestCase):
         self.assertEqual(
             self.payment.status_detail,
             u"Error 569059: Instant payments can\'t be pending")
+
+    @patch("paypaladaptive.api.endpoints.UrlRequest", MockPaymentRequest)
+    def testLostAnswerLeavesPaymentCreated(self):
+        self.payment.tracking_id = 'campaign-1-payment-1'
+        self.payment.save()
+
+        with patch.object(MockPaymentRequest, '_code', 502):
+            with self.assertRaises(TransportError):
+                self.payment.process(self.receivers)
+
+        self.assertEqual('created',
+                         Payment.objects.get(pk=self.payment.pk).status)
@@ -4,12 +4,13 @@ from django.test import TestCase
 
 from mock import patch
 
+from ..models import Payment
 from .factories import PaymentFactory
 
 
 class MockUpdateRequest(object):
     _response = None
-    _code = None
+    _code = 200
     _base_response = {
         'responseEnvelope': {
             'ack': 'Success'
@@ -64,29 +65,42 @@ class TestPaymentUpdate(TestCase):
         self.assertEqual(context_manager.exception.message,
                          "Can't update unprocessed payments")
 
-    @patch("paypaladaptive.api.endpoints.UrlRequest", MockUpdateRequest)
-    def test_update(self):
-        MockUpdateRequest.set_response({'status': 'COMPLETED'})
-
-        self.payment.status = 'created'
-        self.payment.update()
-        self.assertEqual(self.payment.status, 'completed')
-
-        MockUpdateRequest.set_response({'status': 'CREATED'})
-
-        self.payment.update()
-        self.assertEqual(self.payment.status, 'created')
+    def assertUpdate(self, status, response, expected):
+        Payment.objects.filter(pk=self.payment.pk).update(status=status)
+        payment = Payment.objects.get(pk=self.payment.pk)
+        MockUpdateRequest.set_response(response)
 
-        MockUpdateRequest.set_response({'status': 'ERROR'})
+        payment.update()
 
-        self.payment.update()
-        self.assertEqual(self.payment.status, 'error')
+        self.assertEqual(expected, payment.status)
+        self.assertEqual(expected,
+                         Payment.objects.get(pk=self.payment.pk).status)
 
-        self.payment.status = 'new'
-
-        MockUpdateRequest.set_response({
-            'status': 'an unrecognized weird value'})
+    @patch("paypaladaptive.api.endpoints.UrlRequest", MockUpdateRequest)
+    def test_update(self):
+        self.assertUpdate('created', {'status': 'COMPLETED'}, 'completed')
+        self.assertUpdate('new', {'status': 'CREATED'}, 'created')
+        self.assertUpdate('created', {'status': 'ERROR'}, 'error')
+        self.assertUpdate('new', {'status': 'an unrecognized weird value'},
+                          'new')
 
-        self.payment.update()
-        self.assertEqual(self.payment.status, 'new')
+    @patch("paypaladaptive.api.endpoints.UrlRequest", MockUpdateRequest)
+    def test_update_keeps_final_status(self):
+        self.assertUpdate('completed', {'status': 'CREATED'}, 'completed')
+        self.assertUpdate('completed', {'status': 'ERROR'}, 'completed')
+        self.assertUpdate('refunded', {'status': 'COMPLETED'}, 'refunded')
 
+    @patch("paypaladaptive.api.endpoints.UrlRequest", MockUpdateRequest)
+    def test_update_by_tracking_id(self):
+        payment = PaymentFactory.create(status='created', pay_key='',
+                                        tracking_id='campaign-1-payment-1')
+        self.assertEqual({'trackingId': 'campaign-1-payment-1'},
+                         payment.get_update_kwargs())
+        MockUpdateRequest.set_response({'status': 'COMPLETED',
+                                        'payKey': 'AP-1'})
+
+        payment.update()
+
+        payment = Payment.objects.get(pk=payment.pk)
+        self.assertEqual('completed', payment.status)
+        self.assertEqual('AP-1', payment.pay_key)
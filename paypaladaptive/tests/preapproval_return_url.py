@@ -54,7 +54,7 @@ class TestPreapprovalReturnURL(TestCase):
     def testBadStatus(self):
         """Test with bad saved Preapproval status"""
 
-        self.preapproval.status = 'canceled'
+        self.preapproval.status = 'returned'
         self.preapproval.save()
 
         response = self.hitReturnUrl()
@@ -65,4 +65,15 @@ class TestPreapprovalReturnURL(TestCase):
         self.assertEqual(p.status, 'error')
         self.assertEqual(p.status_detail,
                         "Expected status to be created or approved not %s - "
-                        "duplicate transaction?" % 'canceled')
+                        "duplicate transaction?" % 'returned')
+
+    def testTerminalStatusIsKept(self):
+        """Test that a canceled Preapproval isn't changed to error"""
+
+        self.preapproval.status = 'canceled'
+        self.preapproval.save()
+
+        response = self.hitReturnUrl()
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.get_preapproval().status, 'canceled')
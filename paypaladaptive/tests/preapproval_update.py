@@ -4,12 +4,13 @@ from django.test import TestCase
 
 from mock import patch
 
+from ..models import Preapproval
 from .factories import PreapprovalFactory
 
 
 class MockUpdateRequest(object):
     _response = None
-    _code = None
+    _code = 200
     _base_response = {
         'responseEnvelope': {
             'ack': 'Success'
@@ -69,46 +70,60 @@ class TestPreapprovalUpdate(TestCase):
         self.assertEqual(context_manager.exception.message,
                          "Can't update unprocessed preapprovals")
 
+    def assertUpdate(self, status, response, expected):
+        Preapproval.objects.filter(pk=self.preapproval.pk).update(
+            status=status)
+        preapproval = Preapproval.objects.get(pk=self.preapproval.pk)
+        MockUpdateRequest.set_response(response)
+
+        preapproval.update()
+
+        self.assertEqual(expected, preapproval.status)
+        self.assertEqual(
+            expected, Preapproval.objects.get(pk=self.preapproval.pk).status)
+
     @patch("paypaladaptive.api.endpoints.UrlRequest", MockUpdateRequest)
     def test_update(self):
-        MockUpdateRequest.set_response({
+        self.assertUpdate('created', {
             'curPayments': 1,
             'maxNumberOfPayments': 1,
             'status': 'ACTIVE',
             'approved': 'true'
-        })
+        }, 'used')
 
-        self.preapproval.status = 'created'
-        self.preapproval.update()
-        self.assertEqual(self.preapproval.status, 'used')
-
-        MockUpdateRequest.set_response({
+        self.assertUpdate('created', {
             'curPayments': 0,
             'maxNumberOfPayments': 1,
             'status': 'ACTIVE',
             'approved': 'true'
-        })
-
-        self.preapproval.update()
-        self.assertEqual(self.preapproval.status, 'approved')
+        }, 'approved')
 
-        MockUpdateRequest.set_response({
+        self.assertUpdate('returned', {
             'curPayments': 0,
             'maxNumberOfPayments': 1,
             'status': 'ACTIVE',
             'approved': 'false'
-        })
+        }, 'returned')
 
-        self.preapproval.update()
-        self.assertEqual(self.preapproval.status, 'created')
-
-        MockUpdateRequest.set_response({
+        self.assertUpdate('approved', {
             'curPayments': 0,
             'maxNumberOfPayments': 1,
             'status': 'CANCELED',
             'approved': 'true'
-        })
+        }, 'canceled')
 
-        self.preapproval.update()
-        self.assertEqual(self.preapproval.status, 'canceled')
+    @patch("paypaladaptive.api.endpoints.UrlRequest", MockUpdateRequest)
+    def test_update_keeps_final_status(self):
+        self.assertUpdate('used', {
+            'curPayments': 0,
+            'maxNumberOfPayments': 1,
+            'status': 'ACTIVE',
+            'approved': 'true'
+        }, 'used')
 
+        self.assertUpdate('canceled', {
+            'curPayments': 0,
+            'maxNumberOfPayments': 1,
+            'status': 'ACTIVE',
+            'approved': 'false'
+        }, 'canceled')
@@ -0,0 +1,113 @@
+"""
+Number of queries made per transition. Each transition should be a single
+write of the row, plus the insert of its audit record.
+
+"""
+
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.test import TestCase
+
+from mock import patch
+from money.Money import Money
+
+from ..api.datatypes import Receiver, ReceiverList
+from ..models import AuditRecord, Payment, Preapproval
+from .factories import PaymentFactory, PreapprovalFactory
+from .payment_response import MockPaymentRequest
+from .payment_update import MockUpdateRequest
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', MockPaymentRequest)
+class TestTransitionQueries(TestCase):
+    def setUp(self):
+        cache.clear()
+        # fill the Site cache used when building urls
+        Site.objects.get_current()
+
+    def set_response(self, body):
+        MockPaymentRequest._response = (
+            '{"responseEnvelope": {"ack": "Success"}, %s}' % body)
+
+    def testPaymentProcess(self):
+        payment = PaymentFactory.create(money=Money(100, 'USD'))
+        receivers = ReceiverList([Receiver(amount=100, email='a@example.com',
+                                           primary=True)])
+        self.set_response('"payKey": "AP-1", "paymentExecStatus": "CREATED"')
+
+        # INSERT audit record, UPDATE payment
+        with self.assertNumQueries(2):
+            self.assertTrue(payment.process(receivers))
+
+        payment = Payment.objects.get(pk=payment.pk)
+        self.assertEqual('created', payment.status)
+        self.assertEqual('AP-1', payment.pay_key)
+        self.assertEqual('Pay', payment.audit_record.endpoint)
+
+    def testPaymentRefund(self):
+        payment = PaymentFactory.create(status='completed', pay_key='AP-1')
+        self.set_response('"refundInfoList": {"refundInfo": []}')
+
+        # INSERT refund, INSERT audit record, UPDATE refund, UPDATE payment
+        with self.assertNumQueries(4):
+            payment.refund()
+
+        self.assertEqual('refunded',
+                         Payment.objects.get(pk=payment.pk).status)
+        self.assertEqual(1, payment.refunds.count())
+        # the reverse accessor must not shadow Payment.refund()
+        self.assertTrue(callable(payment.refund))
+
+    def testPreapprovalProcess(self):
+        preapproval = PreapprovalFactory.create(money=Money(100, 'USD'))
+        self.set_response('"preapprovalKey": "PA-1"')
+
+        with self.assertNumQueries(2):
+            self.assertTrue(preapproval.process())
+
+        preapproval = Preapproval.objects.get(pk=preapproval.pk)
+        self.assertEqual('created', preapproval.status)
+        self.assertEqual('PA-1', preapproval.preapproval_key)
+
+    def testCancelPreapproval(self):
+        preapproval = PreapprovalFactory.create(status='approved',
+                                                preapproval_key='PA-1')
+        self.set_response('"status": "CANCELED"')
+
+        with self.assertNumQueries(2):
+            preapproval.cancel_preapproval()
+
+    def testMarkAsUsed(self):
+        preapproval = PreapprovalFactory.create(status='approved')
+
+        with self.assertNumQueries(1):
+            preapproval.mark_as_used()
+
+        self.assertEqual('used',
+                         Preapproval.objects.get(pk=preapproval.pk).status)
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', MockUpdateRequest)
+class TestUpdateQueries(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.payment = PaymentFactory.create(status='created',
+                                             pay_key='AP-1')
+
+    def testChangedUpdate(self):
+        MockUpdateRequest.set_response({'status': 'COMPLETED'})
+
+        with self.assertNumQueries(2):
+            self.payment.update()
+
+        self.assertEqual('completed',
+                         Payment.objects.get(pk=self.payment.pk).status)
+
+    @patch('paypaladaptive.settings.AUDIT_SAMPLE_RATE', 0)
+    def testUnchangedUpdateDoesNotWrite(self):
+        MockUpdateRequest.set_response({'status': 'CREATED'})
+
+        with self.assertNumQueries(0):
+            self.payment.update()
+
+        self.assertEqual(0, AuditRecord.objects.count())
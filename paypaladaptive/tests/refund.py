@@ -0,0 +1,315 @@
+import json
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from mock import patch
+from money.Money import Money
+
+from ..api import Refund as RefundEndpoint, DeadlineExceeded, Deadline
+from ..api.datatypes import Receiver, ReceiverList
+from ..api.httpwrapper import UrlResponse
+from ..api.ratelimit import RateLimiter
+from ..models import Payment, Refund
+from .factories import PaymentFactory
+
+
+def refund_info(email, status, full=True):
+    return {'receiver': {'email': email, 'amount': '10.00'},
+            'refundStatus': status,
+            'refundHasBecomeFull': 'true' if full else 'false'}
+
+
+class MockRefundRequest(object):
+    """
+    Answers Refund calls with the refundStatus that is part of the payKey,
+    AP-<STATUS>-n, for each receiver that was asked for. For AP-LOST-n the
+    refund goes through but the answer is lost. PaymentDetails calls show
+    the payments that were refunded.
+
+    """
+
+    calls = []
+    lookups = []
+    refunded = set()
+
+    def call(self, url, data=None, headers=None, deadline=None):
+        data = json.loads(data)
+
+        if url.endswith('PaymentDetails'):
+            self.lookups.append(data)
+            status = ('REFUNDED' if data['payKey'] in self.refunded
+                      else 'COMPLETED')
+            info = {'receiver': {'email': 'a@example.com', 'amount': '10.00'},
+                    'transactionStatus': status}
+            body = {'responseEnvelope': {'ack': 'Success'},
+                    'status': 'COMPLETED',
+                    'paymentInfoList': {'paymentInfo': [info]}}
+            self._response = UrlResponse(json.dumps(body), {}, 200)
+            return self
+
+        self.calls.append(data)
+        status = data['payKey'].split('-')[1]
+        receivers = data.get('receiverList', {}).get('receiver')
+
+        if status == 'LOST':
+            self.refunded.add(data['payKey'])
+            self._response = UrlResponse('', {}, 502)
+            return self
+        if status == 'REFUNDED':
+            self.refunded.add(data['payKey'])
+
+        if receivers:
+            info = [refund_info(r['email'], status, full=False)
+                    for r in receivers]
+        else:
+            info = [refund_info('a@example.com', status)]
+
+        body = {'responseEnvelope': {'ack': 'Success'},
+                'refundInfoList': {'refundInfo': info}}
+        self._response = UrlResponse(json.dumps(body), {}, 200)
+        return self
+
+    @property
+    def response(self):
+        return self._response.data
+
+    @property
+    def code(self):
+        return self._response.code
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestRefundEndpoint(TestCase):
+    def setUp(self):
+        self.receivers = ReceiverList([
+            Receiver(email='a@example.com', amount='10.00')])
+
+    def testFullRefund(self):
+        endpoint = RefundEndpoint('AP-1')
+
+        self.assertEqual('AP-1', endpoint.data['payKey'])
+        self.assertFalse('receiverList' in endpoint.data)
+
+    def testPartialRefund(self):
+        endpoint = RefundEndpoint('AP-1', receivers=self.receivers,
+                                  currency_code='USD')
+
+        self.assertEqual('USD', endpoint.data['currencyCode'])
+        self.assertEqual([{'email': 'a@example.com', 'amount': '10.00'}],
+                         endpoint.data['receiverList']['receiver'])
+
+    def testTotalAmount(self):
+        self.receivers.append(Receiver(email='b@example.com', amount=5))
+        self.receivers.append(Receiver(email='c@example.com',
+                                       amount=Decimal('0.50')))
+
+        self.assertEqual(Decimal('15.50'), self.receivers.total_amount)
+
+    def testPartialRefundNeedsCurrency(self):
+        self.assertRaises(ValueError, RefundEndpoint, 'AP-1',
+                          receivers=self.receivers)
+
+    def testStatus(self):
+        endpoint = RefundEndpoint('AP-1')
+
+        endpoint.response = {'refundInfoList': {'refundInfo': [
+            refund_info('a@example.com', 'REFUNDED'),
+            refund_info('b@example.com', 'PARTIALLY_REFUNDED', full=False)]}}
+        self.assertTrue(endpoint.refunded)
+        self.assertFalse(endpoint.refund_has_become_full)
+
+        endpoint.response = {'refundInfoList': {'refundInfo': [
+            refund_info('a@example.com', 'REFUNDED'),
+            refund_info('b@example.com', 'INSUFFICIENT_BALANCE')]}}
+        self.assertFalse(endpoint.refunded)
+
+
+class TestRateLimiter(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = patch.multiple(RateLimiter, clock=self.clock.time,
+                                 sleep=self.clock.sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testBurstThenRate(self):
+        limiter = RateLimiter(2, burst=2)
+
+        for i in range(4):
+            limiter.acquire()
+
+        self.assertEqual([0.5, 0.5], self.clock.slept)
+
+    def testDeadline(self):
+        limiter = RateLimiter(1, burst=1)
+        limiter.acquire()
+
+        deadline = Deadline(0.1)
+        self.assertRaises(DeadlineExceeded, limiter.acquire, deadline)
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', MockRefundRequest)
+class TestRefund(TestCase):
+    def setUp(self):
+        cache.clear()
+        MockRefundRequest.calls = []
+        MockRefundRequest.lookups = []
+        MockRefundRequest.refunded = set()
+
+    def get(self, obj):
+        return type(obj).objects.get(pk=obj.pk)
+
+    def testFullRefund(self):
+        payment = PaymentFactory.create(status='completed',
+                                        pay_key='AP-REFUNDED-1')
+
+        refund = payment.refund()
+
+        self.assertEqual('completed', self.get(refund).status)
+        self.assertEqual(payment.money, self.get(refund).money)
+        self.assertEqual('refunded', self.get(payment).status)
+        self.assertFalse('trackingId' in MockRefundRequest.calls[0])
+
+    def testPartialRefund(self):
+        payment = PaymentFactory.create(status='completed',
+                                        pay_key='AP-PARTIALLY_REFUNDED-1')
+        receivers = ReceiverList([
+            Receiver(email='a@example.com', amount='10.00')])
+
+        refund = self.get(payment.refund(receivers))
+
+        self.assertEqual('completed', refund.status)
+        self.assertEqual(Money('10.00', payment.money.currency), refund.money)
+        self.assertEqual('a@example.com', refund.receivers.receivers[0].email)
+        self.assertEqual('completed', self.get(payment).status)
+        self.assertEqual(1, payment.refunds.count())
+
+    def testLostResponseIsLookedUp(self):
+        payment = PaymentFactory.create(status='completed',
+                                        pay_key='AP-LOST-1')
+
+        refund = self.get(payment.refund())
+
+        self.assertEqual('completed', refund.status)
+        self.assertEqual('refunded', self.get(payment).status)
+        self.assertEqual(1, len(MockRefundRequest.calls))
+
+    def testRefused(self):
+        payment = PaymentFactory.create(status='completed',
+                                        pay_key='AP-REFUND_NOT_ALLOWED-1')
+
+        refund = self.get(payment.refund())
+
+        self.assertEqual('error', refund.status)
+        self.assertEqual('a@example.com: REFUND_NOT_ALLOWED',
+                         refund.status_detail)
+        self.assertEqual('completed', self.get(payment).status)
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', MockRefundRequest)
+class TestBulkRefund(TestCase):
+    def setUp(self):
+        cache.clear()
+        MockRefundRequest.calls = []
+        MockRefundRequest.lookups = []
+        MockRefundRequest.refunded = set()
+
+    def create(self, status, n, payment_status='completed'):
+        return PaymentFactory.create(status=payment_status,
+                                     pay_key='AP-%s-%s' % (status, n))
+
+    def testBulkRefund(self):
+        refunded = [self.create('REFUNDED', n) for n in range(5)]
+        refused = self.create('INSUFFICIENT_BALANCE', 5)
+        created = self.create('REFUNDED', 6, payment_status='created')
+        progress = []
+
+        stats = Refund.objects.bulk_refund(
+            refunded + [refused, created], max_workers=3, rate=None,
+            progress=lambda done, total: progress.append((done, total)))
+
+        self.assertEqual({'completed': 5, 'failed': 1, 'remaining': 0,
+                          'skipped': 1}, stats)
+        self.assertEqual([(n, 6) for n in range(1, 7)], progress)
+        self.assertEqual(5, Payment.objects.filter(status='refunded').count())
+        self.assertEqual('error',
+                         Refund.objects.get(payment=refused).status)
+        self.assertFalse(Refund.objects.filter(payment=created).exists())
+
+    def testResume(self):
+        payments = [self.create('REFUNDED', n) for n in range(3)]
+        refused = self.create('INSUFFICIENT_BALANCE', 3)
+
+        # a crashed run left a refund created and one never sent
+        Refund.for_payment(payments[0], status='created').save()
+        Refund.for_payment(payments[1]).save()
+        Refund.objects.bulk_refund(payments + [refused])
+        self.assertEqual(4, len(MockRefundRequest.calls))
+
+        stats = Refund.objects.bulk_refund(payments + [refused])
+        self.assertEqual({'completed': 0, 'failed': 0, 'remaining': 0,
+                          'skipped': 4}, stats)
+        self.assertEqual(4, len(MockRefundRequest.calls))
+        self.assertEqual(4, Refund.objects.count())
+
+        stats = Refund.objects.bulk_refund([refused], retry_failed=True)
+        self.assertEqual(1, stats['failed'])
+        self.assertEqual(5, len(MockRefundRequest.calls))
+
+    def testResumeLooksUpSentRefunds(self):
+        payment = self.create('REFUNDED', 0)
+        Refund.for_payment(payment, status='created').save()
+        MockRefundRequest.refunded.add(payment.pay_key)
+
+        stats = Refund.objects.bulk_refund([payment])
+
+        self.assertEqual(1, stats['completed'])
+        self.assertEqual([], MockRefundRequest.calls)
+        self.assertEqual(1, len(MockRefundRequest.lookups))
+        self.assertEqual('completed', Refund.objects.get().status)
+        self.assertEqual('refunded', Payment.objects.get().status)
+
+    def testLostResponseIsLookedUp(self):
+        payment = self.create('LOST', 0)
+
+        stats = Refund.objects.bulk_refund([payment])
+
+        self.assertEqual(1, stats['completed'])
+        self.assertEqual(1, len(MockRefundRequest.calls))
+        self.assertEqual('completed', Refund.objects.get().status)
+        self.assertEqual('refunded', Payment.objects.get().status)
+
+    def testProgressError(self):
+        payments = [self.create('REFUNDED', n) for n in range(3)]
+
+        def progress(done, total):
+            raise RuntimeError('progress bar went away')
+
+        stats = Refund.objects.bulk_refund(payments, max_workers=3,
+                                           progress=progress)
+
+        self.assertEqual(3, stats['completed'])
+        self.assertEqual(3, Refund.objects.filter(status='completed').count())
+
+    def testDeadline(self):
+        payments = [self.create('REFUNDED', n) for n in range(3)]
+
+        stats = Refund.objects.bulk_refund(payments, deadline=Deadline(0))
+
+        self.assertEqual(3, stats['remaining'])
+        self.assertEqual([], MockRefundRequest.calls)
+        self.assertEqual(3, Refund.objects.filter(status='created').count())
@@ -0,0 +1,147 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from mock import patch
+from money.Money import Money
+
+from .. import metrics
+from ..api import (Pay, PaymentDetails, Receiver, ReceiverList,
+                   TransportError, RequestTimeout)
+from ..api.deadline import Deadline
+from ..api.httpwrapper import UrlResponse
+from ..api.retry import RetryPolicy
+
+
+class FlakyRequest(object):
+    """Fails with a connection error until `failures` calls have been made"""
+
+    failures = 0
+    calls = 0
+
+    def call(self, url, data=None, headers=None, deadline=None):
+        FlakyRequest.calls += 1
+        if FlakyRequest.calls <= FlakyRequest.failures:
+            self._response = UrlResponse('connection refused', {}, None)
+        else:
+            self._response = UrlResponse(
+                '{"responseEnvelope": {"ack": "Success"}, '
+                '"status": "COMPLETED"}', {}, 200)
+        return self
+
+    @property
+    def response(self):
+        return self._response.data
+
+    @property
+    def code(self):
+        return self._response.code
+
+
+@patch('paypaladaptive.api.retry.RetryPolicy.sleep',
+       staticmethod(lambda seconds: None))
+class TestRetryPolicy(TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(max_attempts=3, backoff=1, max_backoff=3,
+                                  jitter=0)
+
+    def testBackoffIsExponentialAndCapped(self):
+        self.assertEqual([1, 2, 3, 3],
+                         [self.policy.get_backoff(n) for n in range(1, 5)])
+
+    def testJitterShortensBackoff(self):
+        policy = RetryPolicy(backoff=1, max_backoff=1, jitter=0.5)
+
+        for __ in range(20):
+            self.assertTrue(0.5 <= policy.get_backoff(1) <= 1)
+
+    def testRetriesUntilSuccess(self):
+        results = [RequestTimeout('slow'), TransportError('down'), 'ok']
+
+        def function():
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        attempts = []
+        self.assertEqual('ok', self.policy.run(function, attempts=attempts))
+        self.assertEqual([1, 2, 3], [a.number for a in attempts])
+        self.assertEqual([1, 2, 0], [a.backoff for a in attempts])
+
+    def testGivesUpAfterMaxAttempts(self):
+        def function():
+            raise TransportError('down')
+
+        attempts = []
+        with self.assertRaises(TransportError):
+            self.policy.run(function, attempts=attempts)
+
+        self.assertEqual(3, len(attempts))
+
+    def testDoesNotRetryBeyondDeadline(self):
+        def function():
+            raise TransportError('down')
+
+        attempts = []
+        with self.assertRaises(TransportError):
+            self.policy.run(function, deadline=Deadline(0.5),
+                            attempts=attempts)
+
+        self.assertEqual(1, len(attempts))
+
+    def testRecordsRetryMetrics(self):
+        metrics.reset()
+        results = [None, 'ok']
+
+        self.policy.run(lambda: results.pop(0),
+                        retry_result=lambda result: result is None)
+
+        self.assertEqual(1, metrics.get('api.retry.attempts'))
+        self.assertTrue(metrics.get('api.retry.seconds') >= 1)
+
+
+@patch('paypaladaptive.api.retry.RetryPolicy.sleep',
+       staticmethod(lambda seconds: None))
+@patch('paypaladaptive.api.endpoints.UrlRequest', FlakyRequest)
+class TestEndpointRetries(TestCase):
+    def setUp(self):
+        cache.clear()
+        FlakyRequest.calls = 0
+        FlakyRequest.failures = 1
+
+    def tearDown(self):
+        cache.clear()
+
+    def get_pay(self, **kwargs):
+        receivers = ReceiverList([Receiver(amount=10, email='a@example.com',
+                                           primary=True)])
+        return Pay(Money(10, 'USD'), 'http://return', 'http://cancel',
+                   receivers, **kwargs)
+
+    def testDetailsAreRetried(self):
+        endpoint = PaymentDetails(payKey='AP-123')
+        endpoint.call()
+
+        self.assertEqual(2, FlakyRequest.calls)
+        self.assertEqual(2, len(endpoint.attempts))
+        self.assertEqual('COMPLETED', endpoint.response['status'])
+
+    def testDetailsGiveUpWithTransportError(self):
+        FlakyRequest.failures = 10
+
+        with self.assertRaises(TransportError):
+            PaymentDetails(payKey='AP-123').call()
+
+        self.assertEqual(3, FlakyRequest.calls)
+
+    def testPayIsNotRetried(self):
+        with self.assertRaises(TransportError):
+            self.get_pay().call()
+
+        self.assertEqual(1, FlakyRequest.calls)
+
+    def testPayWithTrackingIdIsNotRetried(self):
+        with self.assertRaises(TransportError):
+            self.get_pay(trackingId='campaign-1-payment-1').call()
+
+        self.assertEqual(1, FlakyRequest.calls)
@@ -0,0 +1,211 @@
+import json
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from mock import patch
+
+from .. import settings
+from ..api.datatypes import Receiver, ReceiverList
+from ..api.httpwrapper import UrlResponse
+from ..models import Payment, Preapproval
+from .factories import PreapprovalFactory
+
+
+class MockSettlementRequest(object):
+    """
+    Pays with the paymentExecStatus that is part of the preapprovalKey,
+    PA-<STATUS>-n, and remembers the trackingIds it was paid with.
+
+    """
+
+    pay_calls = []
+    paid = {}
+    details_error = None
+
+    def call(self, url, data=None, headers=None, deadline=None):
+        data = json.loads(data)
+        envelope = {'responseEnvelope': {'ack': 'Success'}}
+
+        if url.endswith('PaymentDetails'):
+            status = self.paid.get(data['trackingId'])
+            if self.details_error is not None:
+                body = {'responseEnvelope': {'ack': 'Failure'},
+                        'error': [{'errorId': self.details_error,
+                                   'message': 'Internal error'}]}
+            elif status is None:
+                body = {'responseEnvelope': {'ack': 'Failure'},
+                        'error': [{'errorId': '580022',
+                                   'message': 'Invalid request'}]}
+            else:
+                body = dict(envelope, status=status,
+                            payKey='AP-%s' % data['trackingId'])
+        else:
+            self.pay_calls.append(data)
+            if data['preapprovalKey'].startswith('PA-BROKEN'):
+                raise RuntimeError('Unexpected error')
+            status = data['preapprovalKey'].split('-')[1]
+            self.paid[data['trackingId']] = status
+            body = dict(envelope, paymentExecStatus=status,
+                        payKey='AP-%s' % data['trackingId'])
+
+        self._response = UrlResponse(json.dumps(body), {}, 200)
+        return self
+
+    @property
+    def response(self):
+        return self._response.data
+
+    @property
+    def code(self):
+        return self._response.code
+
+
+def get_receivers(preapproval):
+    return ReceiverList([Receiver(amount=100, email='a@example.com',
+                                  primary=True)])
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', MockSettlementRequest)
+class TestSettlement(TestCase):
+    def setUp(self):
+        cache.clear()
+        MockSettlementRequest.pay_calls = []
+        MockSettlementRequest.paid = {}
+        MockSettlementRequest.details_error = None
+
+    def create(self, status, n, preapproval_status='approved'):
+        return PreapprovalFactory.create(
+            status=preapproval_status,
+            preapproval_key='PA-%s-%s' % (status, n))
+
+    def get(self, obj):
+        return type(obj).objects.get(pk=obj.pk)
+
+    def testSettle(self):
+        completed = [self.create('COMPLETED', n) for n in range(4)]
+        failed = self.create('ERROR', 4)
+        self.create('COMPLETED', 5, preapproval_status='created')
+        progress = []
+
+        report = Preapproval.objects.settle(
+            get_receivers, max_workers=3, rate=None,
+            progress=lambda done, total: progress.append(done))
+
+        self.assertEqual(4, report['completed'])
+        self.assertEqual(1, report['failed'])
+        self.assertEqual(1, report['skipped'])
+        self.assertEqual([failed.pk], report['failures'].keys())
+        self.assertEqual(range(1, 6), progress)
+
+        for preapproval in completed:
+            self.assertEqual('used', self.get(preapproval).status)
+            payment = Payment.objects.get(preapproval=preapproval)
+            self.assertEqual('completed', payment.status)
+            self.assertEqual(preapproval.settlement_tracking_id,
+                             payment.tracking_id)
+
+        self.assertEqual('approved', self.get(failed).status)
+        self.assertEqual('error',
+                         Payment.objects.get(preapproval=failed).status)
+
+    def testSecondRunSkips(self):
+        preapprovals = [self.create('COMPLETED', n) for n in range(3)]
+        Preapproval.objects.settle(get_receivers)
+
+        report = Preapproval.objects.filter(
+            pk__in=[p.pk for p in preapprovals]).settle(get_receivers)
+
+        self.assertEqual(3, report['skipped'])
+        self.assertEqual(3, len(MockSettlementRequest.pay_calls))
+        self.assertEqual(3, Payment.objects.count())
+
+    def testResumeWithoutDoubleCharge(self):
+        """A payment left created is looked up before it's paid"""
+
+        charged = self.create('COMPLETED', 1)
+        never_sent = self.create('COMPLETED', 2)
+
+        for preapproval in (charged, never_sent):
+            Payment(money=preapproval.money, preapproval=preapproval,
+                    status='created',
+                    tracking_id=preapproval.settlement_tracking_id).save()
+        MockSettlementRequest.paid[charged.settlement_tracking_id] = (
+            'COMPLETED')
+
+        report = Preapproval.objects.settle(get_receivers)
+
+        self.assertEqual(2, report['completed'])
+        self.assertEqual([never_sent.settlement_tracking_id],
+                         [c['trackingId'] for c in
+                          MockSettlementRequest.pay_calls])
+        self.assertEqual('used', self.get(charged).status)
+        self.assertEqual('used', self.get(never_sent).status)
+
+    def testMarkAsUsed(self):
+        for n in range(3):
+            self.create('COMPLETED', n)
+        canceled = self.create('COMPLETED', 3, preapproval_status='canceled')
+
+        self.assertEqual(3, Preapproval.objects.all().mark_as_used())
+
+        self.assertEqual(3, Preapproval.objects.filter(status='used').count())
+        self.assertEqual('canceled', self.get(canceled).status)
+
+    def testLookupErrorLeavesPaymentCreated(self):
+        """Only Paypal not knowing the trackingId means it wasn't paid"""
+
+        preapproval = self.create('COMPLETED', 1)
+        Payment(money=preapproval.money, preapproval=preapproval,
+                status='created',
+                tracking_id=preapproval.settlement_tracking_id).save()
+        MockSettlementRequest.details_error = '520002'
+
+        report = Preapproval.objects.settle(get_receivers)
+
+        self.assertEqual(1, report['remaining'])
+        self.assertEqual([], MockSettlementRequest.pay_calls)
+        self.assertEqual('created',
+                         Payment.objects.get(preapproval=preapproval).status)
+        self.assertEqual('approved', self.get(preapproval).status)
+
+    def testDecimalAmounts(self):
+        preapproval = self.create('COMPLETED', 1)
+        calls = []
+
+        def get_decimal_receivers(preapproval):
+            calls.append(preapproval.pk)
+            return ReceiverList([Receiver(amount=Decimal('100.00'),
+                                          email='a@example.com',
+                                          primary=True)])
+
+        report = Preapproval.objects.settle(get_decimal_receivers)
+
+        self.assertEqual(1, report['completed'])
+        self.assertEqual([preapproval.pk], calls)
+        self.assertEqual('100.00', MockSettlementRequest.pay_calls[0][
+            'receiverList']['receiver'][0]['amount'])
+
+    def testUnexpectedErrorFailsOnlyItsPayment(self):
+        paid = self.create('COMPLETED', 1)
+        broken = self.create('BROKEN', 2)
+
+        report = Preapproval.objects.settle(get_receivers)
+
+        self.assertEqual(1, report['completed'])
+        self.assertEqual(1, report['failed'])
+        self.assertEqual([broken.pk], report['failures'].keys())
+        self.assertEqual('used', self.get(paid).status)
+        self.assertEqual('error',
+                         Payment.objects.get(preapproval=broken).status)
+
+    @patch.object(settings, 'USE_DELAYED_UPDATES', True)
+    def testNewPaymentsAreScheduled(self):
+        preapproval = self.create('COMPLETED', 1)
+
+        Preapproval.objects.settle(get_receivers)
+
+        payment = Payment.objects.get(preapproval=preapproval)
+        self.assertNotEqual(None, payment.next_check_at)
+
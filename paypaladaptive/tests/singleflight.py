@@ -0,0 +1,202 @@
+import json
+import threading
+
+from django.core.cache import cache, get_cache
+from django.test import TestCase
+
+from mock import patch
+
+from .. import metrics
+from ..api import PaymentDetails, PaypalAdaptiveApiError
+from ..api.deadline import Deadline
+from ..api.errors import DeadlineExceeded
+from ..api.httpwrapper import UrlResponse
+from ..api.singleflight import SingleFlight
+
+
+class GatedDetailsRequest(object):
+    """Blocks every call until `gate` is set, counting the calls made"""
+
+    calls = 0
+    gate = threading.Event()
+
+    def call(self, url, data=None, headers=None, deadline=None):
+        GatedDetailsRequest.calls += 1
+        GatedDetailsRequest.gate.wait(5)
+        body = {'responseEnvelope': {'ack': 'Success'},
+                'status': 'COMPLETED'}
+        self._response = UrlResponse(json.dumps(body), {}, 200)
+        return self
+
+    @property
+    def response(self):
+        return self._response.data
+
+    @property
+    def code(self):
+        return self._response.code
+
+
+def run_concurrently(function, count):
+    results = [None] * count
+
+    def run(n):
+        try:
+            results[n] = function()
+        except Exception, e:
+            results[n] = e
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+class TestSingleFlight(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        self.flight = SingleFlight('test', cache_alias='')
+        self.calls = 0
+        self.gate = threading.Event()
+
+    def slow_call(self):
+        self.calls += 1
+        self.gate.wait(5)
+        return 'result %s' % self.calls
+
+    def wait_for_leader(self):
+        for __ in range(500):
+            if self.calls:
+                break
+            threading.Event().wait(0.01)
+        # give the other threads time to queue up behind the leader
+        threading.Event().wait(0.1)
+
+    def testConcurrentCallsAreShared(self):
+        threads, results = run_concurrently(
+            lambda: self.flight.do('key', self.slow_call), 10)
+        self.wait_for_leader()
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, self.calls)
+        self.assertEqual(['result 1'] * 10, results)
+        self.assertEqual(9, metrics.get('api.single_flight.shared'))
+
+    def testErrorsAreShared(self):
+        def failing_call():
+            self.calls += 1
+            self.gate.wait(5)
+            raise PaypalAdaptiveApiError('failed')
+
+        threads, results = run_concurrently(
+            lambda: self.flight.do('key', failing_call), 5)
+        self.wait_for_leader()
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, self.calls)
+        self.assertTrue(all(isinstance(result, PaypalAdaptiveApiError)
+                            for result in results))
+
+    def testFinishedCallsAreNotRemembered(self):
+        self.gate.set()
+
+        self.assertEqual('result 1', self.flight.do('key', self.slow_call))
+        self.assertEqual('result 2', self.flight.do('key', self.slow_call))
+        self.assertEqual({}, self.flight._calls)
+
+    def testFollowerRespectsDeadline(self):
+        threads, results = run_concurrently(
+            lambda: self.flight.do('key', self.slow_call), 1)
+        self.wait_for_leader()
+
+        with self.assertRaises(DeadlineExceeded):
+            self.flight.do('key', self.slow_call, deadline=Deadline(0.05))
+
+        self.gate.set()
+        threads[0].join()
+
+
+class TestSharedSingleFlight(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        self.flight = SingleFlight('test', cache_alias='default',
+                                   poll_interval=0.01)
+        self.flight.sleep = lambda seconds: None
+
+    def testLeaderStoresResultAndReleasesLock(self):
+        self.assertEqual('ok', self.flight.do('key', lambda: 'ok'))
+
+        self.assertEqual(None, cache.get('paypaladaptive:flight:test:key:lock'))
+
+    def testWaitsForResultOfOtherProcess(self):
+        cache.set('paypaladaptive:flight:test:key:lock', 'other', 60)
+        polls = []
+
+        def sleep(seconds):
+            polls.append(seconds)
+            cache.set('paypaladaptive:flight:test:key:result',
+                      ('other', 'shared'), 60)
+            cache.delete('paypaladaptive:flight:test:key:lock')
+
+        self.flight.sleep = sleep
+
+        self.assertEqual('shared', self.flight.do('key', lambda: 'own'))
+        self.assertEqual(1, len(polls))
+        self.assertEqual(1, metrics.get('api.single_flight.shared'))
+
+    def testCallsItselfWhenOtherProcessFails(self):
+        cache.set('paypaladaptive:flight:test:key:lock', 'other', 60)
+        cache.set('paypaladaptive:flight:test:key:result', ('old', 'stale'),
+                  60)
+        self.flight.sleep = lambda seconds: cache.delete(
+            'paypaladaptive:flight:test:key:lock')
+
+        self.assertEqual('own', self.flight.do('key', lambda: 'own'))
+
+    def testWaitRespectsDeadline(self):
+        cache.set('paypaladaptive:flight:test:key:lock', 'other', 60)
+
+        with self.assertRaises(DeadlineExceeded):
+            self.flight.do('key', lambda: 'own', deadline=Deadline(0.001))
+
+    def testCacheIsResolvedOnce(self):
+        with patch('paypaladaptive.api.singleflight.get_cache',
+                   wraps=get_cache) as mock_get_cache:
+            self.flight.do('key', lambda: 'ok')
+            self.flight.do('other', lambda: 'ok')
+
+        self.assertEqual(1, mock_get_cache.call_count)
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', GatedDetailsRequest)
+class TestEndpointSingleFlight(TestCase):
+    def setUp(self):
+        cache.clear()
+        GatedDetailsRequest.calls = 0
+        GatedDetailsRequest.gate = threading.Event()
+
+    def call(self):
+        endpoint = PaymentDetails(payKey='AP-1')
+        endpoint.call()
+        return endpoint
+
+    def testConcurrentDetailsLookupsShareOneRequest(self):
+        threads, results = run_concurrently(self.call, 5)
+        for __ in range(500):
+            if GatedDetailsRequest.calls:
+                break
+            threading.Event().wait(0.01)
+        threading.Event().wait(0.1)
+        GatedDetailsRequest.gate.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, GatedDetailsRequest.calls)
+        self.assertEqual(['COMPLETED'] * 5,
+                         [endpoint.response['status'] for endpoint in results])
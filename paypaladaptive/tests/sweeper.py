@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.db.models import F
+from django.test import TestCase
+
+from mock import patch
+
+from .. import settings
+from ..api import Deadline
+from ..managers import get_check_interval
+from ..models import Payment
+from .bulk import MockBulkDetailsRequest
+from .factories import PaymentFactory
+
+
+@patch('paypaladaptive.api.endpoints.UrlRequest', MockBulkDetailsRequest)
+class TestSweeper(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.past = datetime.now() - timedelta(minutes=1)
+
+    def create(self, pay_key, status='created', **kwargs):
+        kwargs.setdefault('next_check_at', self.past)
+        return PaymentFactory.create(status=status, pay_key=pay_key,
+                                     **kwargs)
+
+    def get(self, payment):
+        return Payment.objects.get(pk=payment.pk)
+
+    def testCheckInterval(self):
+        with patch.object(settings, 'SWEEP_INTERVALS',
+                          {'created': timedelta(minutes=30)}):
+            self.assertEqual(timedelta(minutes=30),
+                             get_check_interval('created', 0))
+            self.assertEqual(timedelta(minutes=120),
+                             get_check_interval('created', 2))
+            self.assertEqual(settings.SWEEP_MAX_INTERVAL,
+                             get_check_interval('created', 10))
+            self.assertEqual(None, get_check_interval(
+                'created', settings.SWEEP_MAX_CHECKS))
+            self.assertEqual(None, get_check_interval('completed', 0))
+
+    @patch.object(settings, 'USE_DELAYED_UPDATES', True)
+    def testSaveSchedulesCheck(self):
+        payment = Payment()
+        payment.save()
+
+        next_check_at = self.get(payment).next_check_at
+        self.assertTrue(next_check_at > datetime.now())
+        self.assertTrue(next_check_at <= datetime.now()
+                        + settings.DELAYED_UPDATE_COUNTDOWN)
+
+    def testSweep(self):
+        completed = self.create('AP-COMPLETED-1')
+        created = self.create('AP-CREATED-2', check_count=1)
+        failed = self.create('AP-FAIL-3')
+        refunded = self.create('AP-COMPLETED-4', status='refunded')
+        later_check_at = datetime.now() + timedelta(minutes=10)
+        later = self.create('AP-COMPLETED-5', next_check_at=later_check_at)
+
+        stats = Payment.objects.sweep(chunk_size=2)
+
+        self.assertEqual({'updated': 1, 'unchanged': 1, 'failed': 1}, stats)
+
+        self.assertEqual('completed', self.get(completed).status)
+        self.assertEqual(None, self.get(completed).next_check_at)
+
+        created = self.get(created)
+        self.assertEqual(2, created.check_count)
+        self.assertTrue(created.next_check_at > datetime.now()
+                        + get_check_interval('created', 1)
+                        - timedelta(minutes=1))
+
+        self.assertTrue(self.get(failed).next_check_at > datetime.now())
+
+        # not looked up, only unscheduled
+        self.assertEqual('refunded', self.get(refunded).status)
+        self.assertEqual(None, self.get(refunded).next_check_at)
+
+        # not due yet
+        self.assertEqual('created', self.get(later).status)
+        self.assertEqual(later_check_at, self.get(later).next_check_at)
+        self.assertEqual(0, self.get(later).check_count)
+
+    def testOverlappingSweep(self):
+        """Objects claimed by another sweep aren't checked twice"""
+
+        payment = self.create('AP-CREATED-1')
+        other = self.create('AP-CREATED-2')
+        due = list(Payment.objects.due().values_list('pk', 'next_check_at'))
+
+        # another sweep claims payment after we read it
+        Payment.objects.filter(pk=payment.pk).update(
+            next_check_at=datetime.now() + timedelta(minutes=10))
+        claimed_until = datetime.now() + timedelta(minutes=5)
+
+        self.assertEqual([other.pk],
+                         Payment.objects.all()._claim(due, claimed_until))
+        self.assertEqual(claimed_until, self.get(other).next_check_at)
+
+        stats = Payment.objects.sweep()
+        self.assertEqual({'updated': 0, 'unchanged': 0, 'failed': 0}, stats)
+
+    def testRaceLosersAreUnchanged(self):
+        """A row whose status changed before the UPDATE isn't updated"""
+
+        payment = self.create('AP-COMPLETED-1')
+        refresh = Payment.objects.filter(pk=payment.pk)
+        list(refresh)
+        # as transition() would, e.g. for a cancellation IPN
+        Payment.objects.filter(pk=payment.pk).update(
+            status='canceled', version=F('version') + 1)
+
+        stats = refresh.refresh_from_paypal()
+
+        self.assertEqual({'updated': 0, 'unchanged': 1, 'failed': 0}, stats)
+        self.assertEqual('canceled', self.get(payment).status)
+
+    def testNoDowngrade(self):
+        """A refresh doesn't overwrite a status changed in the meantime"""
+
+        payment = self.create('AP-CREATED-1', status='completed')
+
+        Payment.objects.filter(pk=payment.pk).refresh_from_paypal()
+
+        self.assertEqual('completed', self.get(payment).status)
+
+    def testDeadline(self):
+        payment = self.create('AP-COMPLETED-1')
+
+        deadline = Deadline(0)
+        stats = Payment.objects.sweep(deadline=deadline)
+
+        self.assertEqual({'updated': 0, 'unchanged': 0, 'failed': 0}, stats)
+        self.assertEqual('created', self.get(payment).status)
@@ -0,0 +1,99 @@
+import django.test as test
+
+import mock
+
+from paypaladaptive.models import Payment, Preapproval
+
+from factories import PaymentFactory, PreapprovalFactory
+from helpers import MockIPNVerifyRequest, mock_ipn_call
+
+
+class TestStatusTransitions(test.TestCase):
+    def testAllowed(self):
+        payment = PaymentFactory.create(status='created')
+
+        self.assertTrue(payment.transition('completed', transaction_id='1'))
+        self.assertEqual('completed', payment.status)
+
+        payment = Payment.objects.get(pk=payment.pk)
+        self.assertEqual('completed', payment.status)
+        self.assertEqual('1', payment.transaction_id)
+
+    def testRefused(self):
+        payment = PaymentFactory.create(status='completed')
+
+        self.assertFalse(payment.transition('error', status_detail='late'))
+        self.assertEqual('completed', payment.status)
+
+        payment = Payment.objects.get(pk=payment.pk)
+        self.assertEqual('completed', payment.status)
+        self.assertEqual('', payment.status_detail)
+
+    def testCanTransition(self):
+        preapproval = PreapprovalFactory.create(status='approved')
+
+        self.assertTrue(preapproval.can_transition('approved'))
+        self.assertTrue(preapproval.can_transition('used'))
+        self.assertFalse(preapproval.can_transition('created'))
+        self.assertFalse(preapproval.can_transition('approved', 'canceled'))
+
+    def testVersion(self):
+        payment = PaymentFactory.create(status='new')
+        version = payment.version
+
+        payment.transition('created')
+        self.assertEqual(version + 1, payment.version)
+        self.assertEqual(version + 1,
+                         Payment.objects.get(pk=payment.pk).version)
+
+        payment.save_fields('status_detail')
+        self.assertEqual(version + 2,
+                         Payment.objects.get(pk=payment.pk).version)
+
+    def testStaleInstanceRetries(self):
+        """A change by someone else is reloaded before the transition"""
+
+        payment = PaymentFactory.create(status='created')
+        Payment.objects.get(pk=payment.pk).transition('returned')
+
+        self.assertTrue(payment.transition('completed'))
+        self.assertEqual('completed',
+                         Payment.objects.get(pk=payment.pk).status)
+
+    def testStaleInstanceLoses(self):
+        """A stale instance can't overwrite a concurrent completion"""
+
+        payment = PaymentFactory.create(status='created')
+        Payment.objects.get(pk=payment.pk).transition('completed')
+
+        self.assertFalse(payment.transition('canceled'))
+        self.assertEqual('completed', payment.status)
+        self.assertEqual('completed',
+                         Payment.objects.get(pk=payment.pk).status)
+
+    def testUnsaved(self):
+        preapproval = PreapprovalFactory.build(status='new')
+
+        self.assertTrue(preapproval.transition('error'))
+        self.assertEqual('error',
+                         Preapproval.objects.get(pk=preapproval.pk).status)
+
+    @mock.patch('paypaladaptive.api.ipn.endpoints.UrlRequest',
+                MockIPNVerifyRequest)
+    def testIPNAfterRefund(self):
+        """A late IPN doesn't undo a refund"""
+
+        payment = PaymentFactory.create(status='refunded')
+        data = {
+            'status': 'COMPLETED',
+            'transaction_type': 'Adaptive Payment PAY',
+            'transaction[0].id': '1',
+            'transaction[0].amount': str(payment.money),
+            'transaction[0].status': 'COMPLETED',
+        }
+
+        response = mock_ipn_call(data, payment.ipn_url)
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual('refunded',
+                         Payment.objects.get(pk=payment.pk).status)
@@ -0,0 +1,82 @@
+from django.core.cache import cache, get_cache
+from django.test import TestCase
+
+from mock import patch
+
+from .. import metrics
+from ..tasks import delay_update, update_payment
+from .factories import PaymentFactory, PreapprovalFactory
+
+
+class TestUpdateDeduplication(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+
+    @patch('paypaladaptive.tasks.update_payment.delay')
+    def testSuppressesDuplicates(self, delay):
+        payment = PaymentFactory.create(status='created')
+
+        self.assertTrue(delay_update(payment))
+        self.assertFalse(delay_update(payment))
+        self.assertFalse(delay_update(payment))
+
+        self.assertEqual(1, delay.call_count)
+        self.assertEqual(payment.pk, delay.call_args[1]['payment_id'])
+        self.assertEqual(2, metrics.get('tasks.update.suppressed'))
+
+    @patch('paypaladaptive.tasks.update_preapproval.delay')
+    @patch('paypaladaptive.tasks.update_payment.delay')
+    def testPerObject(self, payment_delay, preapproval_delay):
+        delay_update(PaymentFactory.create())
+        delay_update(PaymentFactory.create())
+        delay_update(PreapprovalFactory.create())
+
+        self.assertEqual(2, payment_delay.call_count)
+        self.assertEqual(1, preapproval_delay.call_count)
+        self.assertEqual(0, metrics.get('tasks.update.suppressed'))
+
+    @patch('paypaladaptive.tasks.update_payment.delay')
+    def testReleasedAfterRun(self, delay):
+        payment = PaymentFactory.create(status='completed')
+
+        delay_update(payment)
+        update_payment(**delay.call_args[1])
+
+        self.assertTrue(delay_update(payment))
+        self.assertEqual(2, delay.call_count)
+
+    @patch('paypaladaptive.tasks.update_payment.delay')
+    def testStaleLeaseIsKept(self, delay):
+        """A task holding an expired lease doesn't release a newer one"""
+
+        payment = PaymentFactory.create(status='completed')
+
+        delay_update(payment)
+        update_payment(payment.pk, lease='expired')
+
+        self.assertFalse(delay_update(payment))
+
+    @patch('paypaladaptive.tasks.update_payment.delay')
+    def testReleasedWhenQueueingFails(self, delay):
+        payment = PaymentFactory.create(status='created')
+        delay.side_effect = IOError('broker is down')
+
+        self.assertRaises(IOError, delay_update, payment)
+
+        delay.side_effect = None
+        self.assertTrue(delay_update(payment))
+        self.assertEqual(2, delay.call_count)
+
+    @patch('paypaladaptive.tasks._lease_cache', None)
+    @patch('paypaladaptive.tasks.update_payment.delay')
+    def testLeaseCacheIsResolvedOnce(self, delay):
+        payment = PaymentFactory.create(status='completed')
+
+        with patch('paypaladaptive.tasks.get_cache',
+                   wraps=get_cache) as mock_get_cache:
+            delay_update(payment)
+            update_payment(**delay.call_args[1])
+            delay_update(payment)
+
+        self.assertEqual(1, mock_get_cache.call_count)
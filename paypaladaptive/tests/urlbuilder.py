@@ -0,0 +1,85 @@
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from mock import patch
+
+from ..urlbuilder import UrlBuilder, url_builder
+from .factories import PaymentFactory, PreapprovalFactory
+
+
+class TestUrlBuilder(TestCase):
+    def setUp(self):
+        self.builder = UrlBuilder()
+        self.site = Site.objects.get_current()
+
+    def tearDown(self):
+        url_builder.clear()
+
+    def testBuild(self):
+        url = self.builder.build('paypal-adaptive-payment-return',
+                                 payment_id=12, secret_uuid='abc123')
+        path = reverse('paypal-adaptive-payment-return',
+                       kwargs={'payment_id': 12, 'secret_uuid': 'abc123'})
+
+        self.assertEqual('http://%s%s' % (self.site.domain, path), url)
+
+    def testTemplateIsReversedOnce(self):
+        self.builder.build('paypal-adaptive-preapproval-cancel',
+                           preapproval_id=1)
+
+        with patch('paypaladaptive.urlbuilder.reverse') as reverse_mock:
+            url = self.builder.build('paypal-adaptive-preapproval-cancel',
+                                     preapproval_id=2)
+
+        self.assertFalse(reverse_mock.called)
+        self.assertTrue(url.endswith('/pre/cancel/2/'))
+
+    def testBaseUrlIsCached(self):
+        self.builder.get_base_url()
+
+        with self.assertNumQueries(0):
+            self.builder.get_base_url()
+
+    def testSiteChangeClearsCachedBaseUrl(self):
+        url_builder.get_base_url()
+        self.site.domain = 'changed.example.com'
+        self.site.save()
+
+        self.assertEqual('http://changed.example.com',
+                         url_builder.get_base_url())
+
+    def testSettings(self):
+        self.assertEqual('https://%s' % self.site.domain,
+                         UrlBuilder(scheme='https').get_base_url())
+        self.assertEqual('https://pay.example.com',
+                         UrlBuilder(site_url='https://pay.example.com/')
+                         .get_base_url())
+
+    def testRequestHost(self):
+        request = RequestFactory().get('/', HTTP_HOST='shop.example.com',
+                                       **{'wsgi.url_scheme': 'https'})
+
+        self.assertEqual('https://shop.example.com',
+                         self.builder.get_base_url(request))
+
+    def testModelUrls(self):
+        payment = PaymentFactory.create()
+        preapproval = PreapprovalFactory.create()
+        request = RequestFactory().get('/', HTTP_HOST='shop.example.com')
+
+        self.assertEqual(
+            'http://%s%s' % (self.site.domain, reverse(
+                'paypal-adaptive-ipn',
+                kwargs={'object_id': payment.id,
+                        'object_secret_uuid': payment.secret_uuid})),
+            payment.ipn_url)
+        self.assertTrue(payment.get_cancel_url(request).startswith(
+            'http://shop.example.com/'))
+        self.assertEqual(
+            'http://%s%s' % (self.site.domain, reverse(
+                'paypal-adaptive-preapproval-return',
+                kwargs={'preapproval_id': preapproval.id,
+                        'secret_uuid': preapproval.secret_uuid})),
+            preapproval.return_url)
@@ -0,0 +1,95 @@
+"""
+Building of the absolute return, cancel and IPN URLs sent to Paypal.
+
+Every named URL is reversed once into a template, and the base URL of the
+site is looked up once and cached until a Site is saved or deleted, so that
+building a URL doesn't hit the URL resolver or the database.
+
+"""
+
+import threading
+
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from django.db.models.signals import post_delete, post_save
+
+import settings
+
+
+class UrlBuilder(object):
+    """
+    Formats absolute URLs of named URL patterns.
+
+    The base URL is taken from the request when one is given, so that each
+    request gets URLs on its own host and scheme. Otherwise it is
+    `site_url` (`PAYPAL_SITE_URL`) if set, or the domain of the current
+    Site with `scheme` (`PAYPAL_URL_SCHEME`).
+
+    """
+
+    def __init__(self, site_url=None, scheme=None):
+        self.site_url = site_url
+        self.scheme = scheme
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._base_url = None
+
+    def get_base_url(self, request=None):
+        if request is not None:
+            scheme = 'https' if request.is_secure() else 'http'
+            return '%s://%s' % (scheme, request.get_host())
+
+        site_url = self.site_url or settings.SITE_URL
+        if site_url:
+            return site_url.rstrip('/')
+
+        if self._base_url is None:
+            domain = Site.objects.get_current().domain
+            self._base_url = '%s://%s' % (self.scheme or settings.URL_SCHEME,
+                                          domain)
+        return self._base_url
+
+    def get_template(self, name, kwarg_names):
+        """Reverse name once with placeholder values into a path template"""
+
+        key = (name, kwarg_names)
+        template = self._templates.get(key)
+
+        if template is None:
+            # digits match both the \d+ and \w+ groups of our patterns
+            placeholders = dict((kwarg, '7' * 12 + str(n))
+                                for n, kwarg in enumerate(kwarg_names))
+            template = reverse(name, kwargs=placeholders).replace('%', '%%')
+
+            # longest first, so no placeholder is a prefix of another
+            for kwarg, placeholder in sorted(placeholders.items(),
+                                             key=lambda i: -len(i[1])):
+                template = template.replace(placeholder, '%%(%s)s' % kwarg)
+
+            with self._lock:
+                self._templates[key] = template
+
+        return template
+
+    def build(self, name, request=None, **kwargs):
+        template = self.get_template(name, tuple(sorted(kwargs)))
+        return self.get_base_url(request) + template % kwargs
+
+    def clear(self):
+        """Forget the cached base URL and templates"""
+
+        with self._lock:
+            self._templates = {}
+            self._base_url = None
+
+
+url_builder = UrlBuilder()
+
+
+def clear_base_url(sender, **kwargs):
+    url_builder._base_url = None
+
+post_save.connect(clear_base_url, sender=Site,
+                  dispatch_uid='paypaladaptive.urlbuilder.post_save')
+post_delete.connect(clear_base_url, sender=Site,
+                    dispatch_uid='paypaladaptive.urlbuilder.post_delete')
@@ -8,7 +8,8 @@ import logging
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
 from django.http import (HttpResponseServerError, HttpResponseRedirect,
-                         HttpResponseBadRequest, HttpResponse, Http404)
+                         HttpResponseBadRequest, HttpResponse, Http404,
+                         QueryDict)
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
 from django.shortcuts import get_object_or_404
@@ -16,10 +17,12 @@ from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
+import metrics
 import settings
-from api.ipn import constants
-from models import Payment, Preapproval
-from decorators import takes_ipn
+from api import TransportError
+from models import IPNMessage, Payment, Preapproval
+from processing import (apply_message, precheck, stored_body, verify_message,
+                        NOT_FOUND, SECRET_MISMATCH, UNKNOWN_TYPE)
 
 
 logger = logging.getLogger(__name__)
@@ -48,9 +51,8 @@ def payment_cancel(request, payment_id, secret_uuid,
 
     payment = get_object_or_404(Payment, id=payment_id,
                                 secret_uuid=secret_uuid)
-    
-    payment.status = 'canceled'
-    payment.save()
+
+    payment.transition('canceled')
 
     template_vars = {"is_embedded": settings.USE_EMBEDDED}
     return render(request, template, template_vars)
@@ -71,27 +73,23 @@ def payment_return(request, payment_id, secret_uuid,
                                 secret_uuid=secret_uuid)
 
     if payment.status not in ['created', 'completed']:
-        payment.status_detail = _(u"Expected status to be created or "
-                                  u"completed, not %s - duplicate "
-                                  u"transaction?") % payment.status
-        payment.status = 'error'
-        payment.save()
+        payment.transition('error', status_detail=_(
+            u"Expected status to be created or completed, not %s - "
+            u"duplicate transaction?") % payment.status)
         return HttpResponseServerError('Unexpected error')
 
     elif secret_uuid != payment.secret_uuid:
-        payment.status_detail = (_(u"BuyReturn secret \"%s\" did not match")
-                                 % secret_uuid)
-        payment.status = 'error'
-        payment.save()
+        payment.transition('error', status_detail=(
+            _(u"BuyReturn secret \"%s\" did not match") % secret_uuid))
         return HttpResponseServerError('Unexpected error')
 
     if payment.status != 'completed':
-        payment.status = 'returned'
-        payment.save()
+        # loses to a completing IPN that got in first
+        payment.transition('returned')
 
     if settings.USE_DELAYED_UPDATES:
-        from .tasks import update_payment
-        update_payment.delay(payment_id=payment.id)
+        from .tasks import delay_update
+        delay_update(payment)
 
     template_vars = {"is_embedded": settings.USE_EMBEDDED}
     return render(request, template, template_vars)
@@ -124,106 +122,87 @@ def preapproval_return(request, preapproval_id, secret_uuid,
     logger.info("Return received for Preapproval %s" % preapproval_id)
 
     if preapproval.status not in ['created', 'approved']:
-        preapproval.status_detail = _(
+        preapproval.transition('error', status_detail=_(
             u"Expected status to be created or approved not %s - duplicate "
-            u"transaction?") % preapproval.status
-        preapproval.status = 'error'
-        preapproval.save()
+            u"transaction?") % preapproval.status)
         return HttpResponseServerError('Unexpected error')
 
     elif secret_uuid != preapproval.secret_uuid:
-        preapproval.status_detail = _(u"BuyReturn secret \"%s\" did not"
-                                      u" match") % secret_uuid
-        preapproval.status = 'error'
-        preapproval.save()
+        preapproval.transition('error', status_detail=_(
+            u"BuyReturn secret \"%s\" did not match") % secret_uuid)
         return HttpResponseServerError('Unexpected error')
 
     if preapproval.status != 'approved':
-        preapproval.status = 'returned'
-        preapproval.save()
+        # loses to an approving IPN that got in first
+        preapproval.transition('returned')
 
     if settings.USE_DELAYED_UPDATES:
-        from .tasks import update_preapproval
-        update_preapproval.delay(preapproval_id=preapproval.id)
+        from .tasks import delay_update
+        delay_update(preapproval)
 
     template_vars = {"is_embedded": settings.USE_EMBEDDED,
                      "preapproval": preapproval, }
     return render(request, template, template_vars)
 
 
+def _rejected_response(reason):
+    if reason == NOT_FOUND:
+        raise Http404
+    if reason == SECRET_MISMATCH:
+        return HttpResponseBadRequest('secret uuid mismatch')
+    if reason == UNKNOWN_TYPE:
+        return HttpResponseBadRequest('unknown transaction type')
+
+
+def _ipn_response(message, error=None):
+    if message.status == 'processed':
+        # Ok, no content
+        return HttpResponse(status=204)
+    if message.status == 'rejected':
+        response = _rejected_response(message.error)
+        if response is not None:
+            return response
+        return HttpResponseBadRequest('verify failed')
+    if isinstance(error, TransportError):
+        # Paypal sends it again later
+        return HttpResponse('verify unavailable', status=503)
+    return HttpResponseServerError('Unexpected error')
+
+
 @csrf_exempt
 @require_POST
 @transaction.autocommit
-@takes_ipn
-def ipn(request, object_id, object_secret_uuid, ipn):
+def ipn(request, object_id, object_secret_uuid):
     """
-    Incoming IPN POST request from Paypal
+    Incoming IPN POST request from Paypal. With PAYPAL_ASYNC_IPN it's only
+    stored here, and verified and applied by process_ipn_messages.
+    Messages Paypal sends again are answered from the stored copy.
 
     """
 
-    logger.debug("Incoming IPN call: " + str(request))
+    body = stored_body(request)
+    logger.debug('Incoming IPN call to %s: %r' % (request.path, body))
 
-    object_class = {
-        constants.IPN_TYPE_PAYMENT: Payment,
-        constants.IPN_TYPE_PREAPPROVAL: Preapproval,
-        constants.IPN_TYPE_ADJUSTMENT: Payment
-    }[ipn.type]
+    # junk isn't worth a call to Paypal
+    reason = precheck(QueryDict(body), object_id, object_secret_uuid)
+    if reason is not None:
+        return _rejected_response(reason)
 
-    try:
-        obj = object_class.objects.get(pk=object_id)
-    except object_class.DoesNotExist:
-        logger.warning('Could not find %s ID %s, replying to IPN with '
-                       '404.' % (object_class.__name__, object_id))
-        raise Http404
+    message, created = IPNMessage.objects.receive(
+        object_id, object_secret_uuid, body)
 
-    if obj.secret_uuid != object_secret_uuid:
-        obj.status = 'error'
-        obj.status_detail = ('IPN secret "%s" did not match db'
-                             % object_secret_uuid)
-        obj.save()
-        return HttpResponseBadRequest('secret uuid mismatch')
+    if not created:
+        metrics.incr('ipn.duplicate')
+        if message.status in ('processed', 'rejected'):
+            return _ipn_response(message)
+
+    if settings.ASYNC_IPN:
+        return HttpResponse('')
+
+    if not IPNMessage.objects.claim_message(message):
+        # another request or worker is on it, Paypal sends it again later
+        return HttpResponse('verify unavailable', status=503)
 
-    # IPN type-specific operations
-    if ipn.type == constants.IPN_TYPE_PAYMENT:
-        obj.transaction_id = ipn.transactions[0].id
-
-        if obj.money != ipn.transactions[0].amount:
-            obj.status = 'error'
-            obj.status_detail = ("IPN amounts didn't match. Payment requested "
-                                 "%s. Payment made %s"
-                                 % (obj.money, ipn.transactions[0].amount))
-
-        # check payment status
-        elif request.POST.get('status', '') != 'COMPLETED':
-            obj.status = 'error'
-            obj.status_detail = ('PayPal status was "%s"'
-                                 % request.POST.get('status'))
-        else:
-            obj.status = 'completed'
-
-            # TODO: mark preapproval 'used'
-    elif ipn.type == constants.IPN_TYPE_PREAPPROVAL:
-        if obj.money != ipn.max_total_amount_of_all_payments:
-            obj.status = 'error'
-            obj.status_detail = (
-                "IPN amounts didn't match. Preapproval requested %s. "
-                "Preapproval made %s"
-                % (obj.money, ipn.max_total_amount_of_all_payments))
-        elif ipn.status == constants.IPN_STATUS_CANCELED:
-            obj.status = 'canceled'
-            obj.status_detail = 'Cancellation received via IPN'
-        elif not ipn.approved:
-            obj.status = 'error'
-            obj.status_detail = "The preapproval is not approved"
-        else:
-            obj.status = 'approved'
-    else:
-        logger.warning(
-            'No action found for IPN Type "%s" with status "%s" (id: "%s", '
-            'secret_uuid: %s)'
-            % (ipn.type, ipn.status, obj.id, obj.secret_uuid))
-
-    obj.save()
-
-    # Ok, no content
-    return HttpResponse(status=204)
+    ipn, error = verify_message(message)
+    apply_message(message, ipn, error)
+    return _ipn_response(message, error)
@@ -14,6 +14,7 @@ setup(
     install_requires=[
         'Django>=1.4.3',
         'python-dateutil==2.1',
+        'futures>=2.1.3',
         'python-money',
     ],
     extras_require={